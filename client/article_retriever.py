@@ -129,7 +129,7 @@ class AbstractArticleRetriever(object):
             'Accept-Charset' : 'ISO-8859-1,utf-8;q=0.7,*;q=0.7',
             }
 
-    def __init__(self, extra_headers=None):
+    def __init__(self, extra_headers=None, lease_renewer=None):
         """AbstractArticleRetriever Constructor.
 
         Descendents should call this constructor just to setup common instance
@@ -139,12 +139,22 @@ class AbstractArticleRetriever(object):
         @param total_comments Total number of comments
         @param extra_headers extra headers sent on every HTTP request made by
                    this client
+        @param lease_renewer a function, called with no arguments before
+                   every page is retrieved, that renews the lease of the job
+                   being processed. It raises an exception if the job should
+                   be dropped. See BaseClient.getLeaseRenewer().
         """
         # Setup headers
         if not extra_headers:
             extra_headers = {}
         self.headers = dict(self.COMMOM_HEADERS)
         self.headers.update(extra_headers)
+        self.lease_renewer = lease_renewer
+
+    def renew_lease(self):
+        """Renew the lease of the job being processed, if we know how to."""
+        if self.lease_renewer is not None:
+            self.lease_renewer()
 
     def validate_page(self, page):
         """Verifies if the contents of a downloaded page are valid.
@@ -191,6 +201,7 @@ class AbstractArticleRetriever(object):
             of the informed url. These contents were validated by
             validate_page().
         """
+        self.renew_lease()
         req = urllib2.Request(url, headers=self.headers)
         for attempt in range(1 + n_retries):
             try:
@@ -28,6 +28,7 @@ __license__ = 'X11'
 
 
 import os
+import urllib
 import urllib2
 import time
 #import traceback
@@ -50,6 +51,11 @@ class WrongCommandFormat(Exception):
     pass
 
 
+class JobAborted(Exception):
+    """The server told us to drop the job we are working on."""
+    pass
+
+
 class BaseClient(object):
     """Our client :-)
 
@@ -61,16 +67,39 @@ class BaseClient(object):
     Those methods are registered in self.handlers, a dictionary where keys are
     the command's ACTION name while the methods for carring such actions are the
     values. By default, the SLEPP command is already registered (BaseClient).
-    Descendents should extend this dictionary with their own methods.
+    Descendents should extend this dictionary with their own methods. The
+    server is told which commands (besides SLEEP) we are able to handle, so
+    it doesn't hand us jobs we can't do.
+
+    The server may tell us to drop a job someone else already did, with an
+    ABORT command: either in the response to a lease renewal (see
+    getLeaseRenewer()) or after the SLEEP command we get when we upload a
+    job. Jobs of the current batch we were told to drop are skipped.
 
     Class Atributes
     ---------------
 
     MIN_SLEEP: Minimum ammount of time (in seconds) that client will sleep
         between handling two commands. This overides server commands if needed.
+
+    BATCH_SIZE: Max number of jobs the client asks the server for in a single
+        ping. Jobs in a batch are handled one after the other. The lease of
+        every job but the first is renewed right before the job is handled,
+        so jobs waiting for their turn aren't recycled by the server.
+
+    BATCH_SLEEP: Ammount of time (in seconds) that client will sleep between
+        two jobs of the same batch. MIN_SLEEP is still enforced after the
+        last job of the batch.
+
+    LONG_POLL: Ammount of time (in seconds) the client is willing to wait, in
+        a single ping, for the server to hand it a job. 0 disables long
+        polling: idle clients are just told to SLEEP.
     """
 
     MIN_SLEEP = 240
+    BATCH_SIZE = 1
+    BATCH_SLEEP = 30
+    LONG_POLL = 0
 
     def __init__(self, client_id, base_url, store_dir=None):
         """BaseClient constructor.
@@ -96,7 +125,16 @@ class BaseClient(object):
         self.headers = {'client-id' : client_id,
                         'client-hostname' : socket.getfqdn(),
                         'client-version' : __version__,
-                        'client-arver' : "unknown"}
+                        'client-arver' : "unknown",
+                        'client-aborts' : "1"}
+        if self.BATCH_SIZE > 1:
+            self.headers['client-batch-size'] = str(self.BATCH_SIZE)
+        if self.LONG_POLL > 0:
+            self.headers['client-long-poll'] = str(self.LONG_POLL)
+        # Jobs of the current batch still waiting to be handled
+        self.batch_remaining = 0
+        # Params of the jobs the server told us to drop
+        self.aborted = set()
         # Setup store
         self.store_dir = store_dir
         if self.store_dir:
@@ -107,6 +145,10 @@ class BaseClient(object):
     def run(self):
         """Start event loop - endlessly contact the server for new commands."""
         # Common setup
+        # Tell the server which commands we are able to handle
+        self.headers['client-actions'] = ','.join(
+                [action for action in sorted(self.handlers)
+                 if action != 'SLEEP'])
         ping_url = self.base_url + '/ping'
         ping_req = urllib2.Request(ping_url, headers=self.headers)
         command = None
@@ -145,11 +187,28 @@ class BaseClient(object):
                              sleep_delay)
                 time.sleep(sleep_delay * 60)
 
+    def _parseCommands(self, command):
+        """Split the server response into a list of (action, param) pairs.
+
+        @param command   One or more commands (string) given by the server
+        """
+        tokens = command.split()
+        if not tokens or len(tokens) % 3:
+            raise WrongCommandFormat(command)
+        commands = []
+        for i in range(0, len(tokens), 3):
+            action, param, trailer = tokens[i:i + 3]
+            if trailer != '#':
+                raise WrongCommandFormat(command)
+            commands.append((action, param))
+        return commands
+
     def _handleCommand(self, command, do_sleep=False):
         """Parses and handles a given command.
 
         We also make sure that we don't do successive requests to the site in
-        less than MIN_SLEEP here.
+        less than MIN_SLEEP here. If the server handed us a batch of commands,
+        they are handled in order and we sleep for BATCH_SLEEP between them.
 
         Observe that after submitting the result of an job to the server we will
         receive another command. Althought it ought to be a SLEEP command,  in
@@ -163,14 +222,91 @@ class BaseClient(object):
                          self.MIN_SLEEP, no matter what the ammount given in the 
                          command is.
         """
-        command = command.strip()
-        action, param, trailer = command.split()
-        if trailer != '#':
-            raise WrongCommandFormat(command)
+        commands = self._parseCommands(command.strip())
+        if not do_sleep:
+            # A brand new batch
+            self.aborted.clear()
+        for action, param in commands:
+            if action == 'ABORT':
+                self.aborted.add(param)
+        commands = [(action, param) for action, param in commands
+                    if action != 'ABORT']
         if do_sleep:
-            self.handlers['SLEEP'](max(self.MIN_SLEEP, int(param)))
+            action, param = commands[0]
+            if self.batch_remaining > 0:
+                self.handlers['SLEEP'](self.BATCH_SLEEP)
+            else:
+                self.handlers['SLEEP'](max(self.MIN_SLEEP, int(param)))
         else:
-            self.handlers[action](param)
+            self.batch_remaining = len(commands)
+            for i, (action, param) in enumerate(commands):
+                self.batch_remaining -= 1
+                if param in self.aborted:
+                    logging.info("ABORT - skipping %s %s", action, param)
+                    continue
+                if i > 0 and not self._renewBatchLease(action, param):
+                    continue
+                try:
+                    self.handlers[action](param)
+                except JobAborted:
+                    logging.info("ABORT - dropped %s %s", action, param)
+                    if self.batch_remaining > 0:
+                        self.handlers['SLEEP'](self.BATCH_SLEEP)
+                    else:
+                        self.handlers['SLEEP'](self.MIN_SLEEP)
+
+    def _renewBatchLease(self, action, params):
+        """Renew the lease of a job that waited for its turn in a batch.
+
+        @return False if the job should be skipped, i.e., the server told us
+                to drop it or already handed it to someone else.
+        """
+        response = self.renewLease(action, params)
+        if not response:
+            return True     # We may still beat the server's timeout
+        command = response.split()[0]
+        if command == 'ABORT':
+            logging.info("ABORT - skipping %s %s", action, params)
+            return False
+        if command == 'EXPIRED':
+            logging.info("EXPIRED - skipping %s %s", action, params)
+            return False
+        return True
+
+    def renewLease(self, action, params):
+        """Ask the server not to recycle the job we are working on.
+
+        Long jobs should call this every now and then (say, between pages).
+        Renewing is a best-effort operation: failures are just logged.
+
+        @param action  The ACTION of the job, as given by the server
+        @param params  The parameters of the job, as given by the server
+
+        @return The server response (a command) or None if renewal failed.
+        """
+        query = urllib.urlencode({'action': action, 'params': params})
+        renew_req = urllib2.Request(self.base_url + '/renew?' + query,
+                                    headers=self.headers)
+        try:
+            return urllib2.urlopen(renew_req).read()
+        except (urllib2.URLError, socket.error):
+            logging.warning("RENEW - could not renew lease for %s %s",
+                            action, params)
+            return None
+
+    def getLeaseRenewer(self, action, params):
+        """Return a function that renews the lease of a given job.
+
+        Handy for passing to article retrievers, that call it between pages.
+        See renewLease(). The function raises JobAborted if the server tells
+        us to drop the job, which makes the command handler stop early.
+        """
+        def renew():
+            response = self.renewLease(action, params)
+            if response is not None and response.startswith('ABORT'):
+                raise JobAborted(action, params)
+            return response
+        return renew
 
     def _write_to_store(self, article_id, data):
         """Write some sort of retrieved data (article) into a file in the
@@ -64,7 +64,8 @@ class ArticleRetriever(object):
             'Accept-Charset' : 'ISO-8859-1,utf-8;q=0.7,*;q=0.7',
             }
 
-    def __init__(self, story_id, total_comments, log=sys.stderr, extra_headers={}):
+    def __init__(self, story_id, total_comments, log=sys.stderr, extra_headers={},
+                 lease_renewer=None):
         """
         @param story_id Identifier of the article
         @param total_comments Total number of comments
@@ -72,6 +73,10 @@ class ArticleRetriever(object):
                    during the processing of an article.
         @param extra_headers extra headers sent on every HTTP request made by
                    this client
+        @param lease_renewer a function, called with no arguments before
+                   every page is retrieved, that renews the lease of the job
+                   being processed. It raises an exception if the job should
+                   be dropped.
         """
        
         self.URL_PREFIX = "http://services.digg.com/stories/"
@@ -86,14 +91,20 @@ class ArticleRetriever(object):
         # Setup headers
         self.headers = dict(self.COMMOM_HEADERS)
         self.headers.update(extra_headers)
+        self.lease_renewer = lease_renewer
 
-    def _get_next_pages_urls(self):
-        """Get the URL's of the remaining pages of comments."""
+    def _get_next_pages_urls(self, offset=0, numcomms=None):
+        """Get the URL's of the remaining pages of comments.
+
+        @param offset index of the first comment wanted.
+        @param numcomms number of comments wanted, from offset on. Defaults to
+                   the total number of comments.
+        """
         more_pages_urls = []
-        numcomms = int(self.total_comments)
+        if numcomms is None:
+            numcomms = int(self.total_comments)
         rest = numcomms
         count = 100
-        offset = 0
         while(rest > 100):
             link = self.url_basic + ",0/comments?offset=" + str(offset) + "&count=" + str(count) + self.URL_SUFIX 
             more_pages_urls.append(link)    
@@ -154,6 +165,8 @@ class ArticleRetriever(object):
         in the last attempt will not be masked and their correspondig exceptions
         will also be raised.
         """
+        if self.lease_renewer is not None:
+            self.lease_renewer()
         req = urllib2.Request(url, headers=self.headers)
         for attempt in range(1 + n_retries):
             try:
@@ -212,10 +225,28 @@ class ArticleRetriever(object):
 
     def get_article_compressed(self):
         """Returns a StringIO with the article contents compressed with gzip."""
+        return self._compress(self.get_article())
+
+    def get_comments(self, offset, count):
+        """Return the events (comments) of a range of the article's comments.
+
+        The server merges such ranges into the whole article.
+
+        @param offset index of the first comment wanted.
+        @param count number of comments wanted.
+        """
+        return str(self._merge(self._get_next_pages_urls(offset, count)))
+
+    def get_comments_compressed(self, offset, count):
+        """Returns a StringIO with a range of the article's comments
+        compressed with gzip. See get_comments()."""
+        return self._compress(self.get_comments(offset, count))
 
+    def _compress(self, data):
+        """Returns a StringIO with data compressed with gzip."""
         mem_file = StringIO.StringIO()
         gzip_file = gzip.GzipFile(mode='wb',fileobj=mem_file)
-        gzip_file.write(self.get_article())
+        gzip_file.write(data)
         gzip_file.close()
         mem_file.seek(0)
         return mem_file
@@ -40,6 +40,7 @@ class DiggClient(BaseClient):
         self.headers["client-arver'"] =  articleretriever_version
         # Registering Command Handlers
         self.handlers['ARTICLE'] = self.article
+        self.handlers['ARTICLEPART'] = self.article_part
 
     def _write_to_store(self, article_id, data):
         """Write a (compressed) article to store.
@@ -58,7 +59,8 @@ class DiggClient(BaseClient):
         story_id, total_comments = server_data.split()
         # Download article
         log.write( "ARTICLE " + str(story_id) + " BEGIN\n")
-        downloader = ArticleRetriever(story_id, total_comments)
+        downloader = ArticleRetriever(story_id, total_comments,
+                lease_renewer=self.getLeaseRenewer('ARTICLE', params))
         compressed_article = downloader.get_article_compressed()
         self._write_to_store(story_id, compressed_article)
         log.write( "ARTICLE " + str(story_id) + " GOT COMPRESSED DATA\n")
@@ -77,6 +79,30 @@ class DiggClient(BaseClient):
         command = response.read()
         self._handleCommand(command, do_sleep=True)
 
+    def article_part(self, params):
+        """Retrieve a range of an article's comments and send it to the
+        server, which merges the parts of the article."""
+        story_id, total_comments, offset, count = params.split('/')
+        log.write( "ARTICLEPART " + params + " BEGIN\n")
+        downloader = ArticleRetriever(story_id, total_comments,
+                lease_renewer=self.getLeaseRenewer('ARTICLEPART', params))
+        compressed_part = downloader.get_comments_compressed(int(offset),
+                                                             int(count))
+        self._write_to_store(params, compressed_part)
+        log.write( "ARTICLEPART " + params + " GOT COMPRESSED DATA\n")
+        # Setup upload form and headers
+        upload_headers = dict(self.headers)
+        form_data = {'part-data' : compressed_part,
+                     'part-sid'  : params,
+                     'client-id' : self.id}
+        # Upload the part
+        upload_url = self.base_url + '/articlepart/' + params
+        response = upload_aux.upload_form(upload_url, form_data, upload_headers)
+        log.write( "ARTICLEPART " + params + " END\n")
+        # Command MUST be SLEEP. We will sleep for at least self.MIN_SLEEP
+        command = response.read()
+        self._handleCommand(command, do_sleep=True)
+
 
 #TODO(macambira): move main out of this module or refactor it into a set of small helper functions
 
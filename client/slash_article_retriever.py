@@ -87,7 +87,8 @@ class ArticleRetriever(object):
             'Accept-Charset' : 'ISO-8859-1,utf-8;q=0.7,*;q=0.7',
             }
 
-    def __init__(self, sid, url=None, log=sys.stderr, extra_headers={}):
+    def __init__(self, sid, url=None, log=sys.stderr, extra_headers={},
+                 lease_renewer=None):
         """
         @param sid the sid of the article one wants to retrieve. Can be set to
                    None to force the download of a given URL as article.
@@ -97,6 +98,10 @@ class ArticleRetriever(object):
                    during the processing of an article.
         @param extra_headers extra headers sent on every HTTP request made by
                     this client
+        @param lease_renewer a function, called with no arguments before
+                   every page is retrieved, that renews the lease of the job
+                   being processed. It raises an exception if the job should
+                   be dropped.
         """
         if sid is None:
             self.sid = 'NO-ARTICLE-SID'
@@ -113,6 +118,7 @@ class ArticleRetriever(object):
         self.headers = dict(self.COMMOM_HEADERS)
         self.headers.update(extra_headers)
         self.headers['Referer'] = referer
+        self.lease_renewer = lease_renewer
 
     def _get_next_comment_pages_urls(self):
         """Get the URL's of the remaining pages of comments."""
@@ -174,6 +180,8 @@ class ArticleRetriever(object):
         in the last attempt will not be masked and their correspondig exceptions
         will also be raised.
         """
+        if self.lease_renewer is not None:
+            self.lease_renewer()
         req = urllib2.Request(url, headers=self.headers)
         for attempt in range(1 + n_retries):
             try:
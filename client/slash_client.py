@@ -84,7 +84,8 @@ class SlashClient(BaseClient):
         article_sid = params.strip()
         log.write("ARTICLE " + article_sid + " BEGIN\n")
         try:
-            downloader = ArticleRetriever(article_sid, log=log)
+            downloader = ArticleRetriever(article_sid, log=log,
+                    lease_renewer=self.getLeaseRenewer('ARTICLE', params))
             compressed_article = downloader.getArticleCompressed()
             self._write_to_store(article_sid, compressed_article)
             log.write("ARTICLE " + article_sid + " GOT COMPRESSED DATA\n")
@@ -1,8 +1,8 @@
-from server import BaseControler, BaseDistributedCrawlingServer, ClientRegistry, GdbmBaseControler, InvalidClientId, ManageScheduler, Ping, BsddbBaseControler
+from server import BaseControler, BaseDistributedCrawlingServer, ClientRegistry, GdbmBaseControler, InvalidClientId, ManageScheduler, Ping, RenewLease, BsddbBaseControler
 
 # import important modules and bring server.py main classes into this
 # namespace -- saves time, and avoids DistributedCrawler.server.server imports
 
 __all__ = ["server", "scheduler", "BaseControler", "BsddbBaseControler",
         "BaseDistributedCrawlingServer", "ClientRegistry", "GdbmBaseControler",
-        "InvalidClientId", "ManageScheduler", "Ping"]
+        "InvalidClientId", "ManageScheduler", "Ping", "RenewLease"]
@@ -9,27 +9,222 @@ __author__ = "fonseca at ddc ufmg br & tmacam"
 __copyright__ = 'Copyright (c) 2006-2008 Tiago Alves Macambira'
 __license__ = 'X11'
 
+import gzip
+import math
 import os
+import re
 
-from server import BaseControler, BaseDistributedCrawlingServer
+from server import BaseControler, BaseDistributedCrawlingServer, sendsAborts
+from twisted.persisted.dirdbm import DirDBM
 from twisted.python import log
 from twisted.python.logfile import DailyLogFile
 
+# Get the fastest StringIO implementation available
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
 class ArticleControler(BaseControler):
-    """Task Controller tha receives retrieved Digg articles."""
+    """Task Controller tha receives retrieved Digg articles.
+
+    Articles with more than SPLIT_THRESHOLD comments are not handed to a
+    single client. Instead, they are split in parts of PART_SIZE comments,
+    handled by an ArticlePartControler, that are retrieved by several
+    clients at once. Once every part has arrived, the parts are merged into
+    the same .xml.gz file a single client would have sent us. Split articles
+    waiting for their parts are kept in a "split" store, so we can find them
+    after a restart without listing every pending article.
+
+    Articles keep getting comments after they are crawled, so they are
+    crawled again (as "story_id/expected_total_comments" jobs) when enough
+    new comments are expected, per page fetched, as estimated from the
+    comment counts of previous crawls.
+    """
     ACTION_NAME = "ARTICLE"
     PREFIX_BASE = "articles"
+    HOST_KEY = "services.digg.com"
+    SIZE_AWARE = True
+    SPLIT_THRESHOLD = 1000
+    PART_SIZE = 300
+    REVISIT_BUDGET = 50
+    REVISIT_MIN_GAIN = 10    # new comments per page fetched
+    COMMENTS_PER_PAGE = 100
 
-    def __init__(self, sched, prefix, client_reg, store_dir):
+    def __init__(self, sched, prefix, client_reg, store_dir,
+                 part_controler=None):
         """
         @param store_dir where the articles (compressed) will be stored.
+        @param part_controler an ArticlePartControler. If None, articles are
+                   never split.
         """
-        BaseControler.__init__(self, sched, prefix, client_reg)
         # Setup a directory where we store received articles.
         # Try to create this directory if it doesn't exist
         if not os.path.isdir(store_dir):
             os.makedirs(store_dir)
         self.store_dir = store_dir
+        # Pending articles may be split (and merged) as soon as we load them
+        self.part_controler = part_controler
+        if part_controler is not None:
+            part_controler.article_controler = self
+        BaseControler.__init__(self, sched, prefix, client_reg)
+        # Pending articles aren't loaded when the scheduler state comes from
+        # a snapshot, but we may have stopped right before merging some
+        if part_controler is not None and sched.isRestored(self.ACTION_NAME):
+            for job in self.split_store.keys():
+                if job in self.store:
+                    self._mergeIfComplete(job)
+                else:
+                    self._forgetSplit(job)
+
+    def setupStableStorage(self):
+        """Setup the usual stores and the one with the split articles
+        waiting for their parts."""
+        BaseControler.setupStableStorage(self)
+        split_store_path = self.store_path + "/split"
+        if not os.path.isdir(split_store_path):
+            os.makedirs(split_store_path)
+        self.split_store = DirDBM(split_store_path)
+
+    def getJobCost(self, job):
+        """Articles cost as much as the comments they have.
+
+        Jobs are "story_id/total_comments" strings.
+        """
+        try:
+            return int(job.split('/')[-1]) + 1
+        except ValueError:
+            return None
+
+    def isSplit(self, job):
+        """Is this article retrieved in parts?"""
+        if self.part_controler is None:
+            return False
+        cost = self.getJobCost(job)
+        return cost is not None and cost - 1 > self.SPLIT_THRESHOLD
+
+    def getParts(self, job):
+        """Return the jobs ("story_id/total_comments/offset/count") of the
+        parts of an article, in order."""
+        total_comments = int(job.split('/')[-1])
+        parts = []
+        for offset in range(0, total_comments, self.PART_SIZE):
+            count = min(self.PART_SIZE, total_comments - offset)
+            parts.append("%s/%i/%i" % (job, offset, count))
+        return parts
+
+    def _addToScheduler(self, job, priority=None, deadline=None):
+        """Register a pending job with the scheduler, or its parts with the
+        part controler if the article is to be split."""
+        if not self.isSplit(job):
+            BaseControler._addToScheduler(self, job, priority, deadline)
+            return
+        self.split_store[job] = '1'
+        for part in self.getParts(job):
+            self.part_controler.addJob(part, priority, deadline)
+        # Maybe we stopped right before merging it last time
+        self._mergeIfComplete(job)
+
+    def _isScheduled(self, job):
+        """Split articles are known by the scheduler once all their parts
+        were handed to the part controler."""
+        if not self.isSplit(job):
+            return BaseControler._isScheduled(self, job)
+        part_controler = self.part_controler
+        for part in self.getParts(job):
+            if part not in part_controler.store and \
+                    part not in part_controler.done_store:
+                return False
+        return True
+
+    def _removeFromScheduler(self, job, client_id=None, size=None):
+        """Split articles were never handed to the scheduler, their parts
+        were."""
+        if not self.isSplit(job):
+            BaseControler._removeFromScheduler(self, job, client_id, size)
+
+    def getRevisitKey(self, job):
+        """Articles are identified by their story_id."""
+        return job.split('/')[0]
+
+    def getRevisitJob(self, key, measure):
+        """Ask for as many comments as we expect the article to have."""
+        return "%s/%i" % (key, int(math.ceil(measure)))
+
+    def _recordArticle(self, job, data):
+        """Record how many comments an article has for planning revisits.
+
+        @param data the article's (uncompressed) XML.
+        """
+        match = EVENTS_TOTAL_RE.search(data)
+        if match is not None:
+            total_comments = int(match.group(1))
+        else:
+            total_comments = int(job.split('/')[-1])
+        pages = total_comments // self.COMMENTS_PER_PAGE + 1
+        self.recordVisit(job, total_comments, pages)
+
+    def _getFilename(self, job):
+        """Return the name of the file where an article is stored."""
+        escaped_sid = job.replace('/', '_')
+        return os.path.join(self.store_dir, escaped_sid + '.xml.gz')
+
+    def partDone(self, part):
+        """Merge the article of a part that was just done, if it was the
+        last one missing."""
+        self._mergeIfComplete(part.rsplit('/', 2)[0])
+
+    def partFailed(self, part):
+        """Give up on the article of a part we gave up on, and on its other
+        pending parts."""
+        job = part.rsplit('/', 2)[0]
+        if job not in self.store:
+            return
+        self.markJobAsErroneus(job)
+        self._forgetSplit(job)
+        for other in self.getParts(job):
+            if other in self.part_controler.store:
+                self.part_controler.markJobAsErroneus(other)
+
+    def partExpired(self, part):
+        """Expire the article of a part that missed its deadline, and its
+        other pending parts."""
+        job = part.rsplit('/', 2)[0]
+        if job not in self.store:
+            return
+        self.markJobAsExpired(job)
+        self._forgetSplit(job)
+        for other in self.getParts(job):
+            if other in self.part_controler.store:
+                self.part_controler.markJobAsExpired(other)
+
+    def _forgetSplit(self, job):
+        """Remove an article that is no longer pending from the split
+        store."""
+        if job in self.split_store:
+            del self.split_store[job]
+
+    def _mergeIfComplete(self, job):
+        """Merge the parts of a pending article if they all arrived."""
+        if job not in self.store:
+            return
+        parts = self.getParts(job)
+        done_store = self.part_controler.done_store
+        for part in parts:
+            if part not in done_store:
+                return
+        filenames = [self.part_controler.getFilename(part) for part in parts]
+        merged = mergeEvents([gzip.open(filename, 'rb').read()
+                              for filename in filenames])
+        fh = gzip.open(self._getFilename(job), 'wb')
+        fh.write(merged)
+        fh.close()
+        self.markJobAsDone(job)
+        self._forgetSplit(job)
+        self._recordArticle(job, merged)
+        for filename in filenames:
+            os.remove(filename)
+        log.msg("ARTICLE %s merged from %i parts." % (job, len(parts)))
 
     def render_POST(self, request):
         """Process the article returned by a client."""
@@ -38,15 +233,94 @@ class ArticleControler(BaseControler):
         article_sid = request.args['article-sid'][0]
         article_data = request.args['article-data'][0]
         # save the contents of the article
-        escaped_sid = article_sid.replace('/', '_')
-        fh_filename = os.path.join(self.store_dir, escaped_sid + '.xml.gz')
-        fh = open(fh_filename, 'wb')
+        fh = open(self._getFilename(article_sid), 'wb')
         fh.write(article_data)
         fh.close()
         # Ok! Article saved!
-        self.markJobAsDone(article_sid)
+        was_pending = article_sid in self.store
+        self.markJobAsDone(article_sid, client_id, len(article_data))
+        if was_pending and self.revisits is not None:
+            self._recordArticle(article_sid, gzip.GzipFile(
+                    fileobj=StringIO.StringIO(article_data)).read())
         log.msg("ARTICLE %s done by client %s." % (article_sid, client_id))
-        return self.scheduler.renderPing(client_id, just_ping=True)
+        return self.scheduler.renderPing(client_id, just_ping=True,
+                                         send_aborts=sendsAborts(request))
+
+
+class ArticlePartControler(BaseControler):
+    """Task Controller that receives parts of huge Digg articles.
+
+    A part is a range of an article's comments, identified by
+    "story_id/total_comments/offset/count". Parts are kept in a "parts"
+    directory until their ArticleControler merges them.
+    """
+    ACTION_NAME = "ARTICLEPART"
+    PREFIX_BASE = "articleparts"
+    HOST_KEY = "services.digg.com"
+
+    def __init__(self, sched, prefix, client_reg, store_dir):
+        """
+        @param store_dir where the articles (compressed) will be stored.
+                   Parts are stored in its "parts" subdirectory.
+        """
+        BaseControler.__init__(self, sched, prefix, client_reg)
+        self.article_controler = None   # set by our ArticleControler
+        self.store_dir = os.path.join(store_dir, 'parts')
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def getFilename(self, part):
+        """Return the name of the file where a part is stored."""
+        escaped_sid = part.replace('/', '_')
+        return os.path.join(self.store_dir, escaped_sid + '.xml.gz')
+
+    def markJobAsErroneus(self, job):
+        """Give up on a part and on its article as well."""
+        BaseControler.markJobAsErroneus(self, job)
+        self.article_controler.partFailed(job)
+
+    def markJobAsExpired(self, job):
+        """Expire a part and its article as well."""
+        BaseControler.markJobAsExpired(self, job)
+        self.article_controler.partExpired(job)
+
+    def render_POST(self, request):
+        """Process the article part returned by a client."""
+        client_id = self.client_reg.updateClientStats(request)
+        part_sid = request.args['part-sid'][0]
+        part_data = request.args['part-data'][0]
+        fh = open(self.getFilename(part_sid), 'wb')
+        fh.write(part_data)
+        fh.close()
+        self.markJobAsDone(part_sid, client_id, len(part_data))
+        log.msg("ARTICLEPART %s done by client %s." % (part_sid, client_id))
+        self.article_controler.partDone(part_sid)
+        return self.scheduler.renderPing(client_id, just_ping=True,
+                                         send_aborts=sendsAborts(request))
+
+
+EVENTS_START_RE = re.compile(r'<events\b[^>]*>')
+EVENTS_END = '</events>'
+EVENTS_TOTAL_RE = re.compile(r'<events\b[^>]*\btotal="(\d+)"')
+
+
+def mergeEvents(parts):
+    """Merge the <events> of several article parts into the first part.
+
+    @param parts list with the (uncompressed) XML of every part, in order.
+    """
+    pieces = []
+    for data in parts:
+        start = EVENTS_START_RE.search(data)
+        end = data.rfind(EVENTS_END)
+        if start is None or end < 0:
+            raise ValueError("Article part without <events>")
+        if not pieces:
+            pieces.append(data[:end])
+        else:
+            pieces.append(data[start.end():end])
+    pieces.append(data[end:])
+    return ''.join(pieces)
 
 
 def main():
@@ -56,17 +330,26 @@ def main():
     PREFIX = './db/'
     ARTICLE_STORE_DIR = './article_archive/'
     INTERVAL = 60
+    SNAPSHOT_INTERVAL = 600
 
     # Setup logging
     logfile = DailyLogFile('diggcrawler.log', '.')
     log.startLogging(logfile)
 
-    server = BaseDistributedCrawlingServer(PORT, PREFIX, INTERVAL)
+    server = BaseDistributedCrawlingServer(PORT, PREFIX, INTERVAL,
+                                           snapshot_interval=SNAPSHOT_INTERVAL)
+    part_controler = ArticlePartControler(server.getScheduler(),
+                                          PREFIX,
+                                          server.getClientRegistry(),
+                                          ARTICLE_STORE_DIR)
     article_controler = ArticleControler(server.getScheduler(),
                                          PREFIX,
                                          server.getClientRegistry(),
-                                        ARTICLE_STORE_DIR)
+                                        ARTICLE_STORE_DIR,
+                                        part_controler)
     server.registerTaskController(article_controler, 'article', 'Articles')
+    server.registerTaskController(part_controler, 'articlepart',
+                                  'Article parts')
     server.run()
     
     
@@ -10,8 +10,11 @@
 """Peridically assigns jobs to be processed."""
 
 
-# We are not expecting more then 1k clients so, O(n) algorithms are
-# more than enough.
+# We used to expect no more then 1k clients, so O(n) algorithms over the peers
+# were more than enough. Job queues are another story: a crawl can easily have a
+# few million pending jobs. Either way, every operation done while handling a
+# ping, an upload or a beat must be O(1) or only touch what actually changed --
+# see IndexedQueue, Scheduler.lease_heap and Scheduler.peers.
 # Remember:
 #   - KISS!
 #   - Premature optimization is the root of all evil.
@@ -24,49 +27,1252 @@
 #  It is the clients' job avoiding being caught crawling a site. Our job is to
 # avoid DDOSing said site.
 #
-# We don't provide a stable storage for enqueued works. This must be performed
-# by someone else. In our current implementation, this is how things are:
-#
-#  * scheduler's queues are volatile, i.e., must be repopulated every time a
-#    server is restarted .
+# We don't provide the stable storage of record for enqueued works. This must
+# be performed by someone else. In our current implementation, this is how
+# things are:
 #
 #  * Descendents from BaseControler (server.py) implement stable storange
-#    mechanisms and are responsible for re-registering pending tasks with
-#    the scheduler at every restart.
+#    mechanisms and hold every pending task.
+#
+#  * scheduler's queues can be saved to a snapshot (see
+#    Scheduler.saveSnapshot()), with the transitions since then logged to a
+#    journal (see Scheduler.openJournal()). At restart the snapshot is loaded
+#    and the journal replayed (see Scheduler.loadSnapshot()), so controllers
+#    whose actions were restored (see Scheduler.isRestored()) don't have to
+#    re-register their pending tasks.
+#
+#  * Without a snapshot, scheduler's queues are empty at restart and the
+#    controllers re-register their pending tasks with the scheduler.
 
 
-__all__ = ["Scheduler"]
-__version__ = "0.4.lastfm-" + "$Revision$".split()[1]
+__all__ = ["Scheduler", "JobTable", "IndexedQueue", "AgingPriorityQueue",
+           "TokenBucket", "RateMeter", "PeerStats", "WakeupSlots", "HostQueue",
+           "ActionQueue", "PoliteWorkQueue", "RoutedQueue",
+           "AIMDRateController", "RevisitPlanner"]
+# $Revision$ is only expanded in checkouts of the original repository
+__version__ = "0.4.lastfm-" + ("$Revision$".split()[1:] or ["unknown"])[0]
 __date__ = "2008-09-29 21:09:46 -0300 (Mon, 29 Sep 2008)"
 __author__ = "Tiago Alves Macambira"
 __copyright__ = "Copyright (c) 2006-2008 Tiago Alves Macambira"
 __license__ = 'X11'
 
 
+import bisect
+import cPickle
+import heapq
+import itertools
 import math
+import os
+import random
+import shutil
 import time
+from collections import deque, OrderedDict
+from twisted.internet import threads
 from twisted.python import log
 
+
+class JobTable(object):
+    """Compact representation of jobs.
+
+    Jobs are (action, params) pairs of strings. Instead of a tuple (and the
+    strings in it) for every job, the scheduler keeps a single string per job
+    in its queues and dicts: the job "id", made of its action code (a single
+    byte) followed by its params. Action names are interned in a table, so
+    each of them is kept only once.
+
+    Up to MAX_ACTIONS different actions are supported.
+    """
+
+    MAX_ACTIONS = 256
+
+    def __init__(self, actions=()):
+        """Constructor.
+
+        Args:
+            actions: initial action table, with action names in the order of
+                their codes. See getActions().
+        """
+        self.actions = []       # action code as index, action as value
+        self.action_codes = {}  # action as key, action code as value
+        for action in actions:
+            self._addAction(action)
+
+    def _addAction(self, action):
+        if len(self.actions) >= self.MAX_ACTIONS:
+            raise ValueError("too many actions: " + action)
+        code = self.action_codes[action] = len(self.actions)
+        self.actions.append(action)
+        return code
+
+    def getActions(self):
+        """Return the action table, see the constructor."""
+        return list(self.actions)
+
+    def add(self, action, params):
+        """Return the id of a job, adding its action to the table if needed.
+        """
+        code = self.action_codes.get(action)
+        if code is None:
+            code = self._addAction(action)
+        return chr(code) + params
+
+    def find(self, action, params):
+        """Return the id of a job, or None if its action is unknown."""
+        code = self.action_codes.get(action)
+        if code is None:
+            return None
+        return chr(code) + params
+
+    def get(self, job_id):
+        """Return the (action, params) pair of a job."""
+        return self.actions[ord(job_id[0])], job_id[1:]
+
+    def actionOf(self, job_id):
+        """Return the action of a job."""
+        return self.actions[ord(job_id[0])]
+
+
+class IndexedQueue(object):
+    """A double-ended queue that also knows what is inside it.
+
+    Items are kept in a deque in the order they were added, along with an
+    index (a dict) of the items currently in the queue. This makes appending
+    or popping items at either end, membership tests and removal of an item
+    from anywhere in the queue O(1) (amortized) operations.
+
+    Removal is lazy: a removed item is just dropped from the index and its
+    entry in the deque is skipped when it reaches one of the ends. The deque
+    holds bare items, so the queue stays small even with millions of items.
+    An item that was removed and then re-added may have stale entries in the
+    deque, besides its live one. Those are counted and, since the live entry
+    is always the one closest to the end it was added to, told apart from
+    the live one. The deque is compacted if stale entries start to pile up.
+
+    Items must be hashable and there are no duplicates: adding an item that
+    is already in the queue is a no-op.
+    """
+
+    RIGHT, LEFT = 0, 1
+
+    def __init__(self, items=()):
+        """Constructor.
+
+        Args:
+            items: an optional iterable with the initial contents of the
+                queue, from its start to its end.
+        """
+        self._queue = deque()   # items, stale entries included
+        self._index = {}        # item as key, end it was added to as value
+        self._stale = {}        # item as key, # of stale entries as value
+        self.extend(items)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def __iter__(self):
+        """Iterate over the items in the queue, from its start to its end."""
+        index = self._index
+        stale = self._stale
+        seen = {}   # entries seen so far, for items with stale entries
+        for item in self._queue:
+            if item not in index:
+                continue
+            if item not in stale:
+                yield item
+                continue
+            n = seen[item] = seen.get(item, 0) + 1
+            if index[item] == self.LEFT:
+                if n == 1:
+                    yield item      # the leftmost entry is the live one
+            elif n == stale[item] + 1:
+                yield item          # the rightmost entry is the live one
+
+    def _push(self, item, left):
+        if item in self._index:
+            return
+        if left:
+            self._index[item] = self.LEFT
+            self._queue.appendleft(item)
+        else:
+            self._index[item] = self.RIGHT
+            self._queue.append(item)
+
+    def _pop(self, left):
+        index = self._index
+        stale = self._stale
+        if left:
+            pop = self._queue.popleft
+            end = self.LEFT
+        else:
+            pop = self._queue.pop
+            end = self.RIGHT
+        while self._queue:
+            item = pop()
+            if item in stale:
+                # The live entry, if any, is the one closest to its end
+                if item in index and index[item] == end:
+                    del index[item]
+                    return item
+                stale[item] -= 1
+                if not stale[item]:
+                    del stale[item]
+                continue
+            if item in index:
+                del index[item]
+                return item
+        raise IndexError("pop from an empty queue")
+
+    def append(self, item):
+        """Add an item to the end of the queue."""
+        self._push(item, False)
+
+    def appendleft(self, item):
+        """Add an item to the start of the queue."""
+        self._push(item, True)
+
+    def extend(self, items):
+        """Add several items to the end of the queue, in order.
+
+        Same as calling append() for every item, only faster.
+        """
+        index = self._index
+        append = self._queue.append
+        right = self.RIGHT
+        for item in items:
+            if item not in index:
+                index[item] = right
+                append(item)
+
+    def tail(self, n):
+        """Return a list of (up to) n items from the end of the queue, the
+        last one first.
+
+        Items that were removed and re-added may be left out.
+        """
+        index = self._index
+        stale = self._stale
+        items = []
+        for item in reversed(self._queue):
+            if len(items) >= n:
+                break
+            if item in index and item not in stale:
+                items.append(item)
+        return items
+
+    def pop(self):
+        """Remove and return the item at the end of the queue."""
+        return self._pop(False)
+
+    def popleft(self):
+        """Remove and return the item at the start of the queue."""
+        return self._pop(True)
+
+    def remove(self, item):
+        """Remove an item from the queue. Raises ValueError if not present."""
+        try:
+            del self._index[item]
+        except KeyError:
+            raise ValueError("item not in queue: " + str(item))
+        self._stale[item] = self._stale.get(item, 0) + 1
+        # Don't let stale entries use more memory than the live ones
+        if len(self._queue) > 2 * len(self._index) + 64:
+            self._queue = deque(self)
+            self._stale = {}
+
+
+class AgingPriorityQueue(object):
+    """A heap-backed priority queue where waiting jobs slowly gain priority.
+
+    Higher priorities are popped first. To make sure low priority items still
+    make progress, an item gains `aging` priority points for every second it
+    waits in the queue. Since every item ages at the same pace, this is done
+    by ranking items by (aging * enqueue_time - priority) -- a value that
+    doesn't change while the item waits. So, pushing and popping are still
+    O(log n) operations.
+
+    Removal is lazy, as in IndexedQueue: removed items are dropped from the
+    index and their stale heap entries are skipped when they reach the top.
+    Adding an item that is already in the queue is a no-op.
+    """
+
+    def __init__(self, aging):
+        """Constructor.
+
+        Args:
+            aging: priority points an item gains per second spent waiting.
+        """
+        self.aging = aging
+        self._heap = []     # (rank, seq, item) entries, stale ones included
+        self._index = {}    # item as key, seq of its live entry as value
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def __iter__(self):
+        """Iterate over the items in the queue, in no particular order."""
+        for rank, seq, item in self._heap:
+            if self._index.get(item) == seq:
+                yield item
+
+    def append(self, item, priority=0):
+        """Add an item with the given priority."""
+        if item in self._index:
+            return
+        self._seq += 1
+        self._index[item] = self._seq
+        rank = self.aging * time.time() - priority
+        heapq.heappush(self._heap, (rank, self._seq, item))
+
+    appendleft = append
+
+    def pop(self):
+        """Remove and return the item with the highest (aged) priority."""
+        while self._heap:
+            rank, seq, item = heapq.heappop(self._heap)
+            if self._index.get(item) == seq:
+                del self._index[item]
+                return item
+        raise IndexError("pop from an empty queue")
+
+    def remove(self, item):
+        """Remove an item from the queue. Raises ValueError if not present."""
+        try:
+            del self._index[item]
+        except KeyError:
+            raise ValueError("item not in queue: " + str(item))
+        # Don't let stale entries use more memory than the live ones
+        if len(self._heap) > 2 * len(self._index) + 64:
+            self._heap = [e for e in self._heap
+                          if self._index.get(e[2]) == e[1]]
+            heapq.heapify(self._heap)
+
+
+class RateMeter(object):
+    """Counts events in a sliding time window, one bucket per second."""
+
+    def __init__(self, window=60):
+        """Constructor.
+
+        Args:
+            window: length of the sliding window, in seconds.
+        """
+        self.window = window
+        self.buckets = deque()  # [second, count] pairs, oldest first
+        self.count = 0          # events in the window
+        self.total = 0          # events ever seen
+
+    def _expire(self, now):
+        oldest = int(now) - self.window
+        while self.buckets and self.buckets[0][0] <= oldest:
+            self.count -= self.buckets.popleft()[1]
+
+    def mark(self, now, n=1):
+        """Record n events at time now."""
+        second = int(now)
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += n
+        else:
+            self.buckets.append([second, n])
+        self.count += n
+        self.total += n
+        self._expire(now)
+
+    def countSince(self, now):
+        """Return the number of events in the window ending at now."""
+        self._expire(now)
+        return self.count
+
+    def rate(self, now):
+        """Return the average number of events per second in the window."""
+        return self.countSince(now) / float(self.window)
+
+    def peak(self, now):
+        """Return the highest number of events seen in a second of the window.
+        """
+        self._expire(now)
+        return max([count for second, count in self.buckets] or [0])
+
+
+class PeerStats(object):
+    """How fast and how reliable a peer is, as exponential moving averages.
+
+    Instance Variables
+    ------------------
+
+      - self.duration: how long (in seconds) the peer takes to do a job.
+
+      - self.speed: job cost units (see Scheduler.registerAction()) done per
+        second.
+
+      - self.bytes_per_second: bytes of results sent per second, if known.
+
+      - self.reliability: share of the jobs handed to the peer that it did.
+
+    Averages are None until the first job is done.
+
+    Class Atributes
+    ---------------
+
+    ALPHA: weight of the newest sample in the moving averages.
+    """
+
+    ALPHA = 0.2
+
+    def __init__(self):
+        self.duration = None
+        self.speed = None
+        self.bytes_per_second = None
+        self.reliability = 1.0
+        self.n_done = 0
+        self.n_failed = 0
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.ALPHA * (sample - average)
+
+    def jobDone(self, duration, cost=1, size=None):
+        """Account for a job done in duration seconds.
+
+        Args:
+            duration: time (in seconds) taken by the job.
+
+            cost: the job cost.
+
+            size: size (in bytes) of the job results, if known.
+        """
+        duration = max(duration, 0.001)
+        self.n_done += 1
+        self.duration = self._average(self.duration, duration)
+        self.speed = self._average(self.speed, cost / duration)
+        if size is not None:
+            self.bytes_per_second = self._average(self.bytes_per_second,
+                                                  size / duration)
+        self.reliability = self._average(self.reliability, 1.0)
+
+    def jobFailed(self):
+        """Account for a job the peer didn't do."""
+        self.n_failed += 1
+        self.reliability = self._average(self.reliability, 0.0)
+
+    def score(self):
+        """Return how much work we expect from the peer per second, or None
+        if we don't know it yet."""
+        if self.speed is None:
+            return None
+        return self.speed * self.reliability
+
+
+class WakeupSlots(object):
+    """Books the seconds peers are told to wake up at.
+
+    Every second is a slot that holds at most 'capacity' wake-ups. A peer
+    asking for a wake-up time within a range gets a random second of this
+    range or, if it is full, the next second with room left, so pings are
+    spread over time instead of arriving in waves. Every peer holds at most
+    one booking: booking again releases its previous slot.
+    """
+
+    def __init__(self, capacity=None):
+        """Constructor.
+
+        Args:
+            capacity: max number of wake-ups per second. None means no limit.
+        """
+        self.capacity = capacity
+        self.slots = {}         # second as key, # of wake-ups as value
+        self.booked = {}        # peer_id as key, booked second as value
+        # (second, peer_id) pairs for booked, soonest first. Entries that
+        # don't match booked are stale and are skipped.
+        self.heap = []
+
+    def _release(self, peer_id):
+        second = self.booked.pop(peer_id, None)
+        if second is not None:
+            self.slots[second] -= 1
+            if not self.slots[second]:
+                del self.slots[second]
+
+    def _expire(self, now):
+        # Bookings in the past are of no use anymore
+        now = int(now)
+        heap = self.heap
+        while heap and heap[0][0] < now:
+            second, peer_id = heapq.heappop(heap)
+            if self.booked.get(peer_id) == second:
+                self._release(peer_id)
+
+    def book(self, peer_id, now, earliest, latest):
+        """Book a wake-up time for a peer.
+
+        Args:
+            peer_id: The uniq identifier of the peer.
+
+            now: current time.
+
+            earliest, latest: range of seconds (absolute times) the peer
+                should wake up at.
+
+        Returns:
+            The booked second (an absolute time). It may be after latest if
+            the whole range is full.
+        """
+        self._release(peer_id)
+        self._expire(now)
+        earliest = int(earliest)
+        latest = max(earliest, int(latest))
+        second = random.randint(earliest, latest)
+        if self.capacity is not None:
+            start = second
+            while self.slots.get(second, 0) >= self.capacity:
+                second += 1
+                if second > latest and start > earliest:
+                    # Wrap around before trying seconds after the range
+                    second, latest, start = earliest, start - 1, earliest
+        self.slots[second] = self.slots.get(second, 0) + 1
+        self.booked[peer_id] = second
+        heapq.heappush(self.heap, (second, peer_id))
+        return second
+
+    def histogram(self, now, width):
+        """Return a sorted list of (offset, # of wake-ups) pairs, one per
+        'width' seconds from now on, for the non-empty ones."""
+        now = int(now)
+        buckets = {}
+        for second, count in self.slots.iteritems():
+            if second >= now:
+                offset = (second - now) // width * width
+                buckets[offset] = buckets.get(offset, 0) + count
+        return sorted(buckets.items())
+
+
+class HostQueue(object):
+    """How polite we are to a target host.
+
+    Instance Variables
+    ------------------
+
+      - self.actions: names of the actions whose jobs target this host.
+
+      - self.min_delay: minimum ammount of time (in seconds) between two jobs
+        for this host being dispatched.
+
+      - self.max_active: max number of jobs for this host that can be active
+        (i.e., assigned to peers) at once. None means no limit.
+    """
+
+    def __init__(self, host, min_delay=0, max_active=None):
+        self.host = host
+        self.actions = []
+        self.min_delay = min_delay
+        self.max_active = max_active
+        self.last_dispatch = 0
+        self.n_active = 0
+
+    def isReady(self, now):
+        """Can a job for this host be dispatched right now?"""
+        if now - self.last_dispatch < self.min_delay:
+            return False
+        return self.max_active is None or self.n_active < self.max_active
+
+
+class ActionQueue(object):
+    """Pending jobs of a given action.
+
+    Instance Variables
+    ------------------
+
+      - self.queue: an IndexedQueue (or an AgingPriorityQueue) with the
+        pending jobs of this action.
+
+      - self.host: the HostQueue of the host targeted by this action.
+
+      - self.weight: share of the dispatched jobs given to this action,
+        relative to the other actions. 0 pauses the action.
+
+      - self.meter: a RateMeter of the jobs of this action handed to peers.
+    """
+
+    def __init__(self, action, host, queue, weight=1.0):
+        self.action = action
+        self.host = host
+        self.queue = queue
+        self.weight = weight
+        self.deficit = 0.0
+        self.meter = RateMeter()
+
+    def isReady(self, now):
+        """Can a job of this action be dispatched right now?"""
+        return bool(self.queue) and self.weight > 0 and self.host.isReady(now)
+
+
+class PoliteWorkQueue(object):
+    """Pending jobs, split in per-action sub-queues bound to target hosts.
+
+    Every action has its own queue (an ActionQueue) and every action targets
+    a host (a HostQueue). Jobs are popped from the actions whose hosts are
+    ready, i.e., hosts we didn't contact too recently and that don't have too
+    many active jobs. A crawl that mixes sites is thus not throttled to the
+    slowest site's pace.
+
+    Actions take turns using weighted deficit round-robin: at every turn an
+    action earns its weight in credits and each job popped costs one credit.
+    Actions with weight 2 get twice the jobs of actions with weight 1 -- no
+    matter how many pending jobs each one has.
+
+    The list-like interface (append, appendleft, pop, remove, len, in) is the
+    same of IndexedQueue, so this can be used as a drop-in replacement.
+    """
+
+    def __init__(self, action_of, default_host, aging=None):
+        """Constructor.
+
+        Args:
+            action_of: a function that returns the action of a given job.
+
+            default_host: host key of actions not bound to any host.
+
+            aging: if not None, jobs are kept in AgingPriorityQueues, with
+                this aging rate, instead of in IndexedQueues.
+        """
+        self.action_of = action_of
+        self.default_host = default_host
+        self.aging = aging
+        self.hosts = {}         # host key as key, HostQueue as value
+        self.actions = {}       # action as key, ActionQueue as value
+        self.ring = deque()     # actions, in round-robin order
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, work):
+        action_queue = self.actions.get(self.action_of(work))
+        return action_queue is not None and work in action_queue.queue
+
+    def __iter__(self):
+        for action in self.ring:
+            for work in self.actions[action].queue:
+                yield work
+
+    def getHost(self, host):
+        """Return the HostQueue for a host key, creating it if needed."""
+        host_queue = self.hosts.get(host)
+        if host_queue is None:
+            host_queue = self.hosts[host] = HostQueue(host)
+        return host_queue
+
+    def getAction(self, action, host=None):
+        """Return the ActionQueue for an action, creating it if needed.
+
+        Newly created actions are bound to host (or to the default host).
+        """
+        action_queue = self.actions.get(action)
+        if action_queue is None:
+            if host is None:
+                host = self.default_host
+            if self.aging is None:
+                queue = IndexedQueue()
+            else:
+                queue = AgingPriorityQueue(self.aging)
+            host_queue = self.getHost(host)
+            host_queue.actions.append(action)
+            action_queue = ActionQueue(action, host_queue, queue)
+            self.actions[action] = action_queue
+            self.ring.append(action)
+        return action_queue
+
+    def bindAction(self, action, host):
+        """Bind an action to a host, even if the action already exists."""
+        action_queue = self.getAction(action, host)
+        if action_queue.host.host != host:
+            action_queue.host.actions.remove(action)
+            action_queue.host = self.getHost(host)
+            action_queue.host.actions.append(action)
+        return action_queue
+
+    def setHostPolicy(self, host, min_delay=0, max_active=None):
+        """Set the politeness settings for a given host.
+
+        See HostQueue for the meaning of min_delay and max_active.
+        """
+        host_queue = self.getHost(host)
+        host_queue.min_delay = min_delay
+        host_queue.max_active = max_active
+
+    def _add(self, work, left, priority):
+        queue = self.getAction(self.action_of(work)).queue
+        if work not in queue:
+            self._len += 1
+            if self.aging is not None:
+                queue.append(work, priority or 0)
+            elif left:
+                queue.appendleft(work)
+            else:
+                queue.append(work)
+
+    def append(self, work, priority=None):
+        """Add a job to the end of its action's queue.
+
+        The priority is only taken into account in priority mode.
+        """
+        self._add(work, False, priority)
+
+    def appendleft(self, work, priority=None):
+        """Add a job to the start of its action's queue.
+
+        The priority is only taken into account in priority mode.
+        """
+        self._add(work, True, priority)
+
+    def extend(self, works, priorities=None):
+        """Add several jobs to the end of their actions' queues, in order.
+
+        Same as calling append() for every job, only faster if jobs of the
+        same action come in a row.
+
+        Args:
+            works: an iterable of jobs.
+
+            priorities: a dict with the priorities of jobs, if any. Only
+                taken into account in priority mode.
+        """
+        if self.aging is not None:
+            if priorities is None:
+                priorities = {}
+            for work in works:
+                self._add(work, False, priorities.get(work))
+            return
+        for action, action_works in itertools.groupby(works, self.action_of):
+            queue = self.getAction(action).queue
+            before = len(queue)
+            queue.extend(action_works)
+            self._len += len(queue) - before
+
+    def remove(self, work):
+        """Remove a job. Raises ValueError if not present."""
+        self.getAction(self.action_of(work)).queue.remove(work)
+        self._len -= 1
+
+    def hasReady(self, now, actions=None):
+        """Is there a job that can be dispatched right now?
+
+        If actions is not None, only jobs of these actions are considered.
+        """
+        if actions is None:
+            action_queues = self.actions.itervalues()
+        else:
+            action_queues = [self.actions[action] for action in actions
+                             if action in self.actions]
+        for action_queue in action_queues:
+            if action_queue.isReady(now):
+                return True
+        return False
+
+    def pop(self, now=None, actions=None, choose=None):
+        """Remove and return a job from the action whose turn it is.
+
+        If actions is not None, only these actions take turns. Raises
+        IndexError if no action is ready.
+
+        By default, the job at the end of the action's queue is returned. If
+        choose is not None, it is called with the action's ActionQueue and
+        may return another job of this queue instead (or None).
+        """
+        if now is None:
+            now = time.time()
+        ring = self.ring
+        # Actions with weight < 1 may need a few turns to earn a credit
+        weights = [a.weight for a in self.actions.itervalues() if a.isReady(now)
+                   and (actions is None or a.action in actions)]
+        if not weights:
+            raise IndexError("no action is ready")
+        for i in xrange(len(ring) * (int(1.0 / min(weights)) + 2)):
+            action_queue = self.actions[ring[0]]
+            if not action_queue.queue:
+                # Idle actions don't save credits for later
+                action_queue.deficit = 0.0
+            elif action_queue.isReady(now) and \
+                    (actions is None or action_queue.action in actions):
+                if action_queue.deficit < 1.0:
+                    action_queue.deficit += action_queue.weight
+                if action_queue.deficit >= 1.0:
+                    action_queue.deficit -= 1.0
+                    if action_queue.deficit < 1.0:
+                        ring.rotate(-1)    # its turn is over
+                    action_queue.host.last_dispatch = now
+                    self._len -= 1
+                    if choose is not None:
+                        work = choose(action_queue)
+                        if work is not None:
+                            action_queue.queue.remove(work)
+                            return work
+                    return action_queue.queue.pop()
+            ring.rotate(-1)
+        raise IndexError("no action is ready")
+
+    def leaseStarted(self, work, now):
+        """Account for a job being assigned to a peer."""
+        action_queue = self.getAction(self.action_of(work))
+        action_queue.host.n_active += 1
+        action_queue.meter.mark(now)
+
+    def leaseEnded(self, work):
+        """Account for a job being done or recycled."""
+        host_queue = self.getAction(self.action_of(work)).host
+        host_queue.n_active = max(0, host_queue.n_active - 1)
+
+
+class RoutedQueue(object):
+    """A queue of jobs split in one IndexedQueue per action.
+
+    Jobs can be popped for peers able to run only some actions without
+    looking at the jobs of the other actions. Besides that, the list-like
+    interface is the same of IndexedQueue.
+    """
+
+    def __init__(self, action_of):
+        """Constructor.
+
+        Args:
+            action_of: a function that returns the action of a given job.
+        """
+        self.action_of = action_of
+        self.queues = {}        # action as key, IndexedQueue as value
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, work):
+        queue = self.queues.get(self.action_of(work))
+        return queue is not None and work in queue
+
+    def __iter__(self):
+        for queue in self.queues.itervalues():
+            for work in queue:
+                yield work
+
+    def _getQueue(self, work):
+        action = self.action_of(work)
+        queue = self.queues.get(action)
+        if queue is None:
+            queue = self.queues[action] = IndexedQueue()
+        return queue
+
+    def append(self, work):
+        """Add a job to the end of its action's queue."""
+        queue = self._getQueue(work)
+        if work not in queue:
+            queue.append(work)
+            self._len += 1
+
+    def extend(self, works):
+        """Add several jobs to the end of their actions' queues, in order."""
+        for work in works:
+            self.append(work)
+
+    def remove(self, work):
+        """Remove a job. Raises ValueError if not present."""
+        self._getQueue(work).remove(work)
+        self._len -= 1
+
+    def count(self, action):
+        """Return the number of jobs of an action."""
+        return len(self.queues.get(action, ()))
+
+    def hasAny(self, actions=None):
+        """Is there a job of one of the given actions (or of any action, if
+        actions is None)?"""
+        if actions is None:
+            return self._len > 0
+        for action in actions:
+            if self.queues.get(action):
+                return True
+        return False
+
+    def pop(self, actions=None):
+        """Remove and return a job of one of the given actions (or of any
+        action, if actions is None). Raises IndexError if there is none."""
+        if actions is None:
+            actions = self.queues.keys()
+        for action in actions:
+            queue = self.queues.get(action)
+            if queue:
+                self._len -= 1
+                return queue.pop()
+        raise IndexError("pop from an empty queue")
+
+
+class TokenBucket(object):
+    """A token bucket, used to limit how many jobs are dispatched per second.
+
+    Tokens are added to the bucket at a fixed rate, up to its capacity. Every
+    dispatched job takes a token out of the bucket; no token, no job.
+    """
+
+    def __init__(self, rate, capacity):
+        """Constructor.
+
+        Args:
+            rate: tokens (jobs) added to the bucket per second. May be less
+                than 1.
+
+            capacity: max number of tokens the bucket can hold, i.e., how many
+                jobs can be dispatched back-to-back after an idle period.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_update = time.time()
+
+    def refill(self, now):
+        """Add the tokens earned since the last refill."""
+        elapsed = max(0.0, now - self.last_update)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.last_update = now
+
+    def consume(self, now):
+        """Take a token from the bucket. Return False if there was none."""
+        self.refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def setRate(self, rate):
+        """Change the rate tokens are added to the bucket (tokens/second)."""
+        self.refill(time.time())
+        self.rate = rate
+
+
+class AIMDRateController(object):
+    """Adjusts a scheduler's dispatch rate based on failure signals.
+
+    Completed jobs count as successes. Lease timeouts, backtraces reported by
+    clients and similar signs of the crawled site pushing back count as
+    failures (see Scheduler.reportFailure()). At every adjustment (every
+    scheduler beat), if more than FAILURE_RATIO of the signals seen since the
+    last adjustment were failures, the rate is multiplied by DECREASE_FACTOR.
+    Otherwise, if some job was completed, the rate is increased by a fixed
+    step. The rate is always kept between min_rate and max_rate, so we crawl
+    at the highest rate the site tolerates.
+
+    Every adjustment is logged and the last HISTORY_SIZE adjustments are kept
+    in self.history as (timestamp, old rate, new rate, reason) tuples.
+    """
+
+    DECREASE_FACTOR = 0.5
+    FAILURE_RATIO = 0.1
+    HISTORY_SIZE = 50
+
+    def __init__(self, min_rate, max_rate, increase=None):
+        """Constructor.
+
+        Args:
+            min_rate: min dispatch rate (jobs/second).
+
+            max_rate: max dispatch rate (jobs/second).
+
+            increase: how much the rate is increased (jobs/second) after
+                an adjustment period without failures. Defaults to 1% of the
+                [min_rate, max_rate] range.
+        """
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        if increase is None:
+            increase = (max_rate - min_rate) / 100.0
+        self.increase = increase
+        self.successes = 0
+        self.failures = {}      # reason as key, # of signals as value
+        self.history = deque()
+
+    def success(self):
+        """Account for a job that was completed."""
+        self.successes += 1
+
+    def failure(self, reason):
+        """Account for a failure signal, e.g., 'timeout' or 'backtrace'."""
+        self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    def adjust(self, rate, now):
+        """Return the new dispatch rate, given the signals seen so far.
+
+        Signals are reset after every adjustment.
+        """
+        n_failures = sum(self.failures.values())
+        n_signals = self.successes + n_failures
+        if n_failures and n_failures > self.FAILURE_RATIO * n_signals:
+            new_rate = rate * self.DECREASE_FACTOR
+            reason = ", ".join(["%i %s" % (n, r)
+                                for r, n in sorted(self.failures.items())])
+        elif self.successes:
+            new_rate = rate + self.increase
+            reason = "%i jobs done" % self.successes
+        else:
+            new_rate = rate
+        new_rate = max(self.min_rate, min(self.max_rate, new_rate))
+        self.successes = 0
+        self.failures = {}
+        if new_rate != rate:
+            log.msg("Dispatch rate adjusted from %0.4f to %0.4f jobs/second "
+                    "(%s)" % (rate, new_rate, reason))
+            self.history.append((now, rate, new_rate, reason))
+            if len(self.history) > self.HISTORY_SIZE:
+                self.history.popleft()
+        return new_rate
+
+
+class RevisitPlanner(object):
+    """Decides when items crawled before are worth crawling again.
+
+    Items (say, articles) keep changing after they are crawled. Every time an
+    item is crawled, its content is measured (say, by its number of comments)
+    and the rate it grows at is estimated from successive crawls, as an
+    exponential moving average. The expected gain of crawling an item again
+    is the new content we expect it to have by now, per unit of crawl cost.
+
+    Items are kept in a heap by the time their expected gain reaches
+    min_gain, not sooner than min_interval and not later than max_interval
+    after their last crawl. Items whose first crawl just happened have no
+    rate yet and are due after min_interval. Among the items that are due,
+    pop() returns the ones with the highest expected gain first, so a fixed
+    crawl budget is spent where most new content is.
+
+    Items that stopped growing (i.e., their expected gain in max_interval is
+    below min_gain) are forgotten.
+
+    Class Atributes
+    ---------------
+
+    ALPHA: weight of the newest sample in the moving average of growth rates.
+
+    POP_LOOKAHEAD: pop(n) compares the expected gain of up to POP_LOOKAHEAD
+        times n due items.
+    """
+
+    ALPHA = 0.5
+    POP_LOOKAHEAD = 4
+
+    def __init__(self, min_interval, max_interval, min_gain=1.0):
+        """Constructor.
+
+        Args:
+            min_interval: min ammount of time (in seconds) between two crawls
+                of an item.
+
+            max_interval: max ammount of time (in seconds) between two crawls
+                of an item that is still growing.
+
+            min_gain: expected new content, per unit of crawl cost, that
+                makes an item worth crawling again.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_gain = min_gain
+        # key as key, [last crawl, measure, rate, cost, due] as value. Rates
+        # are None until the second crawl.
+        self.items = {}
+        # (due, key) pairs, soonest first. Entries whose due time doesn't
+        # match the one in self.items are stale and are skipped.
+        self.heap = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def observe(self, key, now, measure, cost=1):
+        """Account for a crawl of an item.
+
+        Args:
+            key: the item identifier.
+
+            now: when the item was crawled.
+
+            measure: (number) how much content the item had.
+
+            cost: how costly crawling the item again will be.
+
+        Returns:
+            False if the item was forgotten because it stopped growing.
+        """
+        rate = None
+        item = self.items.get(key)
+        if item is not None:
+            last_crawl, last_measure, rate = item[:3]
+            elapsed = now - last_crawl
+            if elapsed > 0:
+                sample = max(0.0, float(measure - last_measure)) / elapsed
+                if rate is None:
+                    rate = sample
+                else:
+                    rate += self.ALPHA * (sample - rate)
+        if rate is not None and \
+                rate * self.max_interval < self.min_gain * cost:
+            self.forget(key)
+            return False
+        self.restore(key, now, measure, rate, cost)
+        return True
+
+    def restore(self, key, last_crawl, measure, rate, cost):
+        """Set the state of an item (see getState()) and schedule it."""
+        if rate is None:
+            delay = self.min_interval
+        elif rate <= 0:
+            delay = self.max_interval
+        else:
+            delay = self.min_gain * cost / rate
+            delay = max(self.min_interval, min(self.max_interval, delay))
+        due = last_crawl + delay
+        self.items[key] = [last_crawl, measure, rate, cost, due]
+        heapq.heappush(self.heap, (due, key))
+        # Don't let stale entries pile up
+        if len(self.heap) > 2 * len(self.items) + 64:
+            self.heap = [(item[4], k) for k, item in self.items.iteritems()
+                         if item[4] is not None]    # None: not planned
+            heapq.heapify(self.heap)
+
+    def postpone(self, key, now):
+        """Plan a crawl of an item min_interval seconds from now, say,
+        because the crawl pop() asked for couldn't be done."""
+        item = self.items.get(key)
+        if item is None:
+            return
+        item[4] = now + self.min_interval
+        heapq.heappush(self.heap, (item[4], key))
+
+    def getState(self, key):
+        """Return the (last crawl, measure, rate, cost) state of an item."""
+        return tuple(self.items[key][:4])
+
+    def forget(self, key):
+        """Stop planning crawls of an item."""
+        self.items.pop(key, None)
+
+    def expectedMeasure(self, key, now):
+        """Return how much content we expect an item to have by now.
+
+        Growth is not extrapolated past max_interval.
+        """
+        last_crawl, measure, rate = self.items[key][:3]
+        if rate is None:
+            return measure
+        elapsed = max(0.0, min(now - last_crawl, self.max_interval))
+        return measure + rate * elapsed
+
+    def expectedGain(self, key, now):
+        """Return the new content we expect to get, per unit of cost, by
+        crawling an item now."""
+        measure, rate, cost = self.items[key][1:4]
+        if rate is None:
+            return float(self.min_gain)     # we don't know any better
+        return (self.expectedMeasure(key, now) - measure) / cost
+
+    def pop(self, now, n):
+        """Return up to n due items, the ones with the highest expected gain
+        first, and stop planning their crawls until they are observed again.
+
+        Returns:
+            A list of (key, expected measure) pairs.
+        """
+        heap = self.heap
+        due = []
+        seen = set()
+        while heap and heap[0][0] <= now and \
+                len(due) < self.POP_LOOKAHEAD * n:
+            timestamp, key = heapq.heappop(heap)
+            item = self.items.get(key)
+            if item is None or timestamp is None or item[4] != timestamp or \
+                    key in seen:
+                continue    # stale entry
+            seen.add(key)
+            due.append((self.expectedGain(key, now), timestamp, key))
+        due.sort(key=lambda entry: entry[0], reverse=True)
+        for gain, timestamp, key in due[n:]:
+            heapq.heappush(heap, (timestamp, key))
+        result = []
+        for gain, timestamp, key in due[:n]:
+            result.append((key, self.expectedMeasure(key, now)))
+            # Not planned again until the crawl we asked for happens
+            self.items[key][4] = None
+        return result
+
+
 class Scheduler:
     """A "work" scheduler.
 
-    This scheduler works by, at periodic "beats", moving one registered job from
-    its "work" queue to its "ready" queue. Jobs in the "ready" queue can be
-    claimed by outside entities, what will cause them being moved to the
-    "active" queue.  Jobs that are in the "active" queue for too long will be
-    reclaimed after a timeout and moved back to the end of the "work" queue.
+    This scheduler works by, at periodic "beats", moving one registered job from
+    its "work" queue to its "ready" queue. Jobs in the "ready" queue can be
+    claimed by outside entities, what will cause them being moved to the
+    "active" queue.  Jobs that are in the "active" queue for too long will be
+    reclaimed after a timeout and moved back to the end of the "work" queue.
+
+    If none claims a job in the "ready" queue for more than two consecutive
+    beats, it will be left at the queue. No more jobs of an action will be
+    moved to the "ready" queue if more then MAX_READY_WORKS of them are
+    already there, so jobs no peer claims don't hold the other actions up.
+
+    About the dispatch rate
+    -----------------------
+
+    Moving one job per beat ties throughput to the beat interval. Optionally,
+    a dispatch rate (in jobs/second) can be set. In this mode beats don't move
+    jobs to the "ready" queue anymore: a job is handed to a peer as soon as it
+    pings us and a token is available in the scheduler's TokenBucket. Jobs
+    still in the "ready" queue when this mode is turned on are handed first.
+
+    The dispatch rate can also be adjusted automatically, within bounds, by
+    an AIMDRateController (see setAdaptiveRate()).
+
+    About actions and hosts
+    -----------------------
+
+    Pending jobs are kept in a PoliteWorkQueue, one sub-queue per action.
+    Every action is bound to a host key with registerAction() and each host
+    can have its own minimum delay between jobs and its own cap on active
+    jobs (see setHostPolicy()). Actions never registered go to DEFAULT_HOST,
+    which has no politeness settings. Jobs are taken from actions whose hosts
+    are ready using weighted deficit round-robin, so an action with a huge
+    backlog doesn't starve the others. Weights can be changed at any time
+    with setActionWeight().
+
+    About priorities
+    ----------------
+
+    By default, jobs of a host are handed in the order described above. In
+    priority mode, jobs are given a priority when enqueued and the ones with
+    the highest priority are handed first. Jobs gain PRIORITY_AGING priority
+    points per second spent waiting, so old low-priority jobs still make
+    progress. Recycled jobs keep their original priority.
+
+    About jobs
+    ----------
 
-    If none claims a job in the "ready" queue for more than two consecutive
-    beats, it will be left at the queue. No more jobs will be moved to the
-    "ready" queue if more then MAX_READY_WORKS are already there.
+    Jobs are handed to the scheduler as (action, params) pairs of strings,
+    but internally every job is just a short string id (see JobTable), so
+    millions of pending jobs can be kept in memory. Ids are only translated
+    back to (action, params) pairs when commands are rendered.
 
     About Peers and Clients
     -----------------------
 
     A "client" or peer is an abstraction for any entity that can claim jobs.
-    This class only keeps information about known alive "peers" and it doesn't
-    assign jobs to "peers": as long as there is work available in the "ready"
-    queue, any peer will do.
+    This class keeps information about known alive "peers" and about how well
+    they do their jobs, but peers are not bound to jobs in advance: a job is
+    picked for a peer when it asks for work. Peers that tell which actions
+    they are able to run are only handed jobs of these actions (see
+    "About PINGS and commands"), and jobs of actions that tell how costly
+    their jobs are are picked according to the peer's speed (see "About peer
+    performance"). Otherwise, any peer will do.
 
     About PINGS and commands
     ------------------------
@@ -83,14 +1289,153 @@ class Scheduler:
     informed by the scheduler is SLEEP, with a parameter informing the ammount
     of seconds the peers should wait before contacting the scheduler again.
 
+    Peers are not all told to come back at the very same time, though: the
+    SLEEP time is picked at random within SLEEP_JITTER of the expected cycle
+    length and every second gets at most MAX_WAKEUPS_PER_SECOND wake-ups, so
+    peers that pinged together (say, after a server restart) drift apart
+    instead of arriving in waves.
+
+    Several peers may share the same IP address (e.g., behind a NAT) and
+    sites ban by IP address. The jobs handed to the peers of every address
+    are counted in a sliding window of ADDRESS_WINDOW seconds and, if
+    ADDRESS_BUDGET is set, peers whose address used up its budget are told
+    to SLEEP.
+
+    Peers may tell which actions they are able to run. Such peers are only
+    handed jobs of these actions. Ready jobs are kept in one queue per action
+    (see RoutedQueue) for that matter.
+
+    Peers able to handle several jobs in a row may ask for a batch of up to
+    MAX_BATCH_SIZE jobs in a single PING. In this case, the result will be one
+    command per line, each one for a different job with its own lease. All
+    these leases start at once, so peers handling batch jobs one after the
+    other should renew the lease of each job before starting it.
+
+    Peers working on a long job should renew its lease from time to time (see
+    renderRenew()), otherwise the job will be recycled after
+    MIN_LIVENESS_INTERVALS beats and handed to someone else. The result of a
+    renewal is either "RENEWED <parameters> #", or "EXPIRED <parameters> #" if
+    the job is not active anymore or its lease is held by another peer (only
+    the lease owner may renew it, not former owners or backup holders).
+
+    The scheduler knows which peer holds every active job. Jobs held by a
+    peer declared dead are recycled right away, without waiting for their
+    leases to expire. If RECYCLE_ON_IDLE_PING is set, the same happens to
+    jobs still held by a peer that pings asking for work, since a peer only
+    asks for work when it is idle. This is off by default: processes sharing
+    a peer id (e.g., several clients started from the same store directory)
+    would recycle each other's jobs.
+
+    A recycled job may be done by someone else while its former holder is
+    still working on it; the same goes for backup copies in speculative
+    mode. Such peers are told to drop the job: renewing its lease returns
+    "ABORT <parameters> #" and, if the peer pings just to inform the
+    completion of another job, one "ABORT <parameters> #" line per job it
+    should drop follows the SLEEP command. Older peers don't understand
+    these lines, so they are only sent to peers that say they do (see
+    renderPing()'s send_aborts).
+
+    About deadlines
+    ---------------
+
+    Some jobs are only worth doing for a while (say, a listing that must be
+    crawled while it is on a site's front page). Such jobs may be enqueued
+    with a deadline. Pending (queued, ready or delayed) jobs whose deadline
+    passed are never dispatched: they are handed to the expiry handler of
+    their action (see registerAction()), usually its controller's
+    markJobAsExpired, and forgotten. Deadlines are kept in a heap, so this
+    costs O(log n) per job. Jobs already being processed when their deadline
+    passes are left alone, unless they are recycled.
+
+    About peer performance
+    ----------------------
+
+    Peers are not all alike: some are fast, some are slow and some lose the
+    jobs they are handed. The scheduler keeps moving averages of how long
+    every peer takes to do its jobs, how many bytes per second it delivers
+    and which share of its jobs it does (see PeerStats), and keeps peers
+    sorted by speed as their scores change. Actions may tell how costly
+    (big) their jobs are (see registerAction()). For such actions, when a
+    job is handed to a peer, the last SIZE_AWARE_WINDOW pending jobs (and the
+    job promoted to the ready queue, if any) are sorted by cost and the
+    fastest peers get the biggest ones, while slow, flaky or unknown peers
+    get the smaller ones. Stragglers thus don't hold the biggest jobs up.
+    Without a dispatch rate, a promoted job that isn't picked goes back to
+    the pending queue, still next in line, and the picked job takes its
+    place. This is a FIFO mode feature: in priority mode jobs are still
+    handed by priority.
+
+    About retries
+    -------------
+
+    The scheduler counts how many times every job was handed to a peer.
+    Recycled jobs are not enqueued right away: they wait RETRY_BASE_DELAY
+    seconds, doubled at every new attempt (up to RETRY_MAX_DELAY), in a
+    "delayed" heap. After MAX_ATTEMPTS attempts a job is deemed poisoned and is
+    handed to the dead-letter handler of its action (see registerAction()),
+    usually its controller's markJobAsErroneus.
+
+    About speculative execution
+    ---------------------------
+
+    Near the end of a crawl there is no pending work, while a handful of slow
+    jobs hold everything up. In speculative mode, idle peers asking for work
+    when there is no pending job are handed backup copies of the oldest
+    active jobs (at most MAX_BACKUPS copies per job, for jobs active for more
+    than SPECULATION_MIN_AGE beats). The first completion wins: the job is
+    marked as done and the other copies are forgotten. If the owner of a job
+    dies, one of its backup holders becomes the new owner. Jobs marked as done
+    more than once (late duplicates) are just acknowledged.
+
+    About long polling
+    ------------------
+
+    Instead of being told to SLEEP, idle peers may be parked (see parkPeer())
+    until there is work for them. Parked peers are handed jobs, in the order
+    they were parked, as soon as jobs can be dispatched: at every beat and,
+    if a dispatch rate is set, when jobs are enqueued or done (freeing a host
+    slot). Parked peers are indexed by the actions they are able to run, so
+    only the peers able to run the available jobs are looked at.
+    The scheduler knows nothing about HTTP: it is up to the caller to answer
+    the peer when the job arrives, or to unpark it when it gets tired of
+    waiting.
+
+    About paging
+    ------------
+
+    Keeping every pending job in memory doesn't scale to huge backlogs. An
+    action can have a "feeder" instead (see setFeeder()): a function that
+    reads pending jobs from stable storage. Only a window of the action's
+    pending jobs is then kept in the scheduler. Once it drops below half its
+    size, it is refilled from the feeder at the next beat. Feeders enqueue
+    the jobs they read themselves and should skip jobs the scheduler already
+    knows about (see isKnown()).
+
+    About snapshots
+    ---------------
+
+    Rebuilding the scheduler from the controllers' stores at start-up is slow
+    for big crawls and loses every active lease. Instead, the scheduler state
+    (pending, delayed and active jobs, lease owners, retry counts, peers and
+    the action and host settings) can be saved from time to time with
+    saveSnapshot(). Transitions since the last snapshot (jobs enqueued,
+    assigned and done) are appended to a journal (see openJournal()). At
+    start-up, loadSnapshot() restores the snapshot and replays the journal;
+    controllers of restored actions (see isRestored()) shouldn't enqueue
+    their jobs again. Downtime doesn't count against peers and leases.
+
+    Taking a snapshot pauses the scheduler while its state is pickled, for a
+    time that grows with the number of known jobs. Writing it to disk can
+    be done in a thread, though (see saveSnapshot()).
+
     Class Atributes
     ---------------
 
     SLEEP_DELAY: Nodes will be asked to sleep for SLEEP_DELAY more seconds
         then needed, to avoid colision with the timer interval
 
-    MAX_READY_WORKS: Max number of peding/enqued jobs that can be delivered
-        to client processing at once. It's a balance between not
+    MAX_READY_WORKS: Max number of peding/enqued jobs of an action that can
+        be delivered to client processing at once. It's a balance between not
         wasting intervals where no job was assigned and not DDos'ins
 
     MIN_LIVENESS_INTERVALS: Number of intervals to wait before we assume
@@ -106,6 +1451,56 @@ class Scheduler:
         number of clients falls too low or if cycles length get too short, we
         may experience fluctuation in the number of nodes alive. This number
         solves this.
+
+    DISPATCH_BURST: When a dispatch rate is set, max number of jobs that can
+        be handed to peers back-to-back after an idle period.
+
+    MAX_BATCH_SIZE: Max number of jobs handed to a peer in a single PING.
+
+    ADDRESS_BUDGET: Max number of jobs handed to the peers sharing an IP
+        address in ADDRESS_WINDOW seconds. None means no limit.
+
+    ADDRESS_WINDOW: Length (in seconds) of the sliding window in which jobs
+        handed to every IP address are counted.
+
+    SLEEP_JITTER: Peers are told to sleep for the expected cycle length plus
+        or minus this fraction of it.
+
+    MAX_WAKEUPS_PER_SECOND: Max number of peers told to wake up at the same
+        second. None means no limit.
+
+    RECYCLE_ON_IDLE_PING: Should the jobs held by a peer be recycled when it
+        pings asking for work? Only set it if every process has a peer id of
+        its own.
+
+    DEFAULT_HOST: Host key of jobs whose action wasn't bound to a host.
+
+    MAX_BACKUPS: In speculative mode, max number of backup copies of a job
+        handed to other peers.
+
+    SPECULATION_MIN_AGE: In speculative mode, number of beats a job must be
+        active before backup copies of it are handed.
+
+    RECENTLY_DONE_SIZE: Number of recently done jobs we remember, in order to
+        acknowledge late duplicates.
+
+    MAX_ATTEMPTS: Number of times a job is handed to peers before we give up
+        on it.
+
+    RETRY_BASE_DELAY: Ammount of time (in seconds) a job recycled for the
+        first time waits before being enqueued again. Doubled at every retry.
+
+    RETRY_MAX_DELAY: Max ammount of time (in seconds) a recycled job waits
+        before being enqueued again.
+
+    PRIORITY_AGING: In priority mode, priority points a job gains for every
+        second it waits to be dispatched.
+
+    SIZE_AWARE_WINDOW: Number of pending jobs, from the end of the queue, of
+        an action with job costs considered when picking a job for a peer.
+
+    SNAPSHOT_VERSION: Version of the snapshot format. Snapshots of other
+        versions are ignored.
     """
 
     SLEEP_DELAY = 10
@@ -113,8 +1508,26 @@ class Scheduler:
     MIN_LIVENESS_INTERVALS = 10
     MIN_NODE_LIVENESS_CYCLES = 2
     MIN_NODE_LIVENESS_CYCLE_LENGTH = 240
+    DISPATCH_BURST = 4
+    MAX_BATCH_SIZE = 20
+    ADDRESS_BUDGET = None
+    ADDRESS_WINDOW = 60
+    SLEEP_JITTER = 0.25
+    MAX_WAKEUPS_PER_SECOND = 2
+    RECYCLE_ON_IDLE_PING = False
+    DEFAULT_HOST = "*"
+    MAX_BACKUPS = 1
+    SPECULATION_MIN_AGE = 2
+    RECENTLY_DONE_SIZE = 10000
+    MAX_ATTEMPTS = 5
+    RETRY_BASE_DELAY = 60
+    RETRY_MAX_DELAY = 3600
+    PRIORITY_AGING = 1.0 / 3600
+    SIZE_AWARE_WINDOW = 16
+    SNAPSHOT_VERSION = 2
 
-    def __init__(self, interval=120, timer=None):
+    def __init__(self, interval=120, timer=None, dispatch_rate=None,
+                 use_priorities=False, speculative=False):
         """Scheduler constructror.
 
         Args:
@@ -128,21 +1541,100 @@ class Scheduler:
                 No arguments should be passed to the timerCallback. You can
                 leave this parameter as None and just set i up after
                 construction - there is support for this.
+
+            dispatch_rate: jobs/second handed to peers. If None, one job is
+                made available per beat. See setDispatchRate().
+
+            use_priorities: if True, pending jobs are handed by priority
+                instead of in the order they were enqueued.
+
+            speculative: if True, idle peers are handed backup copies of slow
+                jobs when there is no pending work.
         """
         # Setup timer
         if timer is not None:
             self.timer = timer
         self.interval = interval
         self.next_interval = time.time()    # next beat should be... now!
-        # Records the last ping of every "fresh" peer
-        self.peers = {}
+        # Records the last ping of every "fresh" peer. Peers are kept in the
+        # order they were last seen, the stalest one first.
+        self.peers = OrderedDict()
+        # Works are ids from self.jobs (a JobTable) from now on
+        self.jobs = JobTable()
+        self.ping_meter = RateMeter()   # pings received
+        self.peer_address = {}  # peer_id as key, IP address as value
+        # IP address as key, RateMeter of jobs handed as value. Addresses
+        # are kept in the order they were last handed a job, oldest first.
+        self.address_meters = OrderedDict()
+        self.wakeups = WakeupSlots(self.MAX_WAKEUPS_PER_SECOND)
         # Setup queues
-        self.ready_queue = []  # works ready to be processed
-        self.work_queue = []   # works waiting to be processing
+        self.ready_queue = RoutedQueue(self._actionOf)
+                                           # works ready to be processed
+        if use_priorities:
+            aging = self.PRIORITY_AGING
+        else:
+            aging = None
+        self.work_queue = PoliteWorkQueue(self._actionOf, self.DEFAULT_HOST,
+                                          aging)
+                                           # works waiting to be processing
+        self.priorities = {}    # work as key, priority as value. In priority
+                                # mode, for works not of the default priority
         self.active_queue = {} # works that assigned/being processed
                                # work as key, ts as value
+        # (ts, work) pairs for active_queue, oldest first. Entries whose ts
+        # doesn't match the one in active_queue are stale and are skipped.
+        self.lease_heap = []
+        self.lease_owner = {}   # work as key, peer_id as value
+        self.peer_leases = {}   # peer_id as key, set of works as value
+        self.lease_start = {}   # work as key, when it was assigned as value
+        # Peer performance
+        self.peer_stats = {}    # peer_id as key, PeerStats as value
+        self.peer_scores = []   # sorted (score, peer_id) of scored peers
+        self.job_costs = {}     # action as key, cost function as value
+        # Retries
+        self.attempts = {}      # work as key, # of times it was assigned
+        self.delayed = {}       # work as key, when it can be enqueued again
+        self.delayed_heap = []  # (ts, work) pairs for delayed, soonest first
+        self.dead_letter_handlers = {}  # action as key, function as value
+        self.dead_letters = {}  # action as key, # of jobs given up as value
+        # Deadlines
+        self.deadlines = {}     # work as key, deadline as value
+        self.deadline_heap = [] # (deadline, work) pairs, soonest first.
+                                # Entries not matching self.deadlines are
+                                # stale and are skipped.
+        self.expiry_handlers = {}   # action as key, function as value
+        self.expired = {}       # action as key, # of jobs expired as value
+        # Paging
+        self.feeders = {}       # action as key, (feeder, window) as value
+        # Speculative execution
+        self.speculative = speculative
+        self.backups = {}       # work as key, set of backup peer_ids as value
+        self.peer_backups = {}  # peer_id as key, set of backup works as value
+        self.recently_done = IndexedQueue()
+        # Aborts
+        self.former_owners = {} # work as key, set of peer_ids whose lease
+                                # of it was recycled as value
+        self.aborts = {}        # peer_id as key, set of works done by others
+                                # it should drop as value
+        # Long polling. Peers are kept in the order they were parked.
+        self.parked = OrderedDict() # peer_id as key, (callback, batch_size,
+                                    # actions) as value
+        self.parked_by_action = {}  # action (None for peers able to run any
+                                    # action) as key, OrderedDict with
+                                    # peer_id as key, parking # as value
+        self.n_parkings = 0
+        # Snapshots
+        self.journal = None     # an open file, if journaling is on
+        self.journal_file = None
+        self.saving = None      # a Deferred, while a snapshot is written
+        self.restored_actions = set()   # actions restored from a snapshot
+        # Setup dispatch rate
+        self.dispatcher = None  # a TokenBucket, if a dispatch rate is set
+        self.setDispatchRate(dispatch_rate)
+        self.rate_controller = None     # an AIMDRateController, if enabled
 
-    def renderPing(self, peer_id, just_ping=False):
+    def renderPing(self, peer_id, just_ping=False, batch_size=1,
+                   actions=None, address=None, send_aborts=False):
         """Inform a peer what it should do, returning a command.
         
         Args:
@@ -152,42 +1644,610 @@ class Scheduler:
                 in the ready queue? Just might be the case if the peers just
                 pinged to inform/submit the completion of an assigned job.
 
+            batch_size: max number of jobs the peer is willing to receive.
+                Capped at MAX_BATCH_SIZE.
+
+            actions: a set with the actions the peer is able to run. None
+                means any action.
+
+            address: the peer's IP address, if known.
+
+            send_aborts: does the peer understand ABORT lines? If not, the
+                jobs it should drop are forgotten instead.
+
         Returns:
-            A command, as informed in this class's documentation.
+            A command (or one command per line, for batches), as informed in
+            this class's documentation.
         """
         # Refresh peer liveness timestamp
         now = time.time()
-        self.peers[peer_id] = now
+        self._touchPeer(peer_id, now, address)
+        self.ping_meter.mark(now)
+        self._releaseDelayed(now)
+        self._expireWorks(now)
         n_peers = len(self.peers) - 1
         next_turn = (self.next_interval - now) + (n_peers * self.interval)
         next_turn = int(math.ceil(next_turn))
         # In some odd cases next_turn can be negative. 
         next_turn = max(0, next_turn)
         # "Render" the command
-        if len(self.ready_queue) > 0 and not just_ping:
+        commands = []
+        if not just_ping:
+            # It is idle, so it isn't working on anything it should drop
+            self.aborts.pop(peer_id, None)
+            if self.RECYCLE_ON_IDLE_PING and (peer_id in self.peer_leases or
+                                              peer_id in self.peer_backups):
+                # It is asking for work, so it gave up on what it had
+                self._recyclePeerLeases(peer_id)
+            batch_size = max(1, min(batch_size, self.MAX_BATCH_SIZE))
+            while len(commands) < batch_size and \
+                    self._withinBudget(peer_id, now) and \
+                    self._canDispatch(now, actions):
+                commands.append(self._assignWork(peer_id, now, actions))
+            if not commands and self.speculative and not self.ready_queue \
+                    and not self.work_queue and \
+                    self._withinBudget(peer_id, now):
+                command = self._assignBackup(peer_id, now, actions)
+                if command is not None:
+                    commands.append(command)
+        if commands:
             # Got work to do
-            return self._assignWork(peer_id)
-        else:
-            # The End
-            return "SLEEP %i #" % (next_turn + self.SLEEP_DELAY)
+            return "\n".join(commands)
+        # The End
+        commands.append("SLEEP %i #" % self._pickSleep(peer_id, now,
+                                            next_turn + self.SLEEP_DELAY))
+        aborts = self.aborts.pop(peer_id, ())
+        if send_aborts:
+            for work in aborts:
+                commands.append("ABORT %s #" % self.jobs.get(work)[1])
+        return "\n".join(commands)
+
+    def _pickSleep(self, peer_id, now, sleep):
+        """Return how long a peer should sleep, spreading wake-ups over time.
+
+        Args:
+            peer_id: The uniq identifier of the peer.
+
+            now: current time.
+
+            sleep: the expected ammount of time (in seconds) to sleep.
+        """
+        spread = int(sleep * self.SLEEP_JITTER)
+        now = int(now)
+        wakeup = self.wakeups.book(peer_id, now, now + sleep - spread,
+                                   now + sleep + spread)
+        return wakeup - now
+
+
+    def parkPeer(self, peer_id, callback, batch_size=1, actions=None):
+        """Keep an idle peer waiting until there is work for it.
+
+        Should be called after renderPing() told the peer to SLEEP. A peer
+        that is parked again replaces its previous parking.
+
+        Args:
+            peer_id: The uniq identifier of the peer.
+
+            callback: a function, called with the peer's command(s) once jobs
+                are assigned to it.
+
+            batch_size: max number of jobs the peer is willing to receive.
+                Capped at MAX_BATCH_SIZE.
+
+            actions: a set with the actions the peer is able to run. None
+                means any action.
+        """
+        batch_size = max(1, min(batch_size, self.MAX_BATCH_SIZE))
+        self._unpark(peer_id)
+        self.parked[peer_id] = (callback, batch_size, actions)
+        self.n_parkings += 1
+        if actions is None:
+            actions = [None]
+        for action in actions:
+            peers = self.parked_by_action.get(action)
+            if peers is None:
+                peers = self.parked_by_action[action] = OrderedDict()
+            peers[peer_id] = self.n_parkings
+        self._wakeParked(time.time())
+
+    def unparkPeer(self, peer_id, callback):
+        """Stop keeping a peer waiting, e.g., if its request timed out.
+
+        Args:
+            peer_id: The uniq identifier of the peer.
+
+            callback: the callback it was parked with. If the peer was parked
+                again since then, nothing is done.
+        """
+        parking = self.parked.get(peer_id)
+        if parking is not None and parking[0] is callback:
+            self._unpark(peer_id)
+
+    def _unpark(self, peer_id):
+        """Forget a parked peer, if it is parked."""
+        parking = self.parked.pop(peer_id, None)
+        if parking is None:
+            return
+        actions = parking[2]
+        if actions is None:
+            actions = [None]
+        for action in actions:
+            peers = self.parked_by_action[action]
+            del peers[peer_id]
+            if not peers:
+                del self.parked_by_action[action]
+
+    def _oldestParked(self, action, skipped):
+        """Return the peer_id of the peer parked for the longest time that
+        is able to run action and isn't in skipped, or None."""
+        oldest = None
+        for peers in (self.parked_by_action.get(action),
+                      self.parked_by_action.get(None)):
+            if not peers:
+                continue
+            for peer_id, n_parking in peers.iteritems():
+                if peer_id not in skipped:
+                    if oldest is None or n_parking < oldest[0]:
+                        oldest = (n_parking, peer_id)
+                    break
+        if oldest is None:
+            return None
+        return oldest[1]
+
+    def _wakeParked(self, now):
+        """Hand available jobs to parked peers, the oldest first.
+
+        Only peers able to run the actions that have jobs available are
+        looked at.
+        """
+        self._expireWorks(now)
+        if not self.parked or not self._hasWork(now):
+            return
+        for action in self.jobs.getActions():
+            skipped = set()     # peers over their address budget
+            while self._hasWork(now, [action]):
+                peer_id = self._oldestParked(action, skipped)
+                if peer_id is None:
+                    break
+                callback, batch_size, actions = self.parked[peer_id]
+                if not self._withinBudget(peer_id, now):
+                    skipped.add(peer_id)
+                    continue
+                if not self._canDispatch(now, actions):
+                    return  # out of tokens
+                self._unpark(peer_id)
+                self._touchPeer(peer_id, now)
+                commands = [self._assignWork(peer_id, now, actions)]
+                while len(commands) < batch_size and \
+                        self._withinBudget(peer_id, now) and \
+                        self._canDispatch(now, actions):
+                    commands.append(self._assignWork(peer_id, now, actions))
+                callback("\n".join(commands))
+
+    def renderRenew(self, peer_id, action, params):
+        """Renew the lease of an active job, returning a command.
+
+        Renewing a lease pushes back the moment the job is deemed stuck and
+        recycled. It also counts as a ping concerning peer liveness.
+
+        Args:
+            peer_id: The uniq identifier of the peer.
+
+            action: the action of the job whose lease should be renewed.
+
+            params: the parameters of said job.
+
+        Returns:
+            A command, as informed in this class's documentation.
+        """
+        now = time.time()
+        self._touchPeer(peer_id, now)
+        work = self.jobs.find(action, params)
+        if work in self.aborts.get(peer_id, ()):
+            self._discardAbort(peer_id, work)
+            return "ABORT %s #" % params
+        if work is None or work not in self.active_queue:
+            if work is not None and work in self.recently_done:
+                return "ABORT %s #" % params    # done by someone else
+            return "EXPIRED %s #" % params
+        if self.lease_owner.get(work) != peer_id:
+            return "EXPIRED %s #" % params      # someone else's lease
+        self.active_queue[work] = now
+        heapq.heappush(self.lease_heap, (now, work))
+        return "RENEWED %s #" % params
+
+    def _touchPeer(self, peer_id, now, address=None):
+        """Refresh the liveness timestamp (and the address) of a peer."""
+        self.peers.pop(peer_id, None)   # move it to the end
+        self.peers[peer_id] = now
+        if address is not None:
+            self.peer_address[peer_id] = address
+
+    def _discardAbort(self, peer_id, work):
+        """Stop telling a peer to drop a job."""
+        aborts = self.aborts.get(peer_id)
+        if aborts is not None:
+            aborts.discard(work)
+            if not aborts:
+                del self.aborts[peer_id]
+
+    def _withinBudget(self, peer_id, now):
+        """Can the address of a peer be handed one more job?"""
+        if self.ADDRESS_BUDGET is None:
+            return True
+        meter = self.address_meters.get(self.peer_address.get(peer_id))
+        return meter is None or meter.countSince(now) < self.ADDRESS_BUDGET
+
+    def _chargeAddress(self, peer_id, now):
+        """Account for a job handed to a peer in its address' window."""
+        address = self.peer_address.get(peer_id)
+        if address is not None:
+            # Move it to the end
+            meter = self.address_meters.pop(address, None)
+            if meter is None:
+                meter = RateMeter(self.ADDRESS_WINDOW)
+            self.address_meters[address] = meter
+            meter.mark(now)
+
+    def _hasWork(self, now, actions=None):
+        """Is there a job that a peer able to run actions (any action, if
+        None) could be handed, dispatch rate permitting?"""
+        if self.ready_queue.hasAny(actions):
+            return True
+        return self.dispatcher is not None and \
+                self.work_queue.hasReady(now, actions)
 
+    def _canDispatch(self, now, actions=None):
+        """Is there a job that can be handed to a peer able to run actions
+        (any action, if None) right now?"""
+        if not self._hasWork(now, actions):
+            return False
+        return self.dispatcher is None or self.dispatcher.consume(now)
 
-    def _assignWork(self, peer_id):
+    def _assignWork(self, peer_id, now=None, actions=None):
         """Assign an avaiable job to a peer.
 
         Args:
             peer_id: The peer's uniq identifier.
 
+            now: current time, as seen by the caller.
+
+            actions: the actions the peer is able to run, None for any.
+
         Returns:
             A command to be returned to the peer.
         """
         log.msg( "Assigning work to peer-id " + peer_id )
-        work = self.ready_queue.pop()
-        self.active_queue[work] = time.time()
-        action, params = work
+        if now is None:
+            now = time.time()
+        if self.ready_queue.hasAny(actions):
+            work = self.ready_queue.pop(actions)
+            if self.job_costs:
+                work = self._swapBySize(peer_id, work)
+        elif self.job_costs:
+            work = self.work_queue.pop(now, actions,
+                    lambda action_queue: self._pickBySize(peer_id,
+                                                          action_queue))
+        else:
+            work = self.work_queue.pop(now, actions)
+        self._startLease(work, peer_id, now)
+        self.work_queue.leaseStarted(work, now)
+        self._chargeAddress(peer_id, now)
+        action, params = self.jobs.get(work)
+        if self.journal is not None:
+            self._journal(now, 'L', action, params, peer_id)
+        return "%s %s #" % (action, params)
+
+    def _startLease(self, work, peer_id, now):
+        """Record that a work was assigned to a peer at time now."""
+        self.active_queue[work] = now
+        heapq.heappush(self.lease_heap, (now, work))
+        self.lease_owner[work] = peer_id
+        self.peer_leases.setdefault(peer_id, set()).add(work)
+        self.lease_start[work] = now
+        self.attempts[work] = self.attempts.get(work, 0) + 1
+
+    def _jobCost(self, work):
+        """Return the cost of a work, as told by its action's cost function.
+
+        Works of actions without a cost function (or whose cost is unknown)
+        cost 1.
+        """
+        action, params = self.jobs.get(work)
+        job_cost = self.job_costs.get(action)
+        if job_cost is None:
+            return 1
+        cost = job_cost(params)
+        if cost is None:
+            return 1
+        return cost
+
+    def _pickBySize(self, peer_id, action_queue, promoted=None):
+        """Pick a pending work of an action that suits a peer's speed.
+
+        The last SIZE_AWARE_WINDOW works of the action's queue are sorted by
+        cost and the peer gets the one matching its rank: the fastest peer
+        gets the costliest work, the slowest gets the cheapest one.
+
+        Args:
+            promoted: a work of this action popped from the ready queue, to
+                be considered as the next work.
+
+        Returns:
+            A work in action_queue, or None if the next work will do.
+        """
+        if action_queue.action not in self.job_costs or \
+                not hasattr(action_queue.queue, 'tail'):
+            return None     # no costs or priority mode
+        candidates = action_queue.queue.tail(self.SIZE_AWARE_WINDOW)
+        if promoted is not None:
+            candidates.insert(0, promoted)
+        if len(candidates) < 2:
+            return None
+        # The original order breaks ties, so equal works are handed FIFO
+        sized = sorted([(self._jobCost(work), i, work)
+                        for i, work in enumerate(candidates)])
+        if sized[0][0] == sized[-1][0]:
+            return None
+        rank = self._peerRank(peer_id)
+        work = sized[int(round(rank * (len(sized) - 1)))][2]
+        if work == promoted:
+            return None
+        return work
+
+    def _swapBySize(self, peer_id, work):
+        """Return the work a peer should get instead of a work popped from
+        the ready queue, according to the peer's speed.
+
+        Works are promoted to the ready queue before we know who will get
+        them. If a pending work of the same action suits the peer better,
+        they trade places: the promoted work goes back to the end of the
+        pending queue, so it is still next in line.
+        """
+        action_queue = self.work_queue.actions.get(self._actionOf(work))
+        if action_queue is None:
+            return work
+        chosen = self._pickBySize(peer_id, action_queue, work)
+        if chosen is None:
+            return work
+        self.work_queue.remove(chosen)
+        self.work_queue.append(work)
+        return chosen
+
+    def getPeerStats(self, peer_id):
+        """Return the PeerStats of a peer, creating it if needed."""
+        stats = self.peer_stats.get(peer_id)
+        if stats is None:
+            stats = self.peer_stats[peer_id] = PeerStats()
+        return stats
+
+    def _peerRank(self, peer_id):
+        """Return the rank of a peer by score, 0.0 being the slowest and 1.0
+        the fastest. Unknown peers rank in the middle."""
+        stats = self.peer_stats.get(peer_id)
+        if stats is None or stats.score() is None or \
+                len(self.peer_scores) < 2:
+            return 0.5
+        i = bisect.bisect_left(self.peer_scores, (stats.score(), peer_id))
+        return i / float(len(self.peer_scores) - 1)
+
+    def _rescorePeer(self, peer_id, old_score, new_score):
+        """Move a peer whose score changed in peer_scores."""
+        if old_score is not None:
+            i = bisect.bisect_left(self.peer_scores, (old_score, peer_id))
+            del self.peer_scores[i]
+        if new_score is not None:
+            bisect.insort(self.peer_scores, (new_score, peer_id))
+
+    def _peerDone(self, peer_id, duration, cost, size=None):
+        """Account for a job done by a peer (see PeerStats.jobDone())."""
+        stats = self.getPeerStats(peer_id)
+        old_score = stats.score()
+        stats.jobDone(duration, cost, size)
+        self._rescorePeer(peer_id, old_score, stats.score())
+
+    def _peerFailed(self, peer_id):
+        """Account for a job a peer didn't do."""
+        stats = self.getPeerStats(peer_id)
+        old_score = stats.score()
+        stats.jobFailed()
+        self._rescorePeer(peer_id, old_score, stats.score())
+
+    def _assignBackup(self, peer_id, now, actions=None):
+        """Assign a backup copy of an old active job to a peer.
+
+        Only jobs of the given actions are considered, unless actions is
+        None. Backup copies follow the host policies (see setHostPolicy()),
+        like any other dispatched job.
+
+        Returns:
+            A command to be returned to the peer or None, if there is no job
+            in need of a backup copy.
+        """
+        min_age = now - self.SPECULATION_MIN_AGE * self.interval
+        lease_heap = self.lease_heap
+        popped = []
+        work = None
+        # Look at the oldest leases only
+        while lease_heap and len(popped) < 32:
+            timestamp, candidate = lease_heap[0]
+            if timestamp >= min_age:
+                break
+            heapq.heappop(lease_heap)
+            if self.active_queue.get(candidate) != timestamp:
+                continue    # stale entry, drop it
+            popped.append((timestamp, candidate))
+            backups = self.backups.get(candidate, ())
+            action = self._actionOf(candidate)
+            if (actions is None or action in actions) and \
+                    self.lease_owner.get(candidate) != peer_id and \
+                    peer_id not in backups and \
+                    len(backups) < self.MAX_BACKUPS and \
+                    self.work_queue.getAction(action).host.isReady(now):
+                work = candidate
+                break
+        for entry in popped:
+            heapq.heappush(lease_heap, entry)
+        if work is None:
+            return None
+        if self.dispatcher is not None and not self.dispatcher.consume(now):
+            return None
+        log.msg("Assigning backup work to peer-id " + peer_id)
+        host_queue = self.work_queue.getAction(self._actionOf(work)).host
+        host_queue.last_dispatch = now
+        self.work_queue.leaseStarted(work, now)
+        self._chargeAddress(peer_id, now)
+        self.backups.setdefault(work, set()).add(peer_id)
+        self.peer_backups.setdefault(peer_id, set()).add(work)
+        action, params = self.jobs.get(work)
         return "%s %s #" % (action, params)
 
-    def appendWork(self, action, params):
+    def _dropBackup(self, work, peer_id):
+        """Forget about a backup copy of a work held by a peer."""
+        self.work_queue.leaseEnded(work)
+        backups = self.backups[work]
+        backups.discard(peer_id)
+        if not backups:
+            del self.backups[work]
+        peer_backups = self.peer_backups[peer_id]
+        peer_backups.discard(work)
+        if not peer_backups:
+            del self.peer_backups[peer_id]
+
+    def _endLease(self, work):
+        """Forget about an active work's lease and its owner."""
+        del self.active_queue[work]
+        self.lease_start.pop(work, None)
+        owner = self.lease_owner.pop(work, None)
+        if owner is not None:
+            leases = self.peer_leases[owner]
+            leases.discard(work)
+            if not leases:
+                del self.peer_leases[owner]
+        self.work_queue.leaseEnded(work)
+
+    def _recycleWork(self, work):
+        """Take an active work back and enqueue it again, after a while.
+
+        If someone holds a backup copy of this work, it becomes the work's
+        new owner instead. Works that were tried too many times are handed
+        to their action's dead-letter handler.
+
+        The failure counts against the work's owner (see PeerStats).
+        """
+        owner = self.lease_owner.get(work)
+        if owner is not None:
+            self._peerFailed(owner)
+            # It may still be working on it
+            self.former_owners.setdefault(work, set()).add(owner)
+        if work in self.backups:
+            new_owner = iter(self.backups[work]).next()
+            self._dropBackup(work, new_owner)
+            self._transferLease(work, new_owner)
+            return
+        attempts = self.attempts.get(work, 0)
+        if attempts >= self.MAX_ATTEMPTS:
+            self._deadLetter(work)
+            return
+        self._endLease(work)
+        delay = min(self.RETRY_BASE_DELAY * 2 ** max(0, attempts - 1),
+                    self.RETRY_MAX_DELAY)
+        ready_at = time.time() + delay
+        self.delayed[work] = ready_at
+        heapq.heappush(self.delayed_heap, (ready_at, work))
+        if work in self.deadlines:
+            # Its deadline may have passed while it was active
+            heapq.heappush(self.deadline_heap, (self.deadlines[work], work))
+
+    def _releaseDelayed(self, now):
+        """Enqueue again recycled works whose delay is over."""
+        delayed_heap = self.delayed_heap
+        while delayed_heap and delayed_heap[0][0] <= now:
+            ready_at, work = heapq.heappop(delayed_heap)
+            if self.delayed.get(work) == ready_at:
+                del self.delayed[work]
+                # We use work_queue as a FIFO "stack": we pop() from its END
+                # and we add "new" items to its START
+                self.work_queue.appendleft(work, self.priorities.get(work))
+
+    def _setDeadline(self, work, deadline):
+        """Set the time after which a work is not worth doing anymore."""
+        self.deadlines[work] = deadline
+        heapq.heappush(self.deadline_heap, (deadline, work))
+
+    def _expireWorks(self, now):
+        """Drop pending works whose deadline passed."""
+        deadline_heap = self.deadline_heap
+        while deadline_heap and deadline_heap[0][0] <= now:
+            deadline, work = heapq.heappop(deadline_heap)
+            if self.deadlines.get(work) != deadline or \
+                    work in self.active_queue:
+                continue    # stale entry or too late to stop it
+            self._expireWork(work)
+
+    def _expireWork(self, work):
+        """Give up on a pending work, handing it to its expiry handler."""
+        action, params = self.jobs.get(work)
+        log.msg("Work %s %s expired" % (action, params))
+        self.expired[action] = self.expired.get(action, 0) + 1
+        handler = self.expiry_handlers.get(action)
+        if handler is not None:
+            try:
+                # Handlers are expected to call markWorkDone()
+                handler(params)
+            except Exception, e:
+                log.err("Expiry handler failed for %s %s: %s" %
+                        (action, params, str(e)))
+        if self._isKnown(work):
+            self.markWorkDone(action, params)
+
+    def _deadLetter(self, work):
+        """Give up on an active work, handing it to its dead-letter handler."""
+        action, params = self.jobs.get(work)
+        log.msg("Giving up on work %s %s after %i attempts" %
+                (action, params, self.attempts.get(work, 0)))
+        self.dead_letters[action] = self.dead_letters.get(action, 0) + 1
+        # It wasn't done, so it must not count as a success (or be credited
+        # to its owner) when marked as done. Until then, it is held as a
+        # delayed work that is never released.
+        self._endLease(work)
+        self.delayed[work] = float('inf')
+        handler = self.dead_letter_handlers.get(action)
+        if handler is not None:
+            try:
+                # Handlers are expected to call markWorkDone()
+                handler(params)
+            except Exception, e:
+                log.err("Dead-letter handler failed for %s %s: %s" %
+                        (action, params, str(e)))
+        if work in self.delayed:
+            self.markWorkDone(action, params)
+
+    def _transferLease(self, work, peer_id):
+        """Make a peer the owner of an active work, renewing its lease."""
+        now = time.time()
+        old_owner = self.lease_owner[work]
+        leases = self.peer_leases[old_owner]
+        leases.discard(work)
+        if not leases:
+            del self.peer_leases[old_owner]
+        self.lease_owner[work] = peer_id
+        self.peer_leases.setdefault(peer_id, set()).add(work)
+        self.active_queue[work] = now
+        heapq.heappush(self.lease_heap, (now, work))
+
+    def _recyclePeerLeases(self, peer_id):
+        """Recycle every work held by a peer, dropping its backup copies."""
+        for work in list(self.peer_backups.get(peer_id, ())):
+            self._dropBackup(work, peer_id)
+        works = list(self.peer_leases.get(peer_id, ()))
+        if works:
+            log.msg("Recycling %i works held by peer-id %s" %
+                    (len(works), peer_id))
+        for work in works:
+            self._recycleWork(work)
+
+    def appendWork(self, action, params, priority=None, deadline=None):
         """Enqueue a work for future processing.
         
         Args:
@@ -196,8 +2256,136 @@ class Scheduler:
 
             params: params for the given action. Should be a string and
                 must not have any whitespace in it.
+
+            priority: (number) works with higher priorities are handed first.
+                Only taken into account in priority mode. Defaults to 0.
+
+            deadline: time (as returned by time.time()) after which the work
+                is not worth doing anymore. None means no deadline.
+        """
+        work = self.jobs.add(action, params)
+        if priority and self.work_queue.aging is not None:
+            self.priorities[work] = priority
+        self.work_queue.append(work, priority)
+        if deadline is not None:
+            self._setDeadline(work, deadline)
+        if self.journal is not None:
+            self._journal(time.time(), 'A', action, params, priority)
+            if deadline is not None:
+                self._journal(time.time(), 'T', action, params,
+                              repr(deadline))
+        # Without a dispatch rate, new jobs wait for the next beat anyway
+        if self.parked and self.dispatcher is not None:
+            self._wakeParked(time.time())
+
+    def _actionOf(self, work):
+        """Return the action of a given work."""
+        return self.jobs.actionOf(work)
+
+    def isKnown(self, action, params):
+        """Is a job queued, delayed or active?"""
+        work = self.jobs.find(action, params)
+        return work is not None and self._isKnown(work)
+
+    def setFeeder(self, action, feeder, window):
+        """Page the pending jobs of an action in from stable storage.
+
+        The action's queue is filled right away.
+
+        Args:
+            action: the action name, as used in appendWork().
+
+            feeder: a function, called with a number n, that enqueues
+                (see appendWork()) up to n pending jobs of this action
+                unknown to the scheduler.
+
+            window: max number of pending jobs of this action kept in
+                memory.
+        """
+        self.feeders[action] = (feeder, window)
+        self._refill(action)
+
+    def hasRoom(self, action):
+        """Should a new job of an action be enqueued right away?
+
+        Always True, unless the action is paged and its window is full. Jobs
+        that don't fit will be read by the feeder later.
         """
-        self.work_queue.append((action, params))
+        if action not in self.feeders:
+            return True
+        window = self.feeders[action][1]
+        return len(self.work_queue.getAction(action).queue) < window
+
+    def _refill(self, action):
+        """Fill the window of pending jobs of a paged action."""
+        feeder, window = self.feeders[action]
+        missing = window - len(self.work_queue.getAction(action).queue)
+        if missing > 0:
+            feeder(missing)
+
+    def registerAction(self, action, host=None, weight=None,
+                       dead_letter=None, job_cost=None, expiry=None):
+        """Bind an action to the host its jobs target.
+
+        Should be called before any job for this action is enqueued.
+
+        Args:
+            action: the action name, as used in appendWork().
+
+            host: the host key. If None, DEFAULT_HOST is used.
+
+            weight: share of the dispatched jobs given to this action. See
+                setActionWeight().
+
+            dead_letter: a function, called with a job's params, when we
+                give up on a job of this action after MAX_ATTEMPTS. It
+                should store the job somewhere safe and call markWorkDone().
+
+            job_cost: a function, called with a job's params, that returns
+                how costly (big) the job is, as a positive number, or None if
+                unknown. If set, the costliest jobs are handed to the
+                fastest peers.
+
+            expiry: a function, called with a job's params, when a pending
+                job of this action misses its deadline. It should store the
+                job somewhere safe and call markWorkDone().
+        """
+        if host is None:
+            host = self.DEFAULT_HOST
+        self.work_queue.bindAction(action, host)
+        if weight is not None:
+            self.setActionWeight(action, weight)
+        if dead_letter is not None:
+            self.dead_letter_handlers[action] = dead_letter
+        if job_cost is not None:
+            self.job_costs[action] = job_cost
+        if expiry is not None:
+            self.expiry_handlers[action] = expiry
+
+    def setActionWeight(self, action, weight):
+        """Set the share of dispatched jobs given to an action.
+
+        Args:
+            action: the action name, as used in appendWork().
+
+            weight: (number) actions get jobs dispatched in proportion to
+                their weights. The default weight is 1. 0 pauses the action.
+        """
+        self.work_queue.getAction(action).weight = max(0.0, float(weight))
+
+    def setHostPolicy(self, host, min_delay=0, max_active=None):
+        """Set how polite we should be to a given host.
+
+        Args:
+            host: the host key, as informed in registerAction().
+
+            min_delay: min ammount of time (in seconds) between two jobs
+                for this host being dispatched.
+
+            max_active: max number of jobs for this host that can be active
+                at once. None means no limit.
+        """
+        self.work_queue.setHostPolicy(host, min_delay, max_active)
 
     def timerCallback(self):
         """Update timers, schedule more jobs, rescue jobs that got stucked and
@@ -212,36 +2400,132 @@ class Scheduler:
         liveness_threshold = int(liveness_threshold)
         self.next_interval = now + self.interval
         # Deal with enqueued jobs
-        if self.work_queue and len(self.ready_queue) <= self.MAX_READY_WORKS:
-            self.ready_queue.append(self.work_queue.pop())
-        for work, timestamp in self.active_queue.items():
-            if timestamp < liveness_threshold:
-                # Recycle this work. We use work_queue as a FIFO "stack":
-                # we pop() from its END and we add "new" items to its START
-                del self.active_queue[work]
-                self.work_queue.insert(0, work)
+        self._releaseDelayed(now)
+        self._expireWorks(now)
+        for action, (feeder, window) in self.feeders.iteritems():
+            if len(self.work_queue.getAction(action).queue) <= window // 2:
+                self._refill(action)
+        if self.dispatcher is None:
+            open_actions = [action for action in self.work_queue.actions
+                            if self.ready_queue.count(action) <=
+                            self.MAX_READY_WORKS]
+            if self.work_queue.hasReady(now, open_actions):
+                self.ready_queue.append(self.work_queue.pop(now, open_actions))
+        # Only leases that actually expired are touched here
+        lease_heap = self.lease_heap
+        while lease_heap and lease_heap[0][0] < liveness_threshold:
+            timestamp, work = heapq.heappop(lease_heap)
+            if self.active_queue.get(work) == timestamp:
+                self.reportFailure('timeout')
+                self._recycleWork(work)
+        # Adjust the dispatch rate
+        if self.rate_controller is not None:
+            self.setDispatchRate(
+                    self.rate_controller.adjust(self.getDispatchRate(), now))
+        # Finished leases are left in the heap. Purge them if they pile up.
+        if len(lease_heap) > 2 * len(self.active_queue) + 64:
+            self.lease_heap = [(ts, work) for ts, work in lease_heap
+                               if self.active_queue.get(work) == ts]
+            heapq.heapify(self.lease_heap)
+        if len(self.deadline_heap) > 2 * len(self.deadlines) + 64:
+            self.deadline_heap = [(deadline, work) for work, deadline
+                                  in self.deadlines.iteritems()]
+            heapq.heapify(self.deadline_heap)
         # Remove dead nodes
         cycle_length = max(self.interval * len(self.peers),
                            self.MIN_NODE_LIVENESS_CYCLE_LENGTH) 
         node_liveness_threshold = now - int(self.MIN_NODE_LIVENESS_CYCLES * 
                                             cycle_length)
-        for peer, timestamp in self.peers.items():
-            if timestamp < node_liveness_threshold:
-                del self.peers[peer]
+        # Only the stale peers at the start of self.peers are touched
+        peers = self.peers
+        while peers:
+            peer, timestamp = next(peers.iteritems())
+            if timestamp >= node_liveness_threshold:
+                break
+            del peers[peer]
+            self.peer_address.pop(peer, None)
+            self._recyclePeerLeases(peer)
+            stats = self.peer_stats.pop(peer, None)
+            if stats is not None:
+                self._rescorePeer(peer, stats.score(), None)
+            self.aborts.pop(peer, None)
+        # Forget about addresses with no recent jobs. Only the stale ones
+        # at the start of self.address_meters are touched.
+        address_meters = self.address_meters
+        while address_meters:
+            address, meter = next(address_meters.iteritems())
+            if meter.countSince(now):
+                break
+            del address_meters[address]
+        # Jobs made available in this beat go to parked peers right away
+        if self.parked:
+            self._wakeParked(now)
+
+    def markWorkDone(self, action, params, peer_id=None, size=None):
+        """Mark a job as done, i.e., remove work from all known lists.
+
+        Args:
+            action: the job's action.
+
+            params: the job's params.
 
-    def markWorkDone(self, action, params):
-        """Mark a job as done, i.e., remove work from all known lists."""
-        work = (action, params)
+            peer_id: the peer that did the job. Defaults to the job's owner.
+
+            size: size (in bytes) of the job results, if known.
+        """
+        work = self.jobs.find(action, params)
+        if work is None:
+            msg = "Unknown work being marked as done: %s %s" % (action, params)
+            log.err(msg)
+            raise KeyError(msg)
+        self.priorities.pop(work, None)
+        self.attempts.pop(work, None)
+        self.deadlines.pop(work, None)
+        if peer_id is not None:
+            # No need to tell it to drop what it just finished
+            self._discardAbort(peer_id, work)
+        # Peers that may still be working on it
+        holders = self.former_owners.pop(work, set())
         if work in self.active_queue :
-            del self.active_queue[work]
+            if self.rate_controller is not None:
+                self.rate_controller.success()
+            holders.add(self.lease_owner.get(work))
+            holders.update(self.backups.get(work, ()))
+            if peer_id is None:
+                peer_id = self.lease_owner.get(work)
+            start = self.lease_start.get(work)
+            if peer_id is not None and start is not None:
+                self._peerDone(peer_id, time.time() - start,
+                               self._jobCost(work), size)
+            self._endLease(work)
+            for backup_id in list(self.backups.get(work, ())):
+                self._dropBackup(work, backup_id)
+            if self.parked and self.dispatcher is not None:
+                # A host slot was freed
+                self._wakeParked(time.time())
         elif work in self.work_queue:
             self.work_queue.remove(work)
         elif work in self.ready_queue:
             self.ready_queue.remove(work)
+        elif work in self.delayed:
+            del self.delayed[work]
+        elif work in self.recently_done:
+            log.msg("Late duplicate of work marked as done: %s %s" %
+                    (action, params))
+            return
         else:
-            msg = "Unknown work being marked as done: " +  str(work)
+            msg = "Unknown work being marked as done: %s %s" % (action, params)
             log.err(msg)
             raise KeyError(msg)
+        holders.discard(peer_id)
+        for holder in holders:
+            if holder in self.peers:
+                self.aborts.setdefault(holder, set()).add(work)
+        self.recently_done.append(work)
+        if len(self.recently_done) > self.RECENTLY_DONE_SIZE:
+            self.recently_done.popleft()
+        if self.journal is not None:
+            self._journal(time.time(), 'D', action, params)
 
     # Timer control methods
     def start(self):
@@ -270,5 +2554,365 @@ class Scheduler:
             self.timer.stop()
             self.timer.start(new_interval)
 
+    def setDispatchRate(self, rate):
+        """Set how many jobs per second can be handed to peers.
+
+        Args:
+            rate: jobs/second. May be less than 1. None or 0 turns the
+                dispatch rate off, falling back to one job per beat.
+        """
+        if not rate:
+            self.dispatcher = None
+        elif self.dispatcher is None:
+            self.dispatcher = TokenBucket(rate, self.DISPATCH_BURST)
+        else:
+            self.dispatcher.setRate(rate)
+
+    def getDispatchRate(self):
+        """Return the current dispatch rate (jobs/second) or None if unset."""
+        if self.dispatcher is None:
+            return None
+        return self.dispatcher.rate
+
+    def setAdaptiveRate(self, min_rate, max_rate):
+        """Let the dispatch rate be adjusted automatically within bounds.
+
+        If no dispatch rate was set, we start from one job per beat. See
+        AIMDRateController for details.
+
+        Args:
+            min_rate: min dispatch rate (jobs/second). If None, automatic
+                adjustment is turned off and the current rate is kept.
+
+            max_rate: max dispatch rate (jobs/second).
+        """
+        if min_rate is None:
+            self.rate_controller = None
+            return
+        self.rate_controller = AIMDRateController(min_rate, max_rate)
+        rate = self.getDispatchRate()
+        if rate is None:
+            rate = 1.0 / self.interval
+        self.setDispatchRate(max(min_rate, min(max_rate, rate)))
+
+    def reportFailure(self, reason):
+        """Report a sign that the crawled site is pushing back.
+
+        Lease timeouts are reported by the scheduler itself. Controllers and
+        other resources should report things like backtraces sent by clients
+        or "nothing to see here" error pages.
+
+        Args:
+            reason: (str) short description of the failure, e.g. 'backtrace'.
+        """
+        if self.rate_controller is not None:
+            self.rate_controller.failure(reason)
+
+    # Snapshot methods
+    def isRestored(self, action):
+        """Were the jobs of an action restored from a snapshot?"""
+        return action in self.restored_actions
+
+    def getSnapshot(self):
+        """Return the scheduler state, as a picklable dict.
+
+        Jobs are kept as JobTable ids, along with the action table. Backup
+        copies of active jobs and dispatch statistics are not kept.
+        """
+        work_queue = self.work_queue
+        return {'version': self.SNAPSHOT_VERSION,
+                'time': time.time(),
+                'job_actions': self.jobs.getActions(),
+                'hosts': [(host.host, host.min_delay, host.max_active)
+                          for host in work_queue.hosts.itervalues()],
+                'actions': [(action.action, action.host.host, action.weight)
+                            for action in work_queue.actions.itervalues()],
+                'ready': list(self.ready_queue),
+                'queued': list(work_queue),
+                'priorities': self.priorities,
+                'active': [(work, ts, self.lease_owner.get(work))
+                           for work, ts in self.active_queue.iteritems()],
+                'attempts': self.attempts,
+                'delayed': self.delayed,
+                'dead_letters': self.dead_letters,
+                'deadlines': self.deadlines,
+                'expired': self.expired,
+                'recently_done': list(self.recently_done),
+                'peers': self.peers.items()}
+
+    def saveSnapshot(self, filename, threaded=False):
+        """Save the scheduler state to a file and start a new journal.
+
+        The snapshot is written to a temporary file first, so a crash while
+        saving it doesn't destroy the previous one.
+
+        The state is always pickled right away, as it must not change
+        meanwhile. If threaded is True, the pickled state is written (and
+        synced) to disk in a thread, so the reactor isn't held up by the
+        disk. Until it is safely written, the journal of the previous
+        snapshot is kept aside as a ".old" journal (see loadSnapshot()).
+        Saves asked for while a snapshot is being written are skipped.
+
+        Returns:
+            If threaded, a Deferred fired once the snapshot is written.
+        """
+        if self.saving is not None:
+            log.msg("Scheduler snapshot still being written, skipping")
+            return self.saving
+        start = time.time()
+        data = cPickle.dumps(self.getSnapshot(), cPickle.HIGHEST_PROTOCOL)
+        if not threaded:
+            self._writeSnapshot(filename, data)
+            if self.journal is not None:
+                self.openJournal(self.journal_file, append=False)
+            log.msg("Scheduler snapshot saved in %0.2f seconds" %
+                    (time.time() - start))
+            return None
+        old_journal = None
+        if self.journal is not None:
+            old_journal = self._rotateJournal()
+        log.msg("Scheduler snapshot taken in %0.2f seconds" %
+                (time.time() - start))
+        d = self.saving = threads.deferToThread(self._writeSnapshot,
+                                                filename, data, old_journal)
+        d.addCallbacks(self._snapshotSaved, self._snapshotFailed,
+                       callbackArgs=(start,))
+        return d
+
+    def _writeSnapshot(self, filename, data, old_journal=None):
+        """Write a pickled snapshot to a file, then remove the journal it
+        makes useless, if any. May run in a thread."""
+        tmp_filename = filename + '.tmp'
+        output = open(tmp_filename, 'wb')
+        output.write(data)
+        output.flush()
+        os.fsync(output.fileno())
+        output.close()
+        os.rename(tmp_filename, filename)
+        if old_journal is not None and os.path.exists(old_journal):
+            os.remove(old_journal)
+
+    def _snapshotSaved(self, _result, start):
+        self.saving = None
+        log.msg("Scheduler snapshot saved in %0.2f seconds" %
+                (time.time() - start))
+
+    def _snapshotFailed(self, failure):
+        # The previous snapshot and the ".old" journal are still there
+        self.saving = None
+        log.err("Could not save scheduler snapshot: %s" %
+                failure.getErrorMessage())
+
+    def _rotateJournal(self):
+        """Move the journal aside, appending it to the ".old" journal if a
+        previous snapshot couldn't be written, and start a new one.
+
+        Returns:
+            The name of the ".old" journal.
+        """
+        old_journal = self.journal_file + '.old'
+        self.journal.close()
+        self.journal = None
+        if os.path.exists(old_journal):
+            output = open(old_journal, 'ab')
+            shutil.copyfileobj(open(self.journal_file, 'rb'), output)
+            output.close()
+            os.remove(self.journal_file)
+        else:
+            os.rename(self.journal_file, old_journal)
+        self.openJournal(self.journal_file)
+        return old_journal
+
+    def restoreSnapshot(self, state):
+        """Restore the scheduler state returned by getSnapshot().
+
+        Should be called on a brand new scheduler, before any job is
+        enqueued. Snapshots of older versions are ignored.
+
+        Returns:
+            True if the state was restored.
+        """
+        if state.get('version') != self.SNAPSHOT_VERSION:
+            log.msg("Ignoring snapshot of unknown version %s" %
+                    state.get('version'))
+            return False
+        self.jobs = JobTable(state['job_actions'])
+        work_queue = self.work_queue
+        for host, min_delay, max_active in state['hosts']:
+            work_queue.setHostPolicy(host, min_delay, max_active)
+        for action, host, weight in state['actions']:
+            work_queue.bindAction(action, host).weight = weight
+            self.restored_actions.add(action)
+        self.priorities = state['priorities']
+        self.ready_queue.extend(state['ready'])
+        work_queue.extend(state['queued'], self.priorities)
+        for work, ts, owner in state['active']:
+            self._startLease(work, owner, ts)
+            work_queue.getAction(self._actionOf(work)).host.n_active += 1
+        self.attempts = state['attempts']
+        for work, ready_at in state['delayed'].iteritems():
+            self.delayed[work] = ready_at
+            heapq.heappush(self.delayed_heap, (ready_at, work))
+        self.dead_letters = state['dead_letters']
+        # Snapshots taken before deadlines existed have none
+        for work, deadline in state.get('deadlines', {}).iteritems():
+            self._setDeadline(work, deadline)
+        self.expired = state.get('expired', {})
+        self.recently_done.extend(state['recently_done'])
+        for peer_id, ts in state['peers']:
+            self.peers[peer_id] = ts
+        return True
+
+    def loadSnapshot(self, filename, journal_file=None):
+        """Restore the scheduler state from a snapshot file and its journal.
+
+        Args:
+            filename: the file written by saveSnapshot().
+
+            journal_file: the journal started after the snapshot, if any.
+                The ".old" journal kept while the next snapshot was written
+                (see saveSnapshot()) is replayed before it.
+
+        Returns:
+            True if the state was restored.
+        """
+        start = time.time()
+        try:
+            state = cPickle.load(open(filename, 'rb'))
+        except (IOError, EOFError, cPickle.UnpicklingError), e:
+            log.err("Could not load scheduler snapshot %s: %s" % (filename, e))
+            return False
+        if not self.restoreSnapshot(state):
+            return False
+        last_seen = state['time']
+        if journal_file is not None:
+            for filename in (journal_file + '.old', journal_file):
+                if os.path.exists(filename):
+                    last_seen = max(last_seen, self._replayJournal(filename))
+        # Downtime doesn't count against peers and leases
+        self._shiftTimestamps(time.time() - last_seen)
+        log.msg("Scheduler snapshot loaded in %0.2f seconds: %i queued, "
+                "%i active jobs" % (time.time() - start,
+                                    len(self.work_queue) +
+                                    len(self.ready_queue),
+                                    len(self.active_queue)))
+        return True
+
+    def openJournal(self, filename, append=True):
+        """Log transitions to a journal file from now on.
+
+        Args:
+            filename: the journal file.
+
+            append: if False, the journal is truncated (and its ".old"
+                journal removed). Should be True only if the journal matches
+                the snapshot the scheduler was restored from.
+        """
+        if self.journal is not None:
+            self.journal.close()
+        if append:
+            mode = 'a'
+        else:
+            mode = 'w'
+            if os.path.exists(filename + '.old'):
+                os.remove(filename + '.old')
+        self.journal = open(filename, mode, 1)     # line buffered
+        self.journal_file = filename
+
+    def _journal(self, now, op, action, params, extra=None):
+        """Append a transition to the journal."""
+        if extra is None:
+            extra = '-'
+        self.journal.write("%r %s %s %s %s\n" % (now, op, action, params,
+                                                 extra))
+
+    def _isKnown(self, work):
+        """Is a work queued, delayed or active?"""
+        return (work in self.active_queue or work in self.work_queue or
+                work in self.ready_queue or work in self.delayed)
+
+    def _replayJournal(self, filename):
+        """Apply the transitions logged in a journal.
+
+        Returns:
+            The time of the last transition (0 if none).
+        """
+        now = 0
+        for line in open(filename):
+            fields = line.split()
+            if len(fields) != 5:
+                continue    # a partially written line, probably
+            ts, op, action, params, extra = fields
+            now = float(ts)
+            work = self.jobs.add(action, params)
+            if op == 'A':
+                if not self._isKnown(work):
+                    if extra == '-':
+                        priority = None
+                    else:
+                        priority = float(extra)
+                    self.appendWork(action, params, priority)
+            elif op == 'L':
+                if work in self.active_queue:
+                    self._endLease(work)
+                elif work in self.work_queue:
+                    self.work_queue.remove(work)
+                elif work in self.ready_queue:
+                    self.ready_queue.remove(work)
+                elif work in self.delayed:
+                    del self.delayed[work]
+                else:
+                    continue    # done already
+                self._startLease(work, extra, now)
+                self.work_queue.getAction(action).host.n_active += 1
+            elif op == 'D':
+                if self._isKnown(work):
+                    self.markWorkDone(action, params)
+            elif op == 'T':
+                if self._isKnown(work):
+                    self._setDeadline(work, float(extra))
+        return now
+
+    def _shiftTimestamps(self, delta):
+        """Add delta seconds to the timestamps of peers and leases."""
+        for peer_id in self.peers:
+            self.peers[peer_id] += delta
+        for work in self.active_queue:
+            self.active_queue[work] += delta
+        for work in self.lease_start:
+            self.lease_start[work] += delta
+        self.lease_heap = [(ts, work)
+                           for work, ts in self.active_queue.iteritems()]
+        heapq.heapify(self.lease_heap)
+
+
+def benchmark_beats(sizes=(1000, 10000, 100000), n_beats=100):
+    """Measure the cost of a scheduler beat as the number of leases grows.
+
+    For every size in sizes, a scheduler with that many active (and not yet
+    expired) leases is created and the average time taken by timerCallback()
+    is printed. It should stay flat no matter how many leases there are.
+    """
+    for size in sizes:
+        sched = Scheduler(interval=60)
+        for i in xrange(size):
+            sched.appendWork("BENCH", str(i))
+        # Lease everything, by-passing the one-job-per-beat promotion
+        while sched.work_queue:
+            sched.ready_queue.append(sched.work_queue.pop())
+            sched._assignWork("bench-peer")
+        start = time.time()
+        for i in xrange(n_beats):
+            sched.timerCallback()
+        elapsed = time.time() - start
+        print "%8i active leases: %8.2f usec/beat" % \
+                (size, elapsed * 1e6 / n_beats)
+
+
+if __name__ == '__main__':
+    # Don't flood the output with "Assigning work" messages
+    log.msg = lambda *args, **kwargs: None
+    benchmark_beats()
+
 
 # vim: set ai tw=80 et sw=4 ts=4 sts=4 fileencoding=utf-8 :
@@ -34,7 +34,8 @@ Since we use twisted as our HTTP server framework, some knowledge of twisted.web
 Logging is handled by twisted.python.log.
 """
 
-__version__ = "0.4.lastfm-" + "$Revision$".split()[1]
+# $Revision$ is only expanded in checkouts of the original repository
+__version__ = "0.4.lastfm-" + ("$Revision$".split()[1:] or ["unknown"])[0]
 __date__ = "2008-09-29 21:09:46 -0300 (Mon, 29 Sep 2008)"
 __author__ = "Tiago Alves Macambira"
 __copyright__ = 'Copyright (c) 2006-2008 Tiago Alves Macambira'
@@ -44,6 +45,7 @@ import bsddb
 import gdbm
 import time
 import os
+from collections import OrderedDict
 
 from twisted.web import server, resource
 from twisted.internet import reactor, task
@@ -131,26 +133,81 @@ class ManageScheduler(resource.Resource):
     
     Information about jobs are retrieved directly from the scheduler and from
     controlers for specific tasks.
+
+    Class Atributes
+    ---------------
+
+    WAKEUP_ROWS: Max number of rows in the table of upcoming pings.
     """
+
+    WAKEUP_ROWS = 20
+
     stats_html = """<html>
     <head><title>Manage Scheduler Parameters</title></head>
     <body>
     <h1>Current Settings</h1>
     <dl>
         <dt>Interval</dt><dd>%(interval)0.2f seconds</dd>
+        <dt>Dispatch rate</dt><dd>%(dispatch_rate)s</dd>
+        <dt>Adaptive dispatch rate</dt><dd>%(adaptive_rate)s</dd>
     </dl>
     <form action="manage" method="post">
         New Interval: <input type="text" name="interval" />
         <input type="submit" value="Update"/>
     </form>
+    <form action="manage" method="post">
+        New Dispatch rate (jobs/second, 0 for one job per beat):
+        <input type="text" name="dispatch_rate" />
+        <input type="submit" value="Update"/>
+    </form>
+    <form action="manage" method="post">
+        Adaptive dispatch rate (jobs/second, leave empty to turn it off)
+        from <input type="text" name="min_rate" />
+        to <input type="text" name="max_rate" />
+        <input type="submit" value="Update"/>
+    </form>
+    <form action="manage" method="post">
+        Action: <input type="text" name="action" />
+        New Weight (0 pauses it): <input type="text" name="weight" />
+        <input type="submit" value="Update"/>
+    </form>
     <h1>Scheduler Status</h1>
     <dl>
         <dt>Next Interval</dt><dd>%(next_interval_in)02.2f seconds</dd>
         <dt>Ready jobs</dt><dd>%(ready)i</dd>
         <dt>Active jobs</dt><dd>%(active)i</dd>
+        <dt>Backup copies of active jobs</dt><dd>%(backups)i</dd>
         <dt>Queued jobs</dt><dd>%(queued)i</dd>
+        <dt>Delayed (recycled) jobs</dt><dd>%(delayed)i</dd>
         <dt>Active Clients</dt><dd>%(n_clients)i</dd>
+        <dt>Parked (long polling) Clients</dt><dd>%(n_parked)i</dd>
+        <dt>Pings in the last minute</dt><dd>%(pings)i
+            (at most %(ping_peak)i in a single second)</dd>
     </dl>
+    <h1>Actions Status</h1>
+    <table>
+      <tr><th>Action</th><th>Host</th><th>Weight</th><th>Queued jobs</th>
+          <th>Dispatched jobs</th><th>Dispatched jobs/second</th>
+          <th>Given up jobs</th><th>Expired jobs</th></tr>
+      %(actions)s
+    </table>
+    <h1>Hosts Status</h1>
+    <table>
+      <tr><th>Host</th><th>Queued jobs</th><th>Active jobs</th>
+          <th>Min delay</th><th>Max active</th></tr>
+      %(hosts)s
+    </table>
+    <h1>Upcoming Pings</h1>
+    <table>
+      <tr><th>Seconds from now</th><th>Clients told to wake up</th></tr>
+      %(wakeups)s
+    </table>
+    <h1>Dispatch Rate Adjustments</h1>
+    <table>
+      <tr><th>When</th><th>From (jobs/second)</th><th>To (jobs/second)</th>
+          <th>Why</th></tr>
+      %(rate_adjustments)s
+    </table>
     %(other_services)s
     <p><small> Server v.%(serv_version)s /
                Scheduler v.%(sched_version)s </small></p>
@@ -183,19 +240,121 @@ class ManageScheduler(resource.Resource):
             buf.append('<h1>%s Status</h1>\n%s\n' % (name, serv.getStatus()))
         return ''.join(buf)
 
+    def _getActionsStatus(self, now):
+        """Return HTML table rows reporting the status of every known action."""
+        buf = []
+        actions = self.scheduler.work_queue.actions
+        dead_letters = self.scheduler.dead_letters
+        expired = self.scheduler.expired
+        for name in sorted(actions.keys()):
+            action = actions[name]
+            buf.append('<tr><td>%s</td><td>%s</td><td>%0.2f</td><td>%i</td>'
+                       '<td>%i</td><td>%0.2f</td><td>%i</td><td>%i</td>'
+                       '</tr>\n' %
+                       (name, action.host.host, action.weight,
+                        len(action.queue), action.meter.total,
+                        action.meter.rate(now), dead_letters.get(name, 0),
+                        expired.get(name, 0)))
+        return ''.join(buf)
+
+    def _getRateAdjustments(self):
+        """Return HTML table rows with the latest dispatch rate adjustments."""
+        buf = []
+        rate_controller = self.scheduler.rate_controller
+        if rate_controller is None:
+            return ''
+        for when, old_rate, new_rate, reason in reversed(
+                rate_controller.history):
+            buf.append('<tr><td>%s</td><td>%0.4f</td><td>%0.4f</td>'
+                       '<td>%s</td></tr>\n' %
+                       (time.strftime("%Y-%m-%d %H:%M:%S",
+                                      time.localtime(when)),
+                        old_rate, new_rate, reason))
+        return ''.join(buf)
+
+    def _getHostsStatus(self):
+        """Return HTML table rows reporting the status of every known host."""
+        buf = []
+        work_queue = self.scheduler.work_queue
+        for name in sorted(work_queue.hosts.keys()):
+            host = work_queue.hosts[name]
+            queued = sum([len(work_queue.actions[action].queue)
+                          for action in host.actions])
+            max_active = host.max_active
+            if max_active is None:
+                max_active = '-'
+            buf.append('<tr><td>%s</td><td>%i</td><td>%i</td>'
+                       '<td>%0.2f seconds</td><td>%s</td></tr>\n' %
+                       (name, queued, host.n_active, host.min_delay,
+                        max_active))
+        return ''.join(buf)
+
+    def _getWakeupsStatus(self, now):
+        """Return HTML table rows reporting when clients will ping us again,
+        in (at most) WAKEUP_ROWS rows."""
+        wakeups = self.scheduler.wakeups
+        if not wakeups.slots:
+            return ''
+        span = max(wakeups.slots.keys()) - int(now) + 1
+        width = max(1, -(-span // self.WAKEUP_ROWS))
+        buf = []
+        for offset, count in wakeups.histogram(now, width):
+            buf.append('<tr><td>%i - %i</td><td>%i</td></tr>\n' %
+                       (offset, offset + width - 1, count))
+        return ''.join(buf)
+
     def render(self, request):
         """Render HTML code for the ManageScheduler page."""
         if request.args.has_key('interval'):
             interval = float(request.args['interval'][0])
             self.scheduler.reschedule(interval)
+        if request.args.has_key('dispatch_rate'):
+            dispatch_rate = float(request.args['dispatch_rate'][0])
+            self.scheduler.setDispatchRate(dispatch_rate)
+        if request.args.has_key('min_rate') and \
+                request.args.has_key('max_rate'):
+            min_rate = request.args['min_rate'][0].strip()
+            max_rate = request.args['max_rate'][0].strip()
+            if min_rate and max_rate:
+                self.scheduler.setAdaptiveRate(float(min_rate),
+                                               float(max_rate))
+            else:
+                self.scheduler.setAdaptiveRate(None, None)
+        if request.args.has_key('action') and request.args.has_key('weight'):
+            action = request.args['action'][0].strip()
+            if action in self.scheduler.work_queue.actions:
+                weight = float(request.args['weight'][0])
+                self.scheduler.setActionWeight(action, weight)
         now = time.time()
         sched_version = scheduler.__version__
+        dispatch_rate = self.scheduler.getDispatchRate()
+        if dispatch_rate is None:
+            dispatch_rate = 'one job per beat'
+        else:
+            dispatch_rate = '%0.2f jobs/second' % dispatch_rate
+        rate_controller = self.scheduler.rate_controller
+        if rate_controller is None:
+            adaptive_rate = 'off'
+        else:
+            adaptive_rate = 'from %0.4f to %0.4f jobs/second' % \
+                    (rate_controller.min_rate, rate_controller.max_rate)
         stats = {   'interval' : self.scheduler.interval,
+                    'dispatch_rate' : dispatch_rate,
+                    'adaptive_rate' : adaptive_rate,
+                    'rate_adjustments' : self._getRateAdjustments(),
                     'next_interval_in': self.scheduler.next_interval - now,
                     'ready': len(self.scheduler.ready_queue),
                     'active': len(self.scheduler.active_queue),
+                    'backups': len(self.scheduler.backups),
                     'queued': len(self.scheduler.work_queue),
+                    'delayed': len(self.scheduler.delayed),
                     'n_clients': len(self.scheduler.peers),
+                    'n_parked': len(self.scheduler.parked),
+                    'pings': self.scheduler.ping_meter.countSince(now),
+                    'ping_peak': self.scheduler.ping_meter.peak(now),
+                    'wakeups': self._getWakeupsStatus(now),
+                    'actions' : self._getActionsStatus(now),
+                    'hosts' : self._getHostsStatus(),
                     'other_services' : self._getOtherServicesStatus(),
                     'serv_version': __version__,
                     'sched_version' : sched_version,
@@ -216,14 +375,44 @@ class ManageScheduler(resource.Resource):
         self.other_services[name] = controller
         
 
+def sendsAborts(request):
+    """Does the client that made a request understand ABORT lines?"""
+    return request.getHeader('client-aborts') == '1'
+
+
 class Ping(resource.Resource):
     """Handles client's periodic contact request and dispatches jobs.
     
     Clients (peers) periodically contact the server to inform it they are alive
     and to request work to do. This resource handles this contact request.
 
+    Clients may ask for a batch of jobs by sending a 'client-batch-size'
+    header. By default, just one job is handed per request.
+
+    Clients may tell which actions they are able to run in a 'client-actions'
+    header, a comma-separated list. They are only handed jobs of these
+    actions. Clients that don't send it are handed jobs of any action.
+
+    Clients may also send a 'client-long-poll' header, with the ammount of
+    time (in seconds) they are willing to wait for a job. Instead of being
+    told to SLEEP, such clients have their request held (long polling) until
+    the scheduler hands them a job or the time is up -- in which case they
+    are told to come back right away.
+
+    Clients that understand ABORT lines (see scheduler.Scheduler) should send
+    a 'client-aborts' header set to "1". Other clients are never sent them.
+
+    Class Atributes
+    ---------------
+
+    MAX_LONG_POLL: Max ammount of time (in seconds) a request is held. Must
+        be well below the time the scheduler takes to declare a peer dead.
+
     @warning: most clients expect to find this resource in the "/ping" path.
     """
+
+    MAX_LONG_POLL = 120
+
     def __init__(self, sched, client_reg):
         """Constructor.
 
@@ -239,7 +428,99 @@ class Ping(resource.Resource):
     def render(self, request):
         """Render the command that should be returned to the client."""
         client_id = self.client_reg.updateClientStats(request)
-        return self.scheduler.renderPing(client_id)
+        try:
+            batch_size = int(request.getHeader('client-batch-size') or 1)
+        except ValueError:
+            batch_size = 1
+        actions = request.getHeader('client-actions')
+        if actions is not None:
+            actions = frozenset(actions.split(','))
+        command = self.scheduler.renderPing(client_id, batch_size=batch_size,
+                                            actions=actions,
+                                            address=request.getClientIP(),
+                                            send_aborts=sendsAborts(request))
+        try:
+            long_poll = float(request.getHeader('client-long-poll') or 0)
+        except ValueError:
+            long_poll = 0
+        long_poll = min(long_poll, self.MAX_LONG_POLL)
+        if long_poll <= 0 or not command.startswith('SLEEP'):
+            return command
+        self._park(request, client_id, batch_size, actions, long_poll)
+        return server.NOT_DONE_YET
+
+    def _park(self, request, client_id, batch_size, actions, timeout):
+        """Hold a request until the scheduler hands its client a job.
+
+        Args:
+            request: the twisted.web request being held.
+
+            client_id: the client's uniq identifier.
+
+            batch_size: max number of jobs the client is willing to receive.
+
+            actions: the actions the client is able to run, None for any.
+
+            timeout: ammount of time (in seconds) the request is held.
+        """
+        def deliver(command):
+            if timeout_call.active():
+                timeout_call.cancel()
+            request.write(command)
+            request.finish()
+
+        def expire():
+            self.scheduler.unparkPeer(client_id, deliver)
+            request.write("SLEEP 0 #")
+            request.finish()
+
+        def connectionLost(_reason):
+            if timeout_call.active():
+                timeout_call.cancel()
+            self.scheduler.unparkPeer(client_id, deliver)
+
+        timeout_call = reactor.callLater(timeout, expire)
+        request.notifyFinish().addErrback(connectionLost)
+        self.scheduler.parkPeer(client_id, deliver, batch_size, actions)
+
+
+class RenewLease(resource.Resource):
+    """Lets clients renew the lease of the job they are working on.
+
+    Clients working on long jobs should call this resource every now and then
+    (say, between pages), passing the job's 'action' and 'params' as
+    arguments, so the scheduler doesn't recycle their job and hand it to
+    someone else.
+
+    @warning: most clients expect to find this resource in the "/renew" path.
+    """
+
+    isLeaf = True
+
+    def __init__(self, sched):
+        """Constructor.
+
+        Args:
+            sched: a DistributedCrawler.server.scheduler.Scheduler instance.
+        """
+        resource.Resource.__init__(self)
+        self.scheduler = sched
+
+    def render(self, request):
+        """Renew the lease and render the command returned to the client."""
+        # This is called way more often than /ping, so we don't bother
+        # updating ClientRegistry's persistent storage here.
+        client_id = request.getHeader('client-id')
+        if client_id is None:
+            raise InvalidClientId()
+        if not (request.args.has_key('action') and
+                request.args.has_key('params')):
+            # We can't tell which job this is about, so it isn't leased
+            params = request.args.get('params', [''])[0]
+            return "EXPIRED %s #" % params
+        action = request.args['action'][0]
+        params = request.args['params'][0]
+        return self.scheduler.renderRenew(client_id, action, params)
 
 
 # FIXME: Refactor BaseControler and GenericDBBaseControler into a single class
@@ -270,6 +551,44 @@ class BaseControler(resource.Resource):
         * the following methods:
             - render_POST
 
+    NOTICE: Subclasses may also declare the host their jobs target by setting
+            HOST_KEY, together with how polite the scheduler should be to
+            this host: HOST_MIN_DELAY (seconds between two jobs) and
+            HOST_MAX_ACTIVE (max number of jobs being processed at once).
+            Controllers sharing a HOST_KEY should agree on these settings.
+            See scheduler.Scheduler.setHostPolicy().
+
+            The share of dispatched jobs given to this controller, relative
+            to other controllers, is set by WEIGHT. It can be changed later
+            in the '/manage' page.
+
+    NOTICE: By default, every pending job is loaded into the scheduler at
+            start-up. For huge backlogs, set PENDING_WINDOW: only this many
+            pending jobs are kept in the scheduler and more are read from
+            stable storage, from where we stopped last time, as they are
+            dispatched. See iterStore() and scheduler.Scheduler.setFeeder().
+            DirDBM can't be read from where we stopped without listing its
+            whole directory, so this needs a GenericDBBaseControler that
+            sets CAN_PAGE.
+
+    NOTICE: If the jobs of a controller vary a lot in size, set SIZE_AWARE
+            and overwrite getJobCost(): bigger jobs will be handed to the
+            fastest clients. Pass the client_id (and the size of the results)
+            to markJobAsDone() so clients' performance can be tracked.
+
+    NOTICE: Jobs may be added with a deadline (see addJob()). Jobs that
+            miss their deadline are moved to the "expired" store, so we can
+            tell how much of the crawl was lost this way.
+
+    NOTICE: Done jobs are never seen again, unless REVISIT_BUDGET is set and
+            getRevisitKey() and getRevisitJob() are overwritten. In this case,
+            subclasses should call recordVisit() with how much content a job
+            had (say, comments) when it is done. Jobs are then done again
+            (as new jobs) when they are expected to have changed enough.
+            Every REVISIT_INTERVAL seconds, up to REVISIT_BUDGET revisits are
+            added, the ones with the most expected new content first. See
+            scheduler.RevisitPlanner.
+
     NOTICE: This implementation uses twisted's DirDBM as stable storage
             mechanism. To alter this overwrite setupStableStorage() or
             subclass from GenericDBBaseControler.
@@ -285,9 +604,24 @@ class BaseControler(resource.Resource):
             <dt>Queued jobs</dt><dd>%(queued)i (%(queued_percent)02.02f%%)</dd>
             <dt>Done jobs</dt><dd>%(done)i (%(done_percent)02.02f%%)</dd>
             <dt>Erroneus jobs</dt><dd>%(err)i (%(err_percent)02.02f%%)</dd>
+            <dt>Expired jobs</dt><dd>%(expired)i (%(expired_percent)02.02f%%)</dd>
             <dt>Total</dt><dd>%(total)i</dd>
         </dl>"""
 
+    HOST_KEY = None
+    HOST_MIN_DELAY = 0
+    HOST_MAX_ACTIVE = None
+    WEIGHT = 1.0
+    PENDING_WINDOW = None
+    CAN_PAGE = False
+    SIZE_AWARE = False
+    REVISIT_BUDGET = None
+    REVISIT_INTERVAL = 600
+    REVISIT_MIN_DELAY = 3600
+    REVISIT_MAX_DELAY = 7 * 24 * 3600
+    REVISIT_MIN_GAIN = 1
+    MAX_REVISIT_BUMPS = 100
+
     def __init__(self, sched, prefix, client_reg):
         """Constructor.
 
@@ -304,18 +638,42 @@ class BaseControler(resource.Resource):
         # Set things up
         self.scheduler = sched
         self.client_reg = client_reg
+        # Tell the scheduler which host our jobs target
+        if self.SIZE_AWARE:
+            job_cost = self.getJobCost
+        else:
+            job_cost = None
+        self.scheduler.registerAction(self.ACTION_NAME, self.HOST_KEY,
+                                      self.WEIGHT, self.markJobAsErroneus,
+                                      job_cost, self.markJobAsExpired)
+        if self.HOST_KEY is not None:
+            self.scheduler.setHostPolicy(self.HOST_KEY, self.HOST_MIN_DELAY,
+                                         self.HOST_MAX_ACTIVE)
         # Setup stores
         self.store_path = prefix + "/" + self.PREFIX_BASE + "/"
         self.setupStableStorage()
-        # Load previously stored data
-        for job in self.store.keys():
-            self._addToScheduler(job)
+        # Plan revisits of done jobs
+        self.revisits = None
+        if self.REVISIT_BUDGET:
+            self.setupRevisits()
+        # Load previously stored data, unless the scheduler already knows it
+        self.store_cursor = None    # last pending job read by the scheduler
+        if self.PENDING_WINDOW:
+            if not self.CAN_PAGE:
+                raise ValueError("%s can't page its store, unset "
+                                 "PENDING_WINDOW" % self.__class__.__name__)
+            self.scheduler.setFeeder(self.ACTION_NAME, self._feedScheduler,
+                                     self.PENDING_WINDOW)
+        elif not self.scheduler.isRestored(self.ACTION_NAME):
+            for job in self.store.keys():
+                self._addToScheduler(job, self.getJobPriority(job),
+                                     self.getJobDeadline(job))
 
     def setupStableStorage(self):
         """Setup stable storage used by this BaseControler.
         
-        Load and setup stable storage mechanism for the pending, done and
-        erroneous task queues.
+        Load and setup stable storage mechanism for the pending, done,
+        erroneous and expired task queues, and for the revisit plans.
 
         By default we used twisted's DirDBM, creating the directories where
         the queues will be stored if needed.
@@ -324,41 +682,156 @@ class BaseControler(resource.Resource):
         queue_store_path = self.store_path + "/queue"
         done_store_path = self.store_path + "/done"
         err_store_path = self.store_path + "/error"
-        for queue_path in [queue_store_path, done_store_path, err_store_path]:
+        expired_store_path = self.store_path + "/expired"
+        revisit_store_path = self.store_path + "/revisit"
+        for queue_path in [queue_store_path, done_store_path, err_store_path,
+                           expired_store_path, revisit_store_path]:
             if not os.path.isdir(queue_path):
                 os.makedirs(queue_path)
         self.store = DirDBM(queue_store_path)
         self.done_store = DirDBM(done_store_path)
         self.err_store = DirDBM(err_store_path)
+        self.expired_store = DirDBM(expired_store_path)
+        self.revisit_store = DirDBM(revisit_store_path)
+
+    def iterStore(self, after=None):
+        """Iterate over the pending jobs in stable storage.
 
-    def _addToScheduler(self, job):
+        Subclasses that implement this should set CAN_PAGE.
+
+        Args:
+            after: if not None, iteration starts right after this job, if it
+                is still in stable storage. Otherwise, it starts from the
+                beginning.
+        """
+        # DirDBM has no cursors
+        raise NotImplementedError()
+
+    def _isScheduled(self, job):
+        """Does the scheduler already know about a pending job?"""
+        return self.scheduler.isKnown(self.ACTION_NAME, job)
+
+    def _feedScheduler(self, n):
+        """Hand up to n pending jobs the scheduler doesn't know about to it.
+
+        Reading goes on from where it stopped last time, wrapping around the
+        end of stable storage at most once.
+        """
+        n_fed = 0
+        from_start = self.store_cursor is None
+        iterator = self.iterStore(self.store_cursor)
+        while n_fed < n:
+            job = next(iterator, None)
+            if job is None:
+                self.store_cursor = None
+                if from_start:
+                    break   # we went through all of it
+                from_start = True
+                iterator = self.iterStore()
+                continue
+            self.store_cursor = job
+            if not self._isScheduled(job):
+                self._addToScheduler(job, self.getJobPriority(job),
+                                     self.getJobDeadline(job))
+                n_fed += 1
+
+    def _addToScheduler(self, job, priority=None, deadline=None):
         """Register a pending job with the scheduler."""
-        self.scheduler.appendWork(self.ACTION_NAME, job)
+        self.scheduler.appendWork(self.ACTION_NAME, job, priority, deadline)
+
+    def _addToStore(self, job, deadline=None):
+        """Register a pending job in the persistent storage.
+
+        Jobs with a deadline have it stored as their value.
+        """
+        if deadline is None:
+            self.store[job] = '1'
+        else:
+            self.store[job] = repr(float(deadline))
+
+    def getJobPriority(self, job):
+        """Return the scheduling priority of a job.
+
+        Only used if the scheduler is in priority mode. Higher priorities are
+        handed first. Since priorities are not kept in stable storage, this is
+        also used to recover the priorities of pending jobs at start-up.
+        Subclasses may overwrite this. By default, all jobs have priority 0.
+        """
+        return None
+
+    def getJobDeadline(self, job):
+        """Return the deadline of a pending job, or None if it has none.
 
-    def _addToStore(self, job):
-        """Register a pending job in the persistent storage."""
-        self.store[job] = '1'
+        Deadlines are read back from stable storage.
+        """
+        try:
+            value = self.store[job]
+        except KeyError:
+            return None
+        if value == '1':
+            return None
+        return float(value)
+
+    def getJobCost(self, job):
+        """Return how costly (big) a job is, as a positive number.
+
+        Only used if SIZE_AWARE is set. Subclasses should overwrite this. By
+        default, job costs are unknown (None).
+        """
+        return None
+
+    def addJob(self, job, priority=None, deadline=None):
+        """Register a (probably new and unknown) job with this Controller.
+
+        Args:
+            job: the job identifier.
 
-    def addJob(self, job):
-        """Register a (probably new and unknown) job with this Controller."""
-        if job not in self.done_store and job not in self.store:
-            self._addToStore(job)
-            self._addToScheduler(job)
+            priority: scheduling priority for this job. If None, the result of
+                getJobPriority() is used.
 
-    def markJobAsDone(self, job):
-        """Mark a job as done and remove it from "pending" queues."""
+            deadline: time (as returned by time.time()) after which the job
+                is not worth doing anymore. None means no deadline.
+
+        Returns:
+            False if the job was already pending or done, True otherwise.
+        """
+        if job in self.done_store or job in self.store:
+            return False
+        if priority is None:
+            priority = self.getJobPriority(job)
+        self._addToStore(job, deadline)
+        if self.scheduler.hasRoom(self.ACTION_NAME):
+            self._addToScheduler(job, priority, deadline)
+        return True
+
+    def markJobAsDone(self, job, client_id=None, size=None):
+        """Mark a job as done and remove it from "pending" queues.
+
+        Args:
+            job: the job identifier.
+
+            client_id: the client that did the job, if known.
+
+            size: size (in bytes) of the job results, if known.
+        """
+        if job in self.done_store and job not in self.store:
+            # Someone else did it first. The scheduler may have forgotten
+            # about it already.
+            log.msg("Job %s %s was done already" % (self.ACTION_NAME, job))
+            return
         # Add to done store
         self.done_store[job] = '1'
         # Remove job from the local's and from scheduler's queue
         if job in self.store:
             del self.store[job]
-        self.scheduler.markWorkDone(self.ACTION_NAME, job)
+        self._removeFromScheduler(job, client_id, size)
 
     def markJobAsErroneus(self, job):
         """Dequeue job and save it in the (persistent) list of erroneus jobs.
         
         Erroneus jobs are jobs that, for some reason, were flagged by clients as
-        being probelattic to handle.
+        being probelattic to handle. The scheduler also calls this for jobs
+        that failed too many times.
         """
         # This job does exist, right?
         if job not in self.store:
@@ -368,7 +841,116 @@ class BaseControler(resource.Resource):
         # Remove job from the local's and from scheduler's queue
         if job in self.store:
             del self.store[job]
-        self.scheduler.markWorkDone(self.ACTION_NAME, job)
+        self._removeFromScheduler(job)
+
+    def markJobAsExpired(self, job):
+        """Dequeue a job that missed its deadline and save it in the
+        (persistent) list of expired jobs.
+
+        The scheduler calls this for pending jobs whose deadline passed.
+        """
+        if job not in self.store:
+            raise KeyError("Unknown job " + str(job))
+        self.expired_store[job] = '1'
+        del self.store[job]
+        self._removeFromScheduler(job)
+
+    def setupRevisits(self):
+        """Restore the revisit plans kept in stable storage and start adding
+        revisits every REVISIT_INTERVAL seconds."""
+        self.revisits = scheduler.RevisitPlanner(self.REVISIT_MIN_DELAY,
+                                                 self.REVISIT_MAX_DELAY,
+                                                 self.REVISIT_MIN_GAIN)
+        for key in self.revisit_store.keys():
+            last_visit, measure, rate, cost = \
+                    self.revisit_store[key].split()
+            if rate == 'None':
+                rate = None
+            else:
+                rate = float(rate)
+            self.revisits.restore(key, float(last_visit), float(measure),
+                                  rate, float(cost))
+        self.revisit_timer = task.LoopingCall(self.revisit)
+        self.revisit_timer.start(self.REVISIT_INTERVAL, now=False)
+
+    def getRevisitKey(self, job):
+        """Return the identifier of the item a job crawls, the same for every
+        revisit of the item, or None if the job shouldn't be revisited.
+
+        Subclasses that set REVISIT_BUDGET must overwrite this.
+        """
+        return None
+
+    def getRevisitJob(self, key, measure):
+        """Return the job that crawls an item again.
+
+        Subclasses that set REVISIT_BUDGET must overwrite this.
+
+        Args:
+            key: the item identifier, as returned by getRevisitKey().
+
+            measure: how much content we expect the item to have by now.
+
+        Jobs for bigger measures must have different identifiers: earlier
+        visits of the item may have asked for as much content already, in
+        which case bigger measures are tried (see MAX_REVISIT_BUMPS).
+        """
+        raise NotImplementedError()
+
+    def recordVisit(self, job, measure, cost=1):
+        """Account for a done job, so we know when it is worth doing again.
+
+        Args:
+            job: the job identifier.
+
+            measure: (number) how much content the job got us, in the same
+                unit as REVISIT_MIN_GAIN.
+
+            cost: how costly doing the job again will be.
+        """
+        if self.revisits is None:
+            return
+        key = self.getRevisitKey(job)
+        if key is None:
+            return
+        if self.revisits.observe(key, time.time(), measure, cost):
+            self.revisit_store[key] = ' '.join(
+                    [repr(value) for value in self.revisits.getState(key)])
+        elif key in self.revisit_store:
+            log.msg("%s %s stopped changing, no more revisits" %
+                    (self.ACTION_NAME, key))
+            del self.revisit_store[key]
+
+    def revisit(self):
+        """Add revisits of the done jobs most likely to have changed.
+
+        Called every REVISIT_INTERVAL seconds. At most REVISIT_BUDGET jobs
+        are added.
+        """
+        now = time.time()
+        n_added = 0
+        for key, measure in self.revisits.pop(now, self.REVISIT_BUDGET):
+            job = self.getRevisitJob(key, measure)
+            # Don't ask for a job done already, it would be dropped
+            n_bumps = 0
+            while job in self.done_store and n_bumps < self.MAX_REVISIT_BUMPS:
+                n_bumps += 1
+                job = self.getRevisitJob(key, measure + n_bumps)
+            if self.addJob(job):
+                n_added += 1
+            else:
+                # Try again later, or it would never be revisited
+                self.revisits.postpone(key, now)
+        if n_added:
+            log.msg("Added %i %s revisits" % (n_added, self.ACTION_NAME))
+
+    def _removeFromScheduler(self, job, client_id=None, size=None):
+        """Tell the scheduler a job is not pending anymore.
+
+        Subclasses that keep some of their jobs away from the scheduler
+        should overwrite this.
+        """
+        self.scheduler.markWorkDone(self.ACTION_NAME, job, client_id, size)
 
     def getChild(self, _path, _request):
         """Retrieve a 'child' resource from me.
@@ -385,22 +967,27 @@ class BaseControler(resource.Resource):
         queued = len(self.store)
         done = len(self.done_store)
         err = len(self.err_store)
-        total = queued + done + err
+        expired = len(self.expired_store)
+        total = queued + done + err + expired
         if total == 0.0 :
             queued_percent = 0.0
             done_percent = 100.0
             err_percent = 0.0
+            expired_percent = 0.0
         else:
             queued_percent = (queued * 100.0)/total
             done_percent = (done * 100.0)/total
             err_percent = (err * 100.0)/total
+            expired_percent = (expired * 100.0)/total
         status = {'queued' : queued,
                   'done' : done,
                   'err' : err,
+                  'expired' : expired,
                   'total' : total,
                   'queued_percent' : queued_percent,
                   'done_percent' : done_percent,
-                  'err_percent' : err_percent }
+                  'err_percent' : err_percent,
+                  'expired_percent' : expired_percent }
         return self.STATUS_HTML % status
 
 
@@ -426,7 +1013,8 @@ class GenericDBBaseControler(BaseControler):
 
     def syncAllDBs(self):
         """Sync or reorganize DBs before usage."""
-        for db in (self.store, self.done_store, self.err_store):
+        for db in (self.store, self.done_store, self.err_store,
+                   self.expired_store, self.revisit_store):
             self._syncDB(db)
 
     def setupStableStorage(self):
@@ -436,6 +1024,10 @@ class GenericDBBaseControler(BaseControler):
         queue_store_path = store_path + "/queue" + self.DB_DEFAULT_EXTENSION
         done_store_path = store_path + "/done" + self.DB_DEFAULT_EXTENSION
         err_store_path = store_path + "/error" + self.DB_DEFAULT_EXTENSION
+        expired_store_path = store_path + "/expired" + \
+                self.DB_DEFAULT_EXTENSION
+        revisit_store_path = store_path + "/revisit" + \
+                self.DB_DEFAULT_EXTENSION
         # Make dirs
         if not os.path.isdir(store_path):
             os.makedirs(store_path)
@@ -443,6 +1035,8 @@ class GenericDBBaseControler(BaseControler):
         self.store = self._openDB(queue_store_path)
         self.done_store = self._openDB(done_store_path)
         self.err_store = self._openDB(err_store_path)
+        self.expired_store = self._openDB(expired_store_path)
+        self.revisit_store = self._openDB(revisit_store_path)
         # "Sync or reorganize" DBs before usage
         self.syncAllDBs()
 
@@ -451,6 +1045,7 @@ class GdbmBaseControler(GenericDBBaseControler):
     """A BaseControler that uses GDBM as stable storage mechanism."""
 
     DB_DEFAULT_EXTENSION = ".gdbm"
+    CAN_PAGE = True
 
     def _openDB(self, filename):
         """Open DB with underlying implementation."""
@@ -462,6 +1057,20 @@ class GdbmBaseControler(GenericDBBaseControler):
         enhanced_db = OldMappingIteratorProxy(db)
         return enhanced_db
 
+    def iterStore(self, after=None):
+        """Iterate over the pending jobs in stable storage.
+
+        See BaseControler.iterStore().
+        """
+        store = self.store
+        if after is not None and after in store:
+            key = store.nextkey(after)
+        else:
+            key = store.firstkey()
+        while key is not None:
+            yield key
+            key = store.nextkey(key)
+
     def _syncDB(self, db):
         """Asks the underlying DB implamentation to sync the DB contents."""
         # databases are already opened in sync'ed mode.
@@ -476,11 +1085,30 @@ class BsddbBaseControler(GenericDBBaseControler):
     """
 
     DB_DEFAULT_EXTENSION = ".bsddb"
+    CAN_PAGE = True
 
     def _openDB(self, filename):
         """Open DB with underlying implementation."""
         return bsddb.hashopen(filename, "c")
 
+    def iterStore(self, after=None):
+        """Iterate over the pending jobs in stable storage.
+
+        See BaseControler.iterStore().
+        """
+        store = self.store
+        try:
+            if after is not None and store.has_key(after):
+                store.set_location(after)
+                key, _value = store.next()
+            else:
+                key, _value = store.first()
+            while True:
+                yield key
+                key, _value = store.next()
+        except (KeyError, bsddb.error):
+            return  # no more keys
+
     def _syncDB(self, db):
         """Asks the underlying DB implamentation to sync the DB contents."""
         db.sync()
@@ -496,6 +1124,13 @@ class ClientRegistry(resource.Resource):
     Information about client is stored in a DirDBM. For a given client ID,
     we store it's CLIENT_SENT_HEADERS headers and the # of jobs performed.
     Information is stored as a string, fields separated by '#'.
+
+    Clients' performance, as tracked by the scheduler (see
+    scheduler.PeerStats), is reported as well.
+
+    Requests are also counted per IP address, in a sliding window of
+    ADDRESS_WINDOW seconds, and reported along with the jobs the scheduler
+    handed to every address (see scheduler.Scheduler.ADDRESS_BUDGET).
     """
 
     isLeaf = True
@@ -516,6 +1151,19 @@ class ClientRegistry(resource.Resource):
            <tr>
              <th>client-hostname</th><th>client-version</th>
              <th>client-arver</th><th># jobs</th><th>state</th><th>Next job</th>
+             <th>Avg. job time (s)</th><th>KB/s</th><th>Reliability</th>
+           </tr>
+         <thead>
+         <tbody>"""
+
+    ADDRESSES_HTML_HEADER = """</tbody></table>
+        <h1>Addresses</h1>
+        <table class="sortable" id="addressState">
+         <thead>
+           <tr>
+             <th>IP address</th><th>Requests/minute</th>
+             <th>Jobs handed in the last %(window)i seconds</th>
+             <th>Budget</th>
            </tr>
          <thead>
          <tbody>"""
@@ -524,6 +1172,8 @@ class ClientRegistry(resource.Resource):
         </body>
         </html> """
 
+    ADDRESS_WINDOW = 60
+
     def __init__(self, sched, prefix):
         """ClientRegistry Constructor.
 
@@ -540,6 +1190,9 @@ class ClientRegistry(resource.Resource):
         if not os.path.isdir(self.store_path):
             os.makedirs(self.store_path)
         self.known_clients = DirDBM(self.store_path)
+        self.address_meters = OrderedDict() # IP address as key, RateMeter
+                                            # of requests as value, the
+                                            # least recently seen first
         # Restore information about jobs done
         self.jobs_done = {}
         for client_id in self.known_clients.keys():
@@ -564,6 +1217,21 @@ class ClientRegistry(resource.Resource):
         client_id = request.getHeader('client-id')
         if client_id is None:
             raise InvalidClientId()
+        address = request.getClientIP()
+        now = time.time()
+        address_meters = self.address_meters
+        meter = address_meters.pop(address, None)   # move it to the end
+        if meter is None:
+            meter = scheduler.RateMeter(self.ADDRESS_WINDOW)
+        address_meters[address] = meter
+        meter.mark(now)
+        # Forget about addresses we haven't heard from in a while. Only the
+        # stale ones at the start of address_meters are touched.
+        while address_meters:
+            address, meter = next(address_meters.iteritems())
+            if meter.countSince(now):
+                break
+            del address_meters[address]
         if job_done:
             self.jobs_done[client_id] = self.jobs_done.get(client_id, 0) + 1
         # store client information in persistent storage
@@ -578,6 +1246,41 @@ class ClientRegistry(resource.Resource):
 
         return client_id
 
+    def _getAddressesStatus(self, now):
+        """Return HTML code reporting the request and job rates per address.
+        """
+        sched = self.scheduler
+        budget = sched.ADDRESS_BUDGET
+        if budget is None:
+            budget = '-'
+        result = [self.ADDRESSES_HTML_HEADER % {'window': sched.ADDRESS_WINDOW}]
+        for address, meter in sorted(self.address_meters.items()):
+            if not meter.countSince(now):
+                del self.address_meters[address]
+                continue
+            jobs_meter = sched.address_meters.get(address)
+            if jobs_meter is None:
+                jobs = 0
+            else:
+                jobs = jobs_meter.countSince(now)
+            result.append('<tr><td>%s</td><td>%0.2f</td><td>%i</td>'
+                          '<td>%s</td></tr>' %
+                          (address, meter.rate(now) * 60, jobs, budget))
+        return ''.join(result)
+
+    def _getPerformanceStatus(self, client_id):
+        """Return HTML code (table cells) reporting a client's performance.
+        """
+        stats = self.scheduler.peer_stats.get(client_id)
+        if stats is None or stats.duration is None:
+            return '<td>-</td><td>-</td><td>-</td>'
+        if stats.bytes_per_second is None:
+            speed = '-'
+        else:
+            speed = '%0.2f' % (stats.bytes_per_second / 1024.0)
+        return '<td>%0.2f</td><td>%s</td><td>%0.2f</td>' % \
+                (stats.duration, speed, stats.reliability)
+
     def render(self, _request):
         """Render HTML code for the client status page."""
         now = time.time()
@@ -598,7 +1301,9 @@ class ClientRegistry(resource.Resource):
 
             result.append('<td>%s</td>' % state)
             result.append('<td>%i</td>' % (now - last_seen))
+            result.append(self._getPerformanceStatus(client_id))
             result.append('</tr>')
+        result.append(self._getAddressesStatus(now))
         result.append(self.HTML_FOOTER)
         return "".join(result)
 
@@ -611,10 +1316,20 @@ class BaseDistributedCrawlingServer:
     tried to fix this issue by doing most of the boring setup itself. All you
     gotta do is instanciate and register your Task Handlers and call it's run
     method.
+
+    If snapshots are enabled, the scheduler state is saved every
+    snapshot_interval seconds (and on shutdown) in SNAPSHOT_FILE, below the
+    storage prefix, and restored from there at start-up. See
+    scheduler.Scheduler for details.
     """
 
+    SNAPSHOT_FILE = "scheduler.snapshot"
+    JOURNAL_FILE = "scheduler.journal"
+
     def __init__(self, port=8700, prefix='./db/', interval=60,
-            backtrace_log="backtrace.log"):
+            backtrace_log="backtrace.log", dispatch_rate=None,
+            use_priorities=False, speculative=False,
+            snapshot_interval=None):
         """Constructor.
         
         Args:
@@ -627,13 +1342,29 @@ class BaseDistributedCrawlingServer:
 
             backtrace_log: (str) Filename where backtraces reported by clients
                 and collected by the server will be written.
+
+            dispatch_rate: (float) jobs/second handed to clients. If None,
+                one job is made available per scheduler beat.
+
+            use_priorities: (bool) hand jobs by priority instead of in the
+                order they were enqueued.
+
+            speculative: (bool) hand backup copies of slow jobs to idle
+                clients when there is no pending work.
+
+            snapshot_interval: (int) seconds between snapshots of the
+                scheduler state. If None, snapshots are disabled and the
+                scheduler is rebuilt from the controllers' stores at start-up.
         """
         # Store config locally
         self.port = port
         self.prefix = prefix
         self.interval = interval
         # Setup Scheduler instance
-        self.scheduler = scheduler.Scheduler(self.interval)
+        self.scheduler = scheduler.Scheduler(self.interval,
+                                             dispatch_rate=dispatch_rate,
+                                             use_priorities=use_priorities,
+                                             speculative=speculative)
         sched_timer = task.LoopingCall(self.scheduler.timerCallback)
         self.scheduler.timer = sched_timer
         self.scheduler.start()
@@ -642,12 +1373,39 @@ class BaseDistributedCrawlingServer:
         self.client_reg = ClientRegistry(self.scheduler, self.prefix)
         self.root.putChild('clients', self.client_reg)
         self.root.putChild('ping', Ping(self.scheduler, self.client_reg))
+        self.root.putChild('renew', RenewLease(self.scheduler))
         self.task_manager_ui = ManageScheduler(self.scheduler, sched_timer)
         self.root.putChild('manage', self.task_manager_ui)
         self.terminate = TerminateServerResource()
         self.root.putChild('quitquitquit', self.terminate)
-        self.backtrace_collector = BacktraceReportController(backtrace_log)
+        self.backtrace_collector = BacktraceReportController(backtrace_log,
+                                                             self.scheduler)
         self.root.putChild('backtrace', self.backtrace_collector)
+        if snapshot_interval:
+            self.setupSnapshots(snapshot_interval)
+
+    def setupSnapshots(self, snapshot_interval):
+        """Restore the scheduler state and save it periodically from now on.
+
+        Must be called before any Task Controller is created.
+        """
+        if not os.path.isdir(self.prefix):
+            os.makedirs(self.prefix)
+        snapshot_file = os.path.join(self.prefix, self.SNAPSHOT_FILE)
+        journal_file = os.path.join(self.prefix, self.JOURNAL_FILE)
+        restored = False
+        if os.path.exists(snapshot_file):
+            restored = self.scheduler.loadSnapshot(snapshot_file,
+                                                   journal_file)
+        # The journal only makes sense along with the snapshot it follows
+        self.scheduler.openJournal(journal_file, append=restored)
+        # Snapshots are written to disk in a thread (see saveSnapshot())
+        self.snapshot_timer = task.LoopingCall(self.scheduler.saveSnapshot,
+                                               snapshot_file, True)
+        self.snapshot_timer.start(snapshot_interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      self.scheduler.saveSnapshot,
+                                      snapshot_file, True)
 
     def getScheduler(self):
         """Get the Scheduler instance used by the server."""
@@ -695,17 +1453,23 @@ class TerminateServerResource(resource.Resource):
 
 
 class BacktraceReportController(resource.Resource):
-    """Collects backtraces reported by clients."""
+    """Collects backtraces reported by clients.
+
+    Backtraces are also reported to the scheduler as failures, as they are
+    often a sign that the crawled site is pushing back.
+    """
 
     isLeaf = True
 
-    def __init__(self, output_file):
+    def __init__(self, output_file, sched=None):
         """Constructor.
         
         @param output_file File were reports will be appended.
+        @param sched A scheduler.Scheduler instance, or None.
         """
         resource.Resource.__init__(self)
         self.output_file = output_file
+        self.scheduler = sched
 
     def render(self, request):
         # we reopen it everytime so we can "clean it" between reports...
@@ -725,6 +1489,8 @@ class BacktraceReportController(resource.Resource):
         output.write("\n\t".join(args_data))
         output.write(separator)
         output.close()
+        if self.scheduler is not None:
+            self.scheduler.reportFailure('backtrace')
         log.msg("Backtrace accepted from unknown client.")
         return "Backtrace Accepted."
 
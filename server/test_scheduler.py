@@ -0,0 +1,975 @@
+# -*- coding: utf-8 -*-
+
+"""Unit tests for the scheduler and its queues.
+
+Run them from this directory with "python test_scheduler.py".
+"""
+
+__author__ = "Tiago Alves Macambira"
+__copyright__ = "Copyright (c) 2006-2008 Tiago Alves Macambira"
+__license__ = 'X11'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import scheduler
+
+
+class FakeClock(object):
+    """Stands for the time module in scheduler, so tests control time."""
+
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class SchedulerTestCase(unittest.TestCase):
+    """A TestCase with a Scheduler whose clock is self.clock.
+
+    Jobs are made available one per beat (see beat()), unless DISPATCH_RATE
+    is set.
+    """
+
+    DISPATCH_RATE = None
+
+    def setUp(self):
+        self.real_time = scheduler.time
+        self.clock = scheduler.time = FakeClock()
+        self.scheduler = scheduler.Scheduler(interval=1,
+                                             dispatch_rate=self.DISPATCH_RATE)
+
+    def tearDown(self):
+        scheduler.time = self.real_time
+
+    def beat(self, n=1):
+        """Let n beats go by."""
+        for i in range(n):
+            self.clock.now += self.scheduler.interval
+            self.scheduler.timerCallback()
+
+    def ping(self, peer_id, **kwargs):
+        """Ping the scheduler as a peer, returning the commands it got."""
+        return self.scheduler.renderPing(peer_id, **kwargs).split('\n')
+
+    def assign(self, peer_id, **kwargs):
+        """Ping the scheduler as a peer, returning the params of the job it
+        was handed."""
+        command = self.ping(peer_id, **kwargs)[0].split()
+        self.assertNotEqual(command[0], 'SLEEP')
+        return command[1]
+
+
+class IndexedQueueTest(unittest.TestCase):
+
+    def testEnds(self):
+        queue = scheduler.IndexedQueue([1, 2, 3])
+        queue.appendleft(0)
+        queue.append(4)
+        self.assertEqual(list(queue), [0, 1, 2, 3, 4])
+        self.assertEqual(queue.pop(), 4)
+        self.assertEqual(queue.popleft(), 0)
+        self.assertEqual(len(queue), 3)
+
+    def testNoDuplicates(self):
+        queue = scheduler.IndexedQueue([1, 2])
+        queue.append(1)
+        queue.appendleft(2)
+        self.assertEqual(list(queue), [1, 2])
+
+    def testRemove(self):
+        queue = scheduler.IndexedQueue([1, 2, 3])
+        queue.remove(2)
+        self.failIf(2 in queue)
+        self.assertEqual(list(queue), [1, 3])
+        self.assertEqual(queue.popleft(), 1)
+        self.assertEqual(queue.popleft(), 3)
+        self.assertRaises(IndexError, queue.pop)
+        self.assertRaises(ValueError, queue.remove, 2)
+
+    def testReAddedItemsKeepTheirNewPlace(self):
+        queue = scheduler.IndexedQueue([1, 2, 3])
+        queue.remove(1)
+        queue.append(1)
+        self.assertEqual(list(queue), [2, 3, 1])
+        self.assertEqual(queue.popleft(), 2)
+        self.assertEqual(queue.popleft(), 3)
+        self.assertEqual(queue.popleft(), 1)
+        queue.extend([4, 5])
+        queue.remove(5)
+        queue.appendleft(5)
+        self.assertEqual(queue.pop(), 4)
+        self.assertEqual(queue.pop(), 5)
+        self.assertEqual(len(queue), 0)
+
+    def testCompaction(self):
+        queue = scheduler.IndexedQueue(range(1000))
+        for i in range(0, 1000, 2):
+            queue.remove(i)
+        self.assertEqual(list(queue), range(1, 1000, 2))
+        self.assertEqual(queue.popleft(), 1)
+        self.assertEqual(queue.pop(), 999)
+
+    def testTail(self):
+        queue = scheduler.IndexedQueue(range(10))
+        self.assertEqual(queue.tail(3), [9, 8, 7])
+        self.assertEqual(queue.tail(20), range(9, -1, -1))
+
+
+class SchedulerQueuesTest(SchedulerTestCase):
+
+    def testOneJobPerBeat(self):
+        for params in 'xyz':
+            self.scheduler.appendWork('A', params)
+        self.assertEqual(self.ping('p1')[0].split()[0], 'SLEEP')
+        self.beat()
+        self.assertEqual(self.assign('p1'), 'z')    # the newest job first
+        self.assertEqual(self.ping('p2')[0].split()[0], 'SLEEP')
+
+    def testDoneJobsLeaveEveryQueue(self):
+        for params in 'xyz':
+            self.scheduler.appendWork('A', params)
+        self.beat()
+        self.scheduler.markWorkDone('A', 'z')   # ready
+        self.scheduler.markWorkDone('A', 'x')   # pending
+        self.failIf(self.scheduler.isKnown('A', 'x'))
+        self.failIf(self.scheduler.isKnown('A', 'z'))
+        self.assertEqual(len(self.scheduler.work_queue), 1)
+        self.assertEqual(len(self.scheduler.ready_queue), 0)
+        self.beat()
+        self.assertEqual(self.assign('p1'), 'y')
+        self.scheduler.markWorkDone('A', 'y')   # active
+        self.assertEqual(len(self.scheduler.active_queue), 0)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def testBurstThenRate(self):
+        bucket = scheduler.TokenBucket(2, 3)
+        bucket.last_update = 0
+        self.assertEqual([bucket.consume(0) for i in range(4)],
+                         [True, True, True, False])
+        self.failUnless(bucket.consume(0.5))
+        self.failIf(bucket.consume(0.5))
+
+    def testCapacity(self):
+        bucket = scheduler.TokenBucket(1, 2)
+        bucket.last_update = 0
+        bucket.refill(1000)
+        self.assertEqual(bucket.tokens, 2)
+
+    def testSlowRate(self):
+        bucket = scheduler.TokenBucket(0.1, 1)
+        bucket.last_update = 0
+        self.failUnless(bucket.consume(0))
+        self.failIf(bucket.consume(5))
+        self.failUnless(bucket.consume(10))
+
+
+class DispatchRateTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1
+
+    def testJobsDontWaitForBeats(self):
+        for params in 'xyz':
+            self.scheduler.appendWork('A', params)
+        self.assertEqual(self.assign('p1'), 'z')
+        self.assertEqual(self.assign('p2'), 'y')
+
+    def testRateIsEnforced(self):
+        self.scheduler.setDispatchRate(0.5)
+        for i in range(20):
+            self.scheduler.appendWork('A', str(i))
+        n_assigned = 0
+        while self.ping('p1')[0].split()[0] != 'SLEEP':
+            n_assigned += 1
+        self.assertEqual(n_assigned, self.scheduler.DISPATCH_BURST)
+        self.clock.now += 2
+        self.assertNotEqual(self.ping('p1')[0].split()[0], 'SLEEP')
+        self.assertEqual(self.ping('p1')[0].split()[0], 'SLEEP')
+
+
+class HostPolitenessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = scheduler.PoliteWorkQueue(lambda work: work[0], '*')
+
+    def testHostMinDelay(self):
+        self.queue.setHostPolicy('h', min_delay=10)
+        self.queue.bindAction('A', 'h')
+        self.queue.extend(['A1', 'A2'])
+        self.assertEqual(self.queue.pop(100), 'A2')
+        self.failIf(self.queue.hasReady(105))
+        self.failUnless(self.queue.hasReady(110))
+
+    def testHostMaxActive(self):
+        self.queue.setHostPolicy('h', max_active=1)
+        self.queue.bindAction('A', 'h')
+        self.queue.extend(['A1', 'A2'])
+        work = self.queue.pop(0)
+        self.queue.leaseStarted(work, 0)
+        self.failIf(self.queue.hasReady(0))
+        self.queue.leaseEnded(work)
+        self.failUnless(self.queue.hasReady(0))
+
+    def testBusyHostsDontHoldOthersUp(self):
+        self.queue.setHostPolicy('slow', min_delay=60)
+        self.queue.bindAction('A', 'slow')
+        self.queue.extend(['A1', 'A2', 'B1', 'B2'])
+        popped = [self.queue.pop(100) for i in range(3)]
+        self.assertEqual(sorted(popped), ['A2', 'B1', 'B2'])
+        self.assertRaises(IndexError, self.queue.pop, 100)
+
+
+class SchedulerHostPolicyTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1000
+
+    def testMaxActiveFreedWhenDone(self):
+        self.scheduler.registerAction('A', 'h')
+        self.scheduler.setHostPolicy('h', 0, 1)
+        self.scheduler.appendWork('A', 'x')
+        self.scheduler.appendWork('A', 'y')
+        self.assertEqual(self.assign('p1'), 'y')
+        self.assertEqual(self.ping('p2')[0].split()[0], 'SLEEP')
+        self.scheduler.markWorkDone('A', 'y')
+        self.assertEqual(self.assign('p2'), 'x')
+
+
+class WeightedSharingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = scheduler.PoliteWorkQueue(lambda work: work[0], '*')
+
+    def popMany(self, n, now=0):
+        return ''.join([self.queue.pop(now)[0] for i in range(n)])
+
+    def testWeights(self):
+        for i in range(100):
+            self.queue.append('A%i' % i)
+            self.queue.append('B%i' % i)
+        self.queue.getAction('A').weight = 2.0
+        popped = self.popMany(30)
+        self.assertEqual(popped.count('A'), 20)
+        self.assertEqual(popped.count('B'), 10)
+
+    def testFractionalWeights(self):
+        for i in range(100):
+            self.queue.append('A%i' % i)
+            self.queue.append('B%i' % i)
+        self.queue.getAction('B').weight = 0.25
+        popped = self.popMany(50)
+        self.assertEqual(popped.count('B'), 10)
+
+    def testBacklogSizeDoesNotMatter(self):
+        for i in range(100):
+            self.queue.append('A%i' % i)
+        for i in range(5):
+            self.queue.append('B%i' % i)
+        self.assertEqual(self.popMany(10).count('B'), 5)
+
+    def testPausedAction(self):
+        self.queue.append('A1')
+        self.queue.append('B1')
+        self.queue.getAction('A').weight = 0
+        self.assertEqual(self.queue.pop(0), 'B1')
+        self.failIf(self.queue.hasReady(0))
+        self.assertRaises(IndexError, self.queue.pop, 0)
+
+
+class LeaseRenewalTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1000
+
+    def testOnlyTheOwnerRenews(self):
+        self.scheduler.appendWork('A', 'x')
+        self.assertEqual(self.assign('p1'), 'x')
+        self.assertEqual(self.scheduler.renderRenew('p1', 'A', 'x'),
+                         'RENEWED x #')
+        self.assertEqual(self.scheduler.renderRenew('p2', 'A', 'x'),
+                         'EXPIRED x #')
+
+    def testUnknownJobsAreExpired(self):
+        self.assertEqual(self.scheduler.renderRenew('p1', 'A', 'x'),
+                         'EXPIRED x #')
+
+    def testRenewalPostponesRecycling(self):
+        self.scheduler.appendWork('A', 'x')
+        self.assign('p1')
+        window = self.scheduler.MIN_LIVENESS_INTERVALS * \
+                 self.scheduler.interval
+        self.clock.now += window - 1
+        self.scheduler.renderRenew('p1', 'A', 'x')
+        self.clock.now += window - 1
+        self.scheduler.timerCallback()
+        self.assertEqual(self.scheduler.renderRenew('p1', 'A', 'x'),
+                         'RENEWED x #')
+
+
+class RetryTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1000
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.dead = []
+        self.scheduler.registerAction('A', dead_letter=self.dead.append)
+
+    def expireLeases(self):
+        self.clock.now += (self.scheduler.MIN_LIVENESS_INTERVALS *
+                           self.scheduler.interval + 1)
+        self.scheduler.timerCallback()
+
+    def testRetryAfterTimeout(self):
+        self.scheduler.appendWork('A', 'x')
+        self.assign('p1')
+        self.expireLeases()
+        work = self.scheduler.jobs.find('A', 'x')
+        self.failUnless(work in self.scheduler.delayed)
+        self.failIf(work in self.scheduler.active_queue)
+        self.assertEqual(self.scheduler.getPeerStats('p1').n_failed, 1)
+        self.assertEqual(self.ping('p2')[0].split()[0], 'SLEEP')
+        # Retried once its delay is over
+        self.clock.now += self.scheduler.RETRY_BASE_DELAY
+        self.assertEqual(self.assign('p2'), 'x')
+        self.assertEqual(self.scheduler.attempts[work], 2)
+
+    def testDeadLetter(self):
+        self.scheduler.MAX_ATTEMPTS = 2
+        self.scheduler.appendWork('A', 'x')
+        for i in range(2):
+            self.clock.now += self.scheduler.RETRY_MAX_DELAY
+            self.assign('p%i' % i)
+            self.expireLeases()
+        self.assertEqual(self.dead, ['x'])
+        self.assertEqual(self.scheduler.dead_letters, {'A': 1})
+        self.failIf(self.scheduler.isKnown('A', 'x'))
+
+    def testDoneJobsForgetTheirAttempts(self):
+        self.scheduler.appendWork('A', 'x')
+        self.assign('p1')
+        self.expireLeases()
+        self.clock.now += self.scheduler.RETRY_BASE_DELAY
+        self.assign('p2')
+        self.scheduler.markWorkDone('A', 'x')
+        self.assertEqual(self.scheduler.attempts, {})
+
+
+class CountingRateController(scheduler.AIMDRateController):
+    """Remembers how many successes it saw, adjustments notwithstanding."""
+
+    n_successes = 0
+
+    def success(self):
+        self.n_successes += 1
+        scheduler.AIMDRateController.success(self)
+
+
+class AIMDRateControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = scheduler.AIMDRateController(1, 10, increase=1)
+
+    def testIncreaseWithoutFailures(self):
+        self.controller.success()
+        self.assertEqual(self.controller.adjust(5, 0), 6)
+        self.assertEqual(self.controller.adjust(6, 1), 6)   # nothing done
+
+    def testDecreaseOnFailures(self):
+        for i in range(5):
+            self.controller.success()
+        self.controller.failure('timeout')
+        self.assertEqual(self.controller.adjust(8, 0), 4)
+        self.assertEqual(len(self.controller.history), 1)
+
+    def testRateIsBounded(self):
+        self.controller.failure('backtrace')
+        self.assertEqual(self.controller.adjust(1, 0), 1)
+        self.controller.success()
+        self.assertEqual(self.controller.adjust(10, 1), 10)
+
+
+class SchedulerRateControlTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1000
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.scheduler.rate_controller = CountingRateController(1, 2)
+        self.scheduler.registerAction('A')
+
+    def testDoneJobsAreSuccesses(self):
+        self.scheduler.appendWork('A', 'x')
+        self.assertEqual(self.assign('p1'), 'x')
+        self.scheduler.markWorkDone('A', 'x')
+        self.assertEqual(self.scheduler.rate_controller.n_successes, 1)
+
+    def testGivingUpIsNoSuccess(self):
+        self.scheduler.MAX_ATTEMPTS = 1
+        self.scheduler.appendWork('A', 'x')
+        self.assign('p1')
+        self.clock.now += (self.scheduler.MIN_LIVENESS_INTERVALS *
+                           self.scheduler.interval + 1)
+        self.scheduler.timerCallback()
+        self.failIf(self.scheduler.isKnown('A', 'x'))
+        self.assertEqual(self.scheduler.rate_controller.n_successes, 0)
+
+
+class JobTableTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        jobs = scheduler.JobTable()
+        job_id = jobs.add('ARTICLE', '7/150')
+        self.assertEqual(jobs.get(job_id), ('ARTICLE', '7/150'))
+        self.assertEqual(jobs.actionOf(job_id), 'ARTICLE')
+        self.assertEqual(jobs.find('ARTICLE', '7/150'), job_id)
+
+    def testActionsAreInterned(self):
+        jobs = scheduler.JobTable()
+        jobs.add('A', '1')
+        jobs.add('B', '1')
+        jobs.add('A', '2')
+        self.assertEqual(jobs.getActions(), ['A', 'B'])
+        restored = scheduler.JobTable(jobs.getActions())
+        self.assertEqual(restored.find('B', '1'), jobs.find('B', '1'))
+
+    def testUnknownAction(self):
+        jobs = scheduler.JobTable()
+        self.assertEqual(jobs.find('A', '1'), None)
+
+    def testTooManyActions(self):
+        jobs = scheduler.JobTable()
+        for i in range(jobs.MAX_ACTIONS):
+            jobs.add(str(i), '')
+        self.assertRaises(ValueError, jobs.add, 'one more', '')
+
+
+class SchedulerJobTableTest(SchedulerTestCase):
+
+    def testUnknownWork(self):
+        self.scheduler.appendWork('A', 'y')
+        self.assertRaises(KeyError, self.scheduler.markWorkDone, 'A', 'x')
+        self.assertRaises(KeyError, self.scheduler.markWorkDone, 'B', 'x')
+
+
+class RevisitPlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.planner = scheduler.RevisitPlanner(10, 1000, min_gain=5)
+
+    def testNewItemsAreDueAfterMinInterval(self):
+        self.planner.observe('a', 0, 100)
+        self.assertEqual(self.planner.pop(9, 10), [])
+        self.assertEqual(self.planner.pop(10, 10), [('a', 100)])
+
+    def testGrowthRate(self):
+        self.planner.observe('a', 0, 100)
+        self.planner.observe('a', 20, 300)
+        last_crawl, measure, rate, cost = self.planner.getState('a')
+        self.assertEqual(rate, 10.0)
+        self.assertEqual(self.planner.expectedMeasure('a', 25), 350)
+
+    def testItemsThatStopGrowingAreForgotten(self):
+        self.planner.observe('a', 0, 100)
+        self.failIf(self.planner.observe('a', 20, 100))
+        self.failIf('a' in self.planner.items)
+
+    def testBiggestGainFirst(self):
+        self.planner.observe('slow', 0, 100)
+        self.planner.observe('fast', 0, 100)
+        self.planner.observe('slow', 20, 200)
+        self.planner.observe('fast', 20, 400)
+        self.assertEqual([key for key, measure in self.planner.pop(1e6, 1)],
+                         ['fast'])
+        self.assertEqual([key for key, measure in self.planner.pop(1e6, 1)],
+                         ['slow'])
+
+    def testPoppedItemsAreNotReturnedAgain(self):
+        for i in range(10):
+            self.planner.observe(i, 0, 100)
+        self.assertEqual(len(self.planner.pop(10, 10)), 10)
+        # Piles up stale entries, so the heap is compacted
+        for i in range(100):
+            self.planner.observe('x', 0, 100)
+        self.assertEqual(self.planner.pop(1e6, 100), [('x', 100)])
+        self.assertEqual(self.planner.pop(1e6, 100), [])
+
+    def testPostpone(self):
+        self.planner.observe('a', 0, 100)
+        self.planner.pop(10, 1)
+        self.planner.postpone('a', 50)
+        self.assertEqual(self.planner.pop(59, 1), [])
+        self.assertEqual(self.planner.pop(60, 1), [('a', 100)])
+
+
+class LongPollTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1000
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.woken = []
+
+    def park(self, peer_id, **kwargs):
+        """Park a peer, recording the commands it gets in self.woken."""
+        callback = lambda commands: self.woken.append((peer_id, commands))
+        self.scheduler.parkPeer(peer_id, callback, **kwargs)
+        return callback
+
+    def testWokenWhenWorkArrives(self):
+        self.park('p1')
+        self.park('p2')
+        self.assertEqual(self.woken, [])
+        self.scheduler.appendWork('A', 'x')
+        self.assertEqual(self.woken, [('p1', 'A x #')])
+        self.failIf('p1' in self.scheduler.parked)
+        self.failUnless('p2' in self.scheduler.parked)
+
+    def testBatchesWhenParked(self):
+        for params in 'xyz':
+            self.scheduler.appendWork('A', params)
+        self.park('p1', batch_size=2)
+        self.assertEqual(self.woken, [('p1', 'A z #\nA y #')])
+
+    def testOnlyPeersAbleToRunTheJob(self):
+        self.park('p1', actions=set(['B']))
+        self.park('p2', actions=set(['A']))
+        self.park('p3')
+        self.scheduler.appendWork('A', 'x')
+        self.assertEqual(self.woken, [('p2', 'A x #')])
+        self.scheduler.appendWork('A', 'y')
+        self.assertEqual(self.woken[-1], ('p3', 'A y #'))
+        self.assertEqual(self.scheduler.parked.keys(), ['p1'])
+        self.assertEqual(self.scheduler.parked_by_action.keys(), ['B'])
+
+    def testUnpark(self):
+        callback = self.park('p1')
+        self.scheduler.unparkPeer('p1', lambda commands: None)
+        self.failUnless('p1' in self.scheduler.parked)
+        self.scheduler.unparkPeer('p1', callback)
+        self.assertEqual(self.scheduler.parked_by_action, {})
+        self.scheduler.appendWork('A', 'x')
+        self.assertEqual(self.woken, [])
+
+    def testParkingAgainReplacesTheOldParking(self):
+        self.park('p1', actions=set(['B']))
+        self.park('p1', actions=set(['A']))
+        self.scheduler.appendWork('B', 'x')
+        self.assertEqual(self.woken, [])
+        self.scheduler.appendWork('A', 'y')
+        self.assertEqual(self.woken, [('p1', 'A y #')])
+
+
+class BeatLongPollTest(SchedulerTestCase):
+
+    def testWokenAtTheNextBeat(self):
+        woken = []
+        self.scheduler.parkPeer('p1', woken.append)
+        self.scheduler.appendWork('A', 'x')
+        self.assertEqual(woken, [])
+        self.beat()
+        self.assertEqual(woken, ['A x #'])
+
+
+class SizeAwareTest(SchedulerTestCase):
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.scheduler.registerAction('A', job_cost=int)
+        for params in ['1', '5', '9']:
+            self.scheduler.appendWork('A', params)
+        self.scheduler._peerDone('fast', 10, 1000)
+        self.scheduler._peerDone('slow', 1000, 10)
+
+    def testSlowPeersGetSmallJobs(self):
+        self.beat()
+        self.assertEqual(self.assign('slow'), '1')
+        # The promoted job is still next in line
+        self.beat()
+        self.assertEqual(self.assign('fast'), '9')
+
+    def testFastPeersGetBigJobs(self):
+        self.scheduler.appendWork('A', '2')
+        self.beat()
+        self.assertEqual(self.assign('fast'), '9')
+        self.assertEqual(len(self.scheduler.work_queue), 3)
+        self.assertEqual(len(self.scheduler.ready_queue), 0)
+
+    def testUnknownPeersGetAverageJobs(self):
+        self.beat()
+        self.assertEqual(self.assign('new'), '5')
+        self.beat()
+        self.assertEqual(self.assign('slow'), '1')
+
+
+class DispatchRateSizeAwareTest(SizeAwareTest):
+
+    DISPATCH_RATE = 1000
+
+    def beat(self, n=1):
+        pass    # jobs are handed straight from the pending queue
+
+
+class AbortTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1000
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.scheduler.RETRY_BASE_DELAY = 0
+        for params in 'xy':
+            self.scheduler.appendWork('A', params)
+        self.assertEqual(self.ping('p1', batch_size=2), ['A y #', 'A x #'])
+        # p1 takes too long, so its jobs are handed to (and done by) p2
+        self.clock.now += (self.scheduler.MIN_LIVENESS_INTERVALS *
+                           self.scheduler.interval + 1)
+        self.scheduler.timerCallback()
+        self.assertEqual(sorted(self.ping('p2', batch_size=2)),
+                         ['A x #', 'A y #'])
+        self.scheduler.markWorkDone('A', 'x', 'p2')
+        self.scheduler.markWorkDone('A', 'y', 'p2')
+
+    def testAbortOnRenewal(self):
+        self.assertEqual(self.scheduler.renderRenew('p1', 'A', 'x'),
+                         'ABORT x #')
+        # Done jobs are remembered for a while, even without former owners
+        self.assertEqual(self.scheduler.renderRenew('p3', 'A', 'x'),
+                         'ABORT x #')
+
+    def testAbortOnPing(self):
+        commands = self.ping('p1', just_ping=True, send_aborts=True)
+        self.assertEqual(commands[0].split()[0], 'SLEEP')
+        self.assertEqual(sorted(commands[1:]), ['ABORT x #', 'ABORT y #'])
+        self.assertEqual(self.ping('p1', just_ping=True, send_aborts=True)[1:],
+                         [])
+
+    def testOldPeersArentToldToAbort(self):
+        self.assertEqual(len(self.ping('p1', just_ping=True)), 1)
+        self.assertEqual(self.scheduler.aborts, {})
+
+    def testIdlePeersHaveNothingToAbort(self):
+        self.assertEqual(len(self.ping('p1', send_aborts=True)), 1)
+        self.assertEqual(self.scheduler.aborts, {})
+
+
+class SnapshotTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1000
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.snapshot_file = os.path.join(self.dir, 'scheduler.snapshot')
+        self.journal_file = os.path.join(self.dir, 'scheduler.journal')
+        self.scheduler.registerAction('A', 'h', weight=2)
+        for params in 'xyz':
+            self.scheduler.appendWork('A', params)
+        self.assertEqual(self.assign('p1'), 'z')
+
+    def tearDown(self):
+        if self.scheduler.journal is not None:
+            self.scheduler.journal.close()
+        shutil.rmtree(self.dir)
+        SchedulerTestCase.tearDown(self)
+
+    def restart(self):
+        """Replace the scheduler by one restored from the files it left."""
+        if self.scheduler.journal is not None:
+            self.scheduler.journal.close()
+        self.scheduler = scheduler.Scheduler(interval=1,
+                                             dispatch_rate=self.DISPATCH_RATE)
+        self.failUnless(self.scheduler.loadSnapshot(self.snapshot_file,
+                                                    self.journal_file))
+
+    def testRoundTrip(self):
+        self.scheduler.saveSnapshot(self.snapshot_file)
+        self.restart()
+        self.failUnless(self.scheduler.isRestored('A'))
+        self.failIf(self.scheduler.isRestored('B'))
+        self.failUnless(self.scheduler.isKnown('A', 'x'))
+        self.assertEqual(self.scheduler.work_queue.getAction('A').weight, 2)
+        # Leases survive restarts
+        self.assertEqual(self.scheduler.renderRenew('p1', 'A', 'z'),
+                         'RENEWED z #')
+        self.assertEqual(self.assign('p2'), 'y')
+
+    def testJournalReplay(self):
+        self.scheduler.openJournal(self.journal_file, append=False)
+        self.scheduler.saveSnapshot(self.snapshot_file)
+        self.scheduler.appendWork('A', 'w')
+        self.scheduler.markWorkDone('A', 'x')
+        self.scheduler.markWorkDone('A', 'z', 'p1')
+        self.restart()
+        self.failUnless(self.scheduler.isKnown('A', 'w'))
+        self.failIf(self.scheduler.isKnown('A', 'x'))
+        self.failIf(self.scheduler.isKnown('A', 'z'))
+        self.failUnless(self.scheduler.isKnown('A', 'y'))
+
+    def testOldJournalIsReplayed(self):
+        self.scheduler.openJournal(self.journal_file, append=False)
+        self.scheduler.saveSnapshot(self.snapshot_file)
+        self.scheduler.markWorkDone('A', 'x')
+        # We stop while the next snapshot is being written
+        self.scheduler._rotateJournal()
+        self.scheduler.markWorkDone('A', 'y')
+        self.failUnless(os.path.exists(self.journal_file + '.old'))
+        self.restart()
+        self.failIf(self.scheduler.isKnown('A', 'x'))
+        self.failIf(self.scheduler.isKnown('A', 'y'))
+        self.failUnless(self.scheduler.isKnown('A', 'z'))
+
+    def testDowntimeDoesntCount(self):
+        self.scheduler.saveSnapshot(self.snapshot_file)
+        self.clock.now += 1000 * self.scheduler.interval
+        self.restart()
+        self.scheduler.timerCallback()
+        self.assertEqual(self.scheduler.renderRenew('p1', 'A', 'z'),
+                         'RENEWED z #')
+
+
+class RoutedQueueTest(unittest.TestCase):
+
+    def testOnlyGivenActions(self):
+        queue = scheduler.RoutedQueue(lambda work: work[0])
+        queue.extend(['A1', 'B1', 'A2'])
+        self.assertEqual(queue.count('A'), 2)
+        self.assertEqual(queue.pop(['B']), 'B1')
+        self.failIf(queue.hasAny(['B']))
+        self.assertRaises(IndexError, queue.pop, ['B'])
+        self.failUnless(queue.hasAny())
+
+    def testPoliteWorkQueue(self):
+        queue = scheduler.PoliteWorkQueue(lambda work: work[0], '*')
+        queue.extend(['A1', 'B1'])
+        self.assertEqual(queue.pop(0, ['B']), 'B1')
+        self.failIf(queue.hasReady(0, ['B']))
+        self.failUnless(queue.hasReady(0))
+
+
+class RoutingTest(SchedulerTestCase):
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.scheduler.appendWork('A', 'a1')
+        self.scheduler.appendWork('B', 'b1')
+
+    def testPeersOnlyGetJobsTheyCanRun(self):
+        self.beat(2)
+        self.assertEqual(self.ping('p1', actions=set(['C']))[0].split()[0],
+                         'SLEEP')
+        self.assertEqual(self.assign('p1', actions=set(['B'])), 'b1')
+        self.assertEqual(self.assign('p2'), 'a1')
+
+
+class DispatchRateRoutingTest(RoutingTest):
+
+    DISPATCH_RATE = 1000
+
+
+class ReadyCapTest(SchedulerTestCase):
+
+    def testUnclaimedActionsDontHoldOthersUp(self):
+        for i in range(10):
+            self.scheduler.appendWork('A', 'a%i' % i)
+        self.scheduler.appendWork('B', 'b1')
+        self.beat(20)
+        self.assertEqual(self.scheduler.ready_queue.count('A'),
+                         self.scheduler.MAX_READY_WORKS + 1)
+        self.assertEqual(self.assign('p1', actions=set(['B'])), 'b1')
+
+
+class AddressBudgetTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1000
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.scheduler.ADDRESS_BUDGET = 2
+        for i in range(10):
+            self.scheduler.appendWork('A', str(i))
+
+    def testPeersBehindTheSameAddressShareTheBudget(self):
+        self.assign('p1', address='10.0.0.1')
+        self.assign('p2', address='10.0.0.1')
+        self.assertEqual(self.ping('p3', address='10.0.0.1')[0].split()[0],
+                         'SLEEP')
+        self.assign('p4', address='10.0.0.2')
+
+    def testBatchesAreCut(self):
+        self.assertEqual(len(self.ping('p1', address='10.0.0.1',
+                                       batch_size=5)), 2)
+
+    def testBudgetIsRefilled(self):
+        self.ping('p1', address='10.0.0.1', batch_size=2)
+        self.clock.now += self.scheduler.ADDRESS_WINDOW + 1
+        self.assign('p2', address='10.0.0.1')
+
+    def testIdleAddressesAreForgotten(self):
+        self.assign('p1', address='10.0.0.1')
+        self.clock.now += self.scheduler.ADDRESS_WINDOW
+        self.assign('p2', address='10.0.0.2')
+        self.scheduler.timerCallback()
+        self.assertEqual(self.scheduler.address_meters.keys(), ['10.0.0.2'])
+
+
+class LeaseOwnerTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1000
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.scheduler.RETRY_BASE_DELAY = 0
+        for params in 'xy':
+            self.scheduler.appendWork('A', params)
+        self.assertEqual(self.assign('p1'), 'y')
+
+    def testDeadPeersLoseTheirJobs(self):
+        self.clock.now += (self.scheduler.MIN_LIVENESS_INTERVALS *
+                           self.scheduler.interval + 1)
+        self.scheduler.renderRenew('p2', 'A', 'x')  # p2 is still alive
+        self.scheduler.timerCallback()
+        self.failIf('p1' in self.scheduler.peer_leases)
+        self.assertEqual(sorted([self.assign('p2'), self.assign('p2')]),
+                         ['x', 'y'])
+
+    def testIdlePingsKeepJobsByDefault(self):
+        self.assertEqual(self.assign('p1'), 'x')
+        self.assertEqual(len(self.scheduler.peer_leases['p1']), 2)
+
+    def testRecycleOnIdlePing(self):
+        self.scheduler.RECYCLE_ON_IDLE_PING = True
+        self.assign('p1')
+        self.assertEqual(len(self.scheduler.peer_leases['p1']), 1)
+        self.assertEqual(self.assign('p1'), 'y')
+
+
+class DeadlineTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1000
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.expired = []
+        self.scheduler.registerAction('A', expiry=self.expired.append)
+        self.now = self.clock.now
+
+    def testPendingJobsExpire(self):
+        self.scheduler.appendWork('A', 'x', deadline=self.now + 10)
+        self.scheduler.appendWork('A', 'y')
+        self.clock.now += 10
+        self.assertEqual(self.assign('p1'), 'y')
+        self.assertEqual(self.expired, ['x'])
+        self.assertEqual(self.scheduler.expired, {'A': 1})
+        self.failIf(self.scheduler.isKnown('A', 'x'))
+        self.assertEqual(self.ping('p1')[0].split()[0], 'SLEEP')
+
+    def testActiveJobsAreLeftAlone(self):
+        self.scheduler.appendWork('A', 'x', deadline=self.now + 10)
+        self.assertEqual(self.assign('p1'), 'x')
+        self.clock.now += 10
+        self.scheduler.timerCallback()
+        self.assertEqual(self.expired, [])
+        self.assertEqual(self.scheduler.renderRenew('p1', 'A', 'x'),
+                         'RENEWED x #')
+
+    def testRecycledJobsExpire(self):
+        self.scheduler.appendWork('A', 'x', deadline=self.now + 5)
+        self.assign('p1')
+        self.clock.now += (self.scheduler.MIN_LIVENESS_INTERVALS *
+                           self.scheduler.interval + 1)
+        self.scheduler.timerCallback()
+        self.assertEqual(self.ping('p2')[0].split()[0], 'SLEEP')
+        self.assertEqual(self.expired, ['x'])
+        self.failIf(self.scheduler.isKnown('A', 'x'))
+
+    def testDoneJobsDontExpire(self):
+        self.scheduler.appendWork('A', 'x', deadline=self.now + 10)
+        self.scheduler.markWorkDone('A', 'x')
+        self.clock.now += 10
+        self.scheduler.timerCallback()
+        self.assertEqual(self.expired, [])
+        self.assertEqual(self.scheduler.deadlines, {})
+
+
+class BeatDeadlineTest(SchedulerTestCase):
+
+    def testReadyJobsExpire(self):
+        expired = []
+        self.scheduler.registerAction('A', expiry=expired.append)
+        self.scheduler.appendWork('A', 'x', deadline=self.clock.now + 5)
+        self.beat()
+        self.assertEqual(len(self.scheduler.ready_queue), 1)
+        self.beat(5)
+        self.assertEqual(expired, ['x'])
+        self.assertEqual(len(self.scheduler.ready_queue), 0)
+
+
+class SpeculationTest(SchedulerTestCase):
+
+    DISPATCH_RATE = 1000
+
+    def setUp(self):
+        SchedulerTestCase.setUp(self)
+        self.scheduler.speculative = True
+        self.scheduler.appendWork('A', 'x')
+        self.assertEqual(self.assign('p1'), 'x')
+
+    def age(self):
+        """Make the active job old enough to get a backup copy."""
+        self.clock.now += self.scheduler.SPECULATION_MIN_AGE * \
+                          self.scheduler.interval + 1
+
+    def testNoBackupsOfYoungJobs(self):
+        self.assertEqual(self.ping('p2')[0].split()[0], 'SLEEP')
+
+    def testBackups(self):
+        self.age()
+        self.assertEqual(self.assign('p2'), 'x')
+        # One backup copy per job, and none to its owner
+        self.assertEqual(self.ping('p3')[0].split()[0], 'SLEEP')
+        self.assertEqual(self.ping('p1', just_ping=True)[0].split()[0],
+                         'SLEEP')
+        self.assertEqual(self.scheduler.backups.keys(),
+                         [self.scheduler.jobs.find('A', 'x')])
+
+    def testFirstCompletionWins(self):
+        self.age()
+        self.assign('p2')
+        self.scheduler.markWorkDone('A', 'x', 'p2')
+        self.failIf(self.scheduler.isKnown('A', 'x'))
+        self.assertEqual(self.scheduler.backups, {})
+        self.assertEqual(self.scheduler.renderRenew('p1', 'A', 'x'),
+                         'ABORT x #')
+        # Late duplicates are just acknowledged
+        self.scheduler.markWorkDone('A', 'x', 'p1')
+
+    def testBackupHolderInheritsTheJob(self):
+        self.age()
+        self.assign('p2')
+        self.clock.now += (self.scheduler.MIN_LIVENESS_INTERVALS *
+                           self.scheduler.interval)
+        self.ping('p2', just_ping=True)     # p2 is still alive, p1 isn't
+        self.scheduler.timerCallback()
+        self.assertEqual(self.scheduler.renderRenew('p2', 'A', 'x'),
+                         'RENEWED x #')
+        self.assertEqual(self.scheduler.backups, {})
+
+    def testBackupsFollowHostPolicies(self):
+        self.scheduler.setHostPolicy(self.scheduler.DEFAULT_HOST, 0, 1)
+        self.age()
+        self.assertEqual(self.ping('p2')[0].split()[0], 'SLEEP')
+
+    def testNoBackupsWhileThereIsWork(self):
+        self.scheduler.appendWork('A', 'y')
+        self.age()
+        self.assertEqual(self.assign('p2'), 'y')
+        self.assertEqual(self.scheduler.backups, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: set ai tw=80 et sw=4 ts=4 sts=4 fileencoding=utf-8 :